@@ -1,9 +1,30 @@
 file_path=~/InForage/dataset/index
 index_file=$file_path/e5_Flat.index
 corpus_file=$file_path/wiki-18.jsonl
+doc_store=$file_path/wiki-18_docstore # built from corpus_file on the first launch
 retriever=~/InForage/LLMs/e5-base-v2
 
 CUDA_VISIBLE_DEVICES=1,2,3,4,5,6,7 python tools/search/retrieval_server.py --index_path $index_file \
                                             --corpus_path $corpus_file \
+                                            --doc_store_path $doc_store \
                                             --topk 3 \
                                             --retriever_model $retriever
+
+# Hybrid bm25 + dense retrieval (reciprocal rank fusion) over a pyserini index of the same corpus:
+#   --bm25_index_path $file_path/bm25 --fusion rrf --dense_depth 50 --bm25_depth 50
+
+# Passage token ids for the policy tokenizer, returned to rollouts with tokenized_evidence=True.
+# Build once next to the index, then launch with --token_store_path $file_path/wiki-18_tokens_qwen:
+#   python tools/search/token_store.py --corpus_path $corpus_file --doc_store_path $doc_store \
+#       --tokenizer Qwen/Qwen2.5-7B-Instruct --save_dir $file_path/wiki-18_tokens_qwen
+
+# Multi-process serving on cpu: 8 workers share one read-only mmap of the index and the doc store,
+# each with its own encoder replica (faiss threads are split between the workers):
+#   --faiss_cpu --workers 8
+
+# Scatter-gather over a sharded index (index_builder.py --index_shards): the coordinator keeps the encoder
+# and doc store and merges the top-k of one shard server per shard. All shards as local processes:
+#   --faiss_cpu --launch_local_shards        (shard servers on --port + 1, + 2, ...)
+# or start a shard per node and point the coordinator at them:
+#   python tools/search/retrieval_server.py --index_path $index_file --shard_id $NODE_RANK --faiss_cpu --port 28707
+#   ... --shard_urls http://node0:28707 http://node1:28707
@@ -0,0 +1,79 @@
+import torch
+from collections import OrderedDict
+from typing import List, Union
+
+# an observation is either a plain string or a list of segments, each a string or pre-tokenized ids
+Segment = Union[str, List[int]]
+
+
+class EvidenceTokenizer:
+    """
+    Tokenizes observations segment by segment with an LRU cache of segment ids.
+    The same passages are retrieved over and over during training, so an
+    observation is assembled by concatenating the cached ids of its segments
+    (tags and rank prefixes, passages) and only unseen segments go through the tokenizer,
+    in one batched call per turn.
+    """
+    def __init__(self, tokenizer, pad_token_id: int, max_entries: int = 200000):
+        self.tokenizer = tokenizer
+        self.pad_token_id = pad_token_id
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        # observations truncated by the last encode call
+        self.num_truncated = 0
+
+    def _lookup(self, texts: List[str]) -> List[List[int]]:
+        missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        if missing:
+            encoded = self.tokenizer(missing, add_special_tokens=False)['input_ids']
+            self.cache.update(zip(missing, encoded))
+        ids = []
+        for text in texts:
+            self.cache.move_to_end(text)
+            ids.append(self.cache[text])
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return ids
+
+    @staticmethod
+    def _segment_cap(lengths: List[int], max_length: int) -> int:
+        """
+        Largest per-segment length at which all segments fit into `max_length` tokens,
+        None if they fit untruncated. Short segments (tags, rank prefixes) are kept
+        whole and the budget left is shared evenly by the long ones (the passages).
+        """
+        if sum(lengths) <= max_length:
+            return None
+        remaining = max_length
+        for k, length in enumerate(sorted(lengths)):
+            share = remaining // (len(lengths) - k)
+            if length > share:
+                return share
+            remaining -= length
+        return None
+
+    def encode(self, observations: List[Union[str, List[Segment]]], max_length: int) -> torch.Tensor:
+        """
+        Right-padded ids of the observations. An observation longer than `max_length`
+        tokens is truncated per passage, so every passage and the closing tag survive.
+        """
+        observations = [[obs] if isinstance(obs, str) else obs for obs in observations]
+        texts = [segment for obs in observations for segment in obs if isinstance(segment, str)]
+        text_ids = iter(self._lookup(texts))
+
+        rows = []
+        self.num_truncated = 0
+        for obs in observations:
+            segments = [next(text_ids) if isinstance(segment, str) else segment for segment in obs]
+            cap = self._segment_cap([len(segment) for segment in segments], max_length)
+            self.num_truncated += cap is not None
+            row = []
+            for segment in segments:
+                row.extend(segment if cap is None else segment[:cap])
+            rows.append(row)
+
+        width = max((len(row) for row in rows), default=0)
+        ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        for i, row in enumerate(rows):
+            ids[i, :len(row)] = torch.tensor(row, dtype=torch.long)
+        return ids
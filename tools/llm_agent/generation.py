@@ -1,14 +1,26 @@
 import torch
 import re
+import time
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import os
 from typing import List, Dict, Any, Tuple
 from dataclasses import dataclass
-from .tensor_helper import TensorHelper, TensorConfig
+from .tensor_helper import TensorHelper, TensorConfig, TrajectoryBuffer
+from .search_client import SearchClient, SearchClientConfig
+from .evidence import EvidenceTokenizer
 from verl import DataProto
 from verl.utils.tracking import Tracking
+from verl.utils.torch_functional import pad_sequence_to_length
 import shutil
-import requests
+import ray
+
+ACTION_PATTERN = re.compile(r'<(search|answer)>(.*?)</\1>', re.DOTALL)
+
+INVALID_ACTION_OBS = '\nMy previous action is invalid. \
+If I want to search, I should put the query between <search> and </search>. \
+If I want to give the final answer, I should put the answer between <answer> and </answer>. Let me try again.\n'
 
 @dataclass
 class GenerationConfig:
@@ -22,6 +34,15 @@ class GenerationConfig:
     search_url: str = None
     wiki_url: str = None
     topk: int = 3
+    search_timeout: float = 60.0
+    search_retries: int = 3
+    pipeline_chunks: int = 1
+    reuse_prefix_cache: bool = False
+    stop_at_action_tags: bool = False
+    tokenized_evidence: bool = False
+    n_agent: int = 1
+    # step reward for retrieving the source urls of an example, off keeps the reward at 0 as before
+    source_url_reward: bool = False
 
 class LLMGenerationManager:
     def __init__(
@@ -30,11 +51,14 @@ class LLMGenerationManager:
         actor_rollout_wg,
         config: GenerationConfig,
         is_validation: bool = False,
+        retrieval_actor=None,
     ):
         self.tokenizer = tokenizer
         self.actor_rollout_wg = actor_rollout_wg
         self.config = config
         self.is_validation = is_validation
+        # RetrievalActor handle, serves the queries of search_url in-cluster instead of over HTTP
+        self.retrieval_actor = retrieval_actor
 
         self.tensor_fn = TensorHelper(TensorConfig(
             pad_token_id=tokenizer.pad_token_id,
@@ -42,6 +66,44 @@ class LLMGenerationManager:
             max_obs_length=config.max_obs_length,
             max_start_length=config.max_start_length
         ))
+        self.search_client = SearchClient(SearchClientConfig(
+            timeout=config.search_timeout,
+            retries=config.search_retries
+        ))
+        # retrieval of one chunk runs here while the next chunk generates, see _pipelined_step
+        self.pipeline_executor = ThreadPoolExecutor(max_workers=1)
+        # set by the trainer, per-stage timings of the loop are accumulated into it
+        self.timing_raw = None
+        # set by the trainer to a RolloutProfiler, collects per-turn stage metrics and trace spans
+        self.profiler = None
+        # the first generate call of a rollout drops the prefix cache of the previous weights
+        self._reset_prefix_cache = True
+        # evidence is assembled from cached passage ids, see _process_next_obs
+        self.evidence_tokenizer = EvidenceTokenizer(tokenizer, tokenizer.pad_token_id)
+
+    @contextmanager
+    def _stage_timer(self, name: str):
+        """Accumulate the time spent in a rollout stage over all turns into timing_raw."""
+        start = time.perf_counter()
+        try:
+            if self.profiler is not None:
+                with self.profiler.span(name):
+                    yield
+            else:
+                yield
+        finally:
+            # a failed stage (e.g. a retried generation) still took its time
+            if self.timing_raw is not None:
+                self.timing_raw[name] = self.timing_raw.get(name, 0.0) + time.perf_counter() - start
+
+    def _profile(self, name: str, value: float):
+        if self.profiler is not None:
+            self.profiler.add(name, value)
+
+    def _next_turn(self, turn: int, active_mask: torch.Tensor):
+        if self.profiler is not None:
+            self.profiler.next_turn(turn)
+            self.profiler.add('active_rows', active_mask.sum().item())
 
     def _batch_tokenize(self, responses: List[str]) -> torch.Tensor:
         """Tokenize a batch of responses."""
@@ -54,6 +116,13 @@ class LLMGenerationManager:
 
     def _postprocess_responses(self, responses: torch.Tensor) -> torch.Tensor:
         """Process responses to stop at search operation or answer operation."""
+        with self._stage_timer('gen_tokenize'):
+            return self._postprocess_response_ids(responses)
+
+    def _postprocess_response_ids(self, responses: torch.Tensor) -> torch.Tensor:
+        if self.config.stop_at_action_tags:
+            return self._trim_stopped_responses(responses)
+
         responses_str = self.tokenizer.batch_decode(
             responses, 
             skip_special_tokens=True
@@ -75,15 +144,35 @@ class LLMGenerationManager:
         responses = self._batch_tokenize(responses_str)
         return responses, responses_str
 
+    def _trim_stopped_responses(self, responses: torch.Tensor) -> Tuple[torch.Tensor, List[str]]:
+        """
+        Responses of a rollout stopped at the action tags already end with the tag,
+        so the generated ids are kept as they are instead of being re-tokenized.
+        The eos token is dropped like the decode round trip does, and the padding
+        columns are cut.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        responses = responses.masked_fill(responses == self.tokenizer.eos_token_id, pad_token_id)
+        width = max(int((responses != pad_token_id).sum(dim=1).max()), 1) if responses.shape[0] else 1
+        responses = responses[:, :width]
+        responses_str = self.tokenizer.batch_decode(responses, skip_special_tokens=True)
+        return responses, responses_str
+
     def _process_next_obs(self, next_obs: List[str]) -> torch.Tensor:
         """Process next observations from environment."""
-        
-        next_obs_ids = self.tokenizer(
-            next_obs, 
-            padding='longest',
-            return_tensors='pt',
-            add_special_tokens=False,  # Prevents adding special tokens
-        )['input_ids']
+        with self._stage_timer('gen_tokenize'):
+            if self.config.tokenized_evidence:
+                next_obs_ids = self.evidence_tokenizer.encode(next_obs, self.config.max_obs_length)
+                self._profile('truncated_obs', self.evidence_tokenizer.num_truncated)
+                return next_obs_ids
+
+            next_obs_ids = self.tokenizer(
+                next_obs,
+                padding='longest',
+                return_tensors='pt',
+                add_special_tokens=False,  # Prevents adding special tokens
+            )['input_ids']
+        self._profile('truncated_obs', ((next_obs_ids != self.tokenizer.pad_token_id).sum(dim=1) > self.config.max_obs_length).sum().item())
 
         if next_obs_ids.shape[1] > self.config.max_obs_length:
             print(f"[WARNING] OBSERVATION TOO LONG, CONSIDER CHANGING YOUR CONFIG, {next_obs_ids.shape[1]} & {self.config.max_obs_length}")            
@@ -91,138 +180,157 @@ class LLMGenerationManager:
 
         return next_obs_ids
 
-    def _update_rolling_state(self, rollings: DataProto, cur_responses: torch.Tensor, 
-                            next_obs_ids: torch.Tensor) -> Dict:
+    def _update_rolling_state(self, rollings: DataProto, rolling_buffer: TrajectoryBuffer,
+                              cur_responses: torch.Tensor, next_obs_ids: torch.Tensor) -> Dict:
         """Update rolling state with new responses and observations."""
-        # Concatenate and handle padding        
-        new_input_ids = self.tensor_fn.concatenate_with_padding([
-            rollings.batch['input_ids'],
-            cur_responses,
-            next_obs_ids
-        ])
-        
-        # Create attention mask and position ids
-        new_attention_mask = self.tensor_fn.create_attention_mask(new_input_ids)
-        new_position_ids = self.tensor_fn.create_position_ids(new_attention_mask)
+        # Append in place, the buffer drops the padding of the new segments
+        rolling_buffer.append(cur_responses)
+        rolling_buffer.append(next_obs_ids)
 
-        # Cut to appropriate length
-        effective_len = new_attention_mask.sum(dim=1).max()
-        max_len = min(self.config.max_prompt_length, effective_len)
+        # Left-padded view, cut to appropriate length
+        new_input_ids, new_position_ids = rolling_buffer.left_padded(self.config.max_prompt_length)
+        new_attention_mask = self.tensor_fn.create_attention_mask(new_input_ids)
+        rolling_buffer.truncate_left(self.config.max_prompt_length)
 
         new_rollings = DataProto.from_dict({
-            'input_ids': new_input_ids[:, -max_len:],
-            'position_ids': new_position_ids[:, -max_len:],
-            'attention_mask': new_attention_mask[:, -max_len:]
+            'input_ids': new_input_ids,
+            'position_ids': new_position_ids,
+            'attention_mask': new_attention_mask
         })
         new_rollings.meta_info.update(rollings.meta_info)
         
         return new_rollings
 
-    def _info_masked_concatenate_with_padding(self, 
-                prompt: torch.Tensor, 
-                prompt_with_mask: torch.Tensor, 
-                response: torch.Tensor, 
-                info: torch.Tensor = None,
-                pad_to_left: bool = True
-            ) -> torch.Tensor:
-        """Concatenate tensors and handle padding. Additionally, create a mask (info_mask) to cover the information block if it exists."""
-        pad_id = self.tokenizer.pad_token_id
-        tensors = [prompt, response]
-        tensors_with_mask = [prompt_with_mask, response]
-        if info is not None:
-            tensors.append(info)
-            info_mask = torch.full(info.size(), pad_id, dtype=info.dtype, device=info.device) # information mask
-            tensors_with_mask.append(info_mask)
-        
-        concatenated = torch.cat(tensors, dim=1)
-        concatenated_with_info = torch.cat(tensors_with_mask, dim=1)
-        mask = concatenated != pad_id if pad_to_left else concatenated == pad_id
-        sorted_indices = mask.to(torch.int64).argsort(dim=1, stable=True)
-        padded_tensor = concatenated.gather(1, sorted_indices)
-        padded_tensor_with_info = concatenated_with_info.gather(1, sorted_indices)
-
-        return padded_tensor, padded_tensor_with_info
-
-    def _update_right_side(self, right_side: Dict, 
+    def _update_right_side(self, right_buffer: TrajectoryBuffer,
                           cur_responses: torch.Tensor,
-                          next_obs_ids: torch.Tensor = None) -> Dict:
-        """Update right side state."""
-        if next_obs_ids != None:
-            responses, responses_with_info_mask = self._info_masked_concatenate_with_padding(
-                    right_side['responses'],
-                    right_side['responses_with_info_mask'],
-                    cur_responses,
-                    next_obs_ids, 
-                    pad_to_left=False
-                )
-        else:
-            responses, responses_with_info_mask = self._info_masked_concatenate_with_padding(
-                    right_side['responses'],
-                    right_side['responses_with_info_mask'],
-                    cur_responses,
-                    pad_to_left=False
-                )
-        effective_len = self.tensor_fn.create_attention_mask(responses).sum(dim=1).max()
-        max_len = min(self.config.max_prompt_length, effective_len)
-        
-        return {'responses': responses[:, :max_len], 'responses_with_info_mask': responses_with_info_mask[:, :max_len]}
+                          next_obs_ids: torch.Tensor = None):
+        """Update right side state, the observations are info-masked."""
+        right_buffer.append(cur_responses)
+        if next_obs_ids is not None:
+            right_buffer.append(next_obs_ids, is_info=True)
 
     def _generate_with_gpu_padding(self, active_batch: DataProto) -> DataProto:
         """
             Wrapper for generation that handles multi-GPU padding requirements.
             if num_gpus <= 1, return self.actor_rollout_wg.generate_sequences(active_batch)
-            if active_batch size is not divisible by num_gpus, pad with first sequence
-            then remove padding from output
+            otherwise the batch is dispatched ragged: the dispatcher pads it to a multiple of
+            num_gpus with placeholder rows on the last ranks, which are not generated and
+            are dropped from the output again
         """
-        num_gpus = self.config.num_gpus
-        if num_gpus <= 1:
-            return self.actor_rollout_wg.generate_sequences(active_batch)
-            
-        batch_size = active_batch.batch['input_ids'].shape[0]
-        remainder = batch_size % num_gpus
-        
-        for key in active_batch.batch.keys():
-            active_batch.batch[key] = active_batch.batch[key].long()
-        if remainder == 0:
-            return self.actor_rollout_wg.generate_sequences(active_batch)
-        
-        # Add padding sequences
-        padding_size = num_gpus - remainder
-        padded_batch = {}
-        
-        for k, v in active_batch.batch.items():
-            # Use first sequence as padding template
-            pad_sequence = v[0:1].repeat(padding_size, *[1] * (len(v.shape) - 1))
-            padded_batch[k] = torch.cat([v, pad_sequence], dim=0)
-
-        padded_active_batch = DataProto.from_dict(padded_batch)
-        for key in padded_active_batch.batch.keys():
-            padded_active_batch.batch[key] = padded_active_batch.batch[key].long()
+        # the log probs of the full trajectories are computed once after the loop, a
+        # per-turn recompute would also run with the kept kv cache still on the gpus
+        active_batch.meta_info['recompute_log_prob'] = False
+        if self.config.reuse_prefix_cache:
+            # keep the kv cache of the rollout between turns, so the history shared
+            # with the previous turn is served from the prefix cache
+            active_batch.meta_info.update(keep_cache_engine=True, reset_prefix_cache=self._reset_prefix_cache)
+            self._reset_prefix_cache = False
+        if self.config.stop_at_action_tags:
+            # vLLM stops decoding right after the action, see _trim_stopped_responses
+            active_batch.meta_info['stop'] = ['</search>', '</answer>']
+
+        if self.config.num_gpus > 1:
+            active_batch.meta_info['ragged_dispatch'] = True
+        # prompt tokens sent, the ones vLLM serves from its prefix cache are not prefilled again
+        self._profile('prompt_tokens', active_batch.batch['attention_mask'].sum().item())
+        gen_output = self.actor_rollout_wg.generate_sequences(active_batch)
+        self._profile('decode_tokens', (gen_output.batch['responses'] != self.tokenizer.pad_token_id).sum().item())
+        return gen_output
+
+    def _generate(self, active_batch: DataProto, group_size: int = 1) -> DataProto:
+        """
+        Generate the responses of the active rows. With `group_size` > 1 the rows are
+        `group_size` interleaved copies of each prompt (the n_agent trajectories before
+        their histories diverge): only one row per prompt is sent and vLLM samples its
+        `group_size` responses (SamplingParams.n), so each prompt is dispatched and
+        prefilled once. The output has a row per input row either way.
+        """
+        if group_size > 1:
+            active_batch = DataProto.from_dict({k: v[::group_size] for k, v in active_batch.batch.items()})
+            active_batch.meta_info['n'] = group_size
+        return self._generate_with_gpu_padding(active_batch)
+
+    def _group_size(self, step: int, active_mask: torch.Tensor) -> int:
+        """n_agent on the first turn, when the trajectories of a prompt still share their history."""
+        if step == 0 and self.config.n_agent > 1 and active_mask.all() and len(active_mask) % self.config.n_agent == 0:
+            return self.config.n_agent
+        return 1
+
+    def _pipelined_step(self, rollings_active: DataProto, active_mask: torch.Tensor,
+                        source_urls=None, data_source=None, group_size: int = 1) -> Tuple:
+        """
+        One turn of the loop with the active rows split into `pipeline_chunks` chunks.
+        The retrieval of each chunk runs in the background while the next chunk is
+        generated (double buffering), so the GPUs and the retriever are busy at the
+        same time. Returns the generation meta info, the padded responses and the
+        `execute_predictions` outputs of the full batch, identical to running the
+        whole active batch at once. Chunks keep the rows of a group together.
+        """
+        batch_size = active_mask.shape[0]
+        active_rows = torch.nonzero(active_mask).squeeze(-1)
+        num_groups = len(active_rows) // group_size
+        chunks = [(groups[:, None] * group_size + torch.arange(group_size)).reshape(-1)
+                  for groups in torch.tensor_split(torch.arange(num_groups), min(self.config.pipeline_chunks, num_groups))]
+
+        def select(values, rows):
+            if values is None or isinstance(values, str):
+                return values
+            return [values[row] for row in rows]
+
+        def search_chunk(chunk_str, rows):
+            with self._stage_timer('gen_search'):
+                return self.execute_predictions(
+                    chunk_str, self.tokenizer.pad_token, torch.ones(len(rows), dtype=torch.bool),
+                    source_urls=select(source_urls, rows), data_source=select(data_source, rows)
+                )
 
-        # Generate with padded batch
-        padded_output = self.actor_rollout_wg.generate_sequences(padded_active_batch)
+        active_ids = []
+        active_str = []
+        pending = []
+        for chunk in chunks:
+            chunk_batch = DataProto.from_dict({k: v[chunk] for k, v in rollings_active.batch.items()})
+            with self._stage_timer('gen_generate'):
+                gen_output = self._generate(chunk_batch, group_size)
+            meta_info = gen_output.meta_info
+            chunk_ids, chunk_str = self._postprocess_responses(gen_output.batch['responses'])
+            active_ids.append(chunk_ids)
+            active_str.extend(chunk_str)
+            rows = active_rows[chunk].tolist()
+            pending.append((rows, self.pipeline_executor.submit(search_chunk, chunk_str, rows)))
+
+        # inactive rows keep the outputs execute_predictions gives them
+        next_obs, dones, valid_action, is_search = [''] * batch_size, [1] * batch_size, [0] * batch_size, [0] * batch_size
+        step_scores = torch.zeros(batch_size, dtype=torch.float)
+        with self._stage_timer('gen_search_wait'):
+            for rows, future in pending:
+                outputs = future.result()
+                for j, row in enumerate(rows):
+                    next_obs[row], dones[row], valid_action[row], is_search[row] = (output[j] for output in outputs[:4])
+                    if source_urls is not None:
+                        step_scores[row] = outputs[4][j]
 
-        # Remove padding from output
-        trimmed_batch = {k: v[:-padding_size] for k, v in padded_output.batch.items()}
-        
-        # Handle meta_info if present
-        if hasattr(padded_output, 'meta_info') and padded_output.meta_info:
-            trimmed_meta = {}
-            for k, v in padded_output.meta_info.items():
-                if isinstance(v, torch.Tensor):
-                    trimmed_meta[k] = v[:-padding_size]
-                else:
-                    trimmed_meta[k] = v
-            padded_output.meta_info = trimmed_meta
-            
-        padded_output.batch = trimmed_batch
-        return padded_output
+        # tokenized (or padded) together, so padding matches generating the whole batch at once
+        if self.config.stop_at_action_tags:
+            width = max(ids.shape[1] for ids in active_ids)
+            responses_ids = torch.cat([pad_sequence_to_length(ids, width, self.tokenizer.pad_token_id) for ids in active_ids])
+        else:
+            responses_ids = self._batch_tokenize(active_str)
+        responses_ids, responses_str = self.tensor_fn._example_level_pad(responses_ids, active_str, active_mask)
+        step_outputs = (next_obs, dones, valid_action, is_search)
+        if source_urls is not None:
+            step_outputs += (step_scores,)
+        return meta_info, responses_ids, responses_str, step_outputs
 
     def run_llm_loop(self, gen_batch, initial_input_ids: torch.Tensor) -> Tuple[Dict, Dict]:
         """Run main LLM generation loop."""
         
         original_left_side = {'input_ids': initial_input_ids[:, -self.config.max_start_length:]}
-        original_right_side = {'responses': initial_input_ids[:, []], 'responses_with_info_mask': initial_input_ids[:, []]}
+        # responses beyond max_prompt_length are dropped, as are the oldest rolling tokens
+        right_buffer = TrajectoryBuffer(initial_input_ids[:, []], self.tokenizer.pad_token_id,
+                                        capacity=self.config.max_prompt_length,
+                                        max_length=self.config.max_prompt_length, track_info_mask=True)
+        rolling_buffer = TrajectoryBuffer(gen_batch.batch['input_ids'], self.tokenizer.pad_token_id,
+                                          capacity=self.config.max_prompt_length)
         
         active_mask = torch.ones(gen_batch.batch['input_ids'].shape[0], dtype=torch.bool)
         turns_stats = torch.ones(gen_batch.batch['input_ids'].shape[0], dtype=torch.int)
@@ -232,11 +340,13 @@ class LLMGenerationManager:
         valid_search_stats = torch.zeros(gen_batch.batch['input_ids'].shape[0], dtype=torch.int)
         active_num_list = [active_mask.sum().item()]
         rollings = gen_batch
+        self._reset_prefix_cache = True
 
         # Main generation loop
         for step in range(self.config.max_turns):
             if not active_mask.sum():
                 break
+            self._next_turn(step, active_mask)
             rollings.batch = self.tensor_fn.cut_to_effective_len(
                 rollings.batch,
                 keys=['input_ids', 'attention_mask', 'position_ids']
@@ -246,16 +356,6 @@ class LLMGenerationManager:
             rollings_active = DataProto.from_dict({
                 k: v[active_mask] for k, v in rollings.batch.items()
             })            
-            try:
-                gen_output = self._generate_with_gpu_padding(rollings_active)
-            except Exception as e:
-                print(f"Error generating with GPU padding: {e}")
-                print(rollings_active.batch['input_ids'].shape)
-                continue
-
-            meta_info = gen_output.meta_info            
-            responses_ids, responses_str = self._postprocess_responses(gen_output.batch['responses'])
-            responses_ids, responses_str = self.tensor_fn._example_level_pad(responses_ids, responses_str, active_mask)
 
             if 'source_urls' in rollings.meta_info:
                 source_urls = rollings.meta_info['source_urls']
@@ -266,15 +366,39 @@ class LLMGenerationManager:
             else:
                 data_source = None
 
-            # Execute in environment and process observations
+            group_size = self._group_size(step, active_mask)
+            if self.config.pipeline_chunks > 1:
+                try:
+                    meta_info, responses_ids, responses_str, step_outputs = self._pipelined_step(
+                        rollings_active, active_mask, source_urls=source_urls, data_source=data_source,
+                        group_size=group_size
+                    )
+                except Exception as e:
+                    print(f"Error generating with GPU padding: {e}")
+                    print(rollings_active.batch['input_ids'].shape)
+                    continue
+            else:
+                try:
+                    with self._stage_timer('gen_generate'):
+                        gen_output = self._generate(rollings_active, group_size)
+                except Exception as e:
+                    print(f"Error generating with GPU padding: {e}")
+                    print(rollings_active.batch['input_ids'].shape)
+                    continue
+
+                meta_info = gen_output.meta_info            
+                responses_ids, responses_str = self._postprocess_responses(gen_output.batch['responses'])
+                responses_ids, responses_str = self.tensor_fn._example_level_pad(responses_ids, responses_str, active_mask)
+
+                # Execute in environment and process observations
+                with self._stage_timer('gen_search'):
+                    step_outputs = self.execute_predictions(
+                        responses_str, self.tokenizer.pad_token, active_mask, source_urls=source_urls, data_source=data_source
+                    )
             if source_urls is not None:
-                next_obs, dones, valid_action, is_search, _step_reward = self.execute_predictions(
-                    responses_str, self.tokenizer.pad_token, active_mask, source_urls=source_urls, data_source=data_source
-                )
+                next_obs, dones, valid_action, is_search, _step_reward = step_outputs
             else:
-                next_obs, dones, valid_action, is_search = self.execute_predictions(
-                    responses_str, self.tokenizer.pad_token, active_mask, data_source=data_source
-                )
+                next_obs, dones, valid_action, is_search = step_outputs
             
             curr_active_mask = torch.tensor([not done for done in dones], dtype=torch.bool)
 
@@ -298,19 +422,22 @@ class LLMGenerationManager:
             next_obs_ids = self._process_next_obs(next_obs)
             
             # Update states
-            rollings = self._update_rolling_state(
-                rollings,
-                responses_ids,
-                next_obs_ids
-            )
-            original_right_side = self._update_right_side(
-                original_right_side,
-                responses_ids,
-                next_obs_ids
-            )
+            with self._stage_timer('gen_update_state'):
+                rollings = self._update_rolling_state(
+                    rollings,
+                    rolling_buffer,
+                    responses_ids,
+                    next_obs_ids
+                )
+                self._update_right_side(
+                    right_buffer,
+                    responses_ids,
+                    next_obs_ids
+                )
             
         # final LLM rollout
         if active_mask.sum():
+            self._next_turn(self.config.max_turns, active_mask)
             rollings.batch = self.tensor_fn.cut_to_effective_len(
                 rollings.batch,
                 keys=['input_ids', 'attention_mask', 'position_ids']
@@ -321,7 +448,8 @@ class LLMGenerationManager:
                 k: v[active_mask] for k, v in rollings.batch.items()
             })            
             try:
-                gen_output = self._generate_with_gpu_padding(rollings_active)
+                with self._stage_timer('gen_generate'):
+                    gen_output = self._generate_with_gpu_padding(rollings_active)
                 meta_info = gen_output.meta_info            
                 responses_ids, responses_str = self._postprocess_responses(gen_output.batch['responses'])
                 responses_ids, responses_str = self.tensor_fn._example_level_pad(responses_ids, responses_str, active_mask)
@@ -338,13 +466,16 @@ class LLMGenerationManager:
                 valid_search_stats += torch.tensor(is_search, dtype=torch.int)
                 
 
-                original_right_side = self._update_right_side(
-                    original_right_side,
+                self._update_right_side(
+                    right_buffer,
                     responses_ids,
                 )
             except Exception as e:
                 print(f"Error generating with GPU padding: {e}")
                 print(rollings_active.batch['input_ids'].shape)
+
+        if self.config.reuse_prefix_cache:
+            self.actor_rollout_wg.free_rollout_cache()
         
         meta_info['turns_stats'] = turns_stats.tolist()
         meta_info['active_mask'] = active_mask.tolist()
@@ -354,6 +485,10 @@ class LLMGenerationManager:
         meta_info['length_penalty'] = length_penalty
         print("ACTIVE_TRAJ_NUM:", active_num_list)
         
+        original_right_side = {
+            'responses': right_buffer.right_padded(),
+            'responses_with_info_mask': right_buffer.right_padded(info_mask=True)
+        }
         return self._compose_final_output(original_left_side, original_right_side, meta_info)
 
     def _compose_final_output(self, left_side: Dict,
@@ -406,15 +541,26 @@ class LLMGenerationManager:
         next_obs, dones, valid_action, is_search = [], [], [], []
         step_scores = torch.zeros(len(cur_actions), dtype=torch.float)
         
-        search_queries = [content for action, content in zip(cur_actions, contents) if action == 'search']
+        # align the per-example data source and source urls with the search queries
+        search_rows = [i for i, action in enumerate(cur_actions) if action == 'search']
+        search_queries = [contents[i] for i in search_rows]
+        if data_source is None or isinstance(data_source, str):
+            data_source = [data_source] * len(cur_actions)
+        data_source = [data_source[i] for i in search_rows]
+        if source_urls is not None:
+            source_urls = [source_urls[i] for i in search_rows]
+        step_reward = [0] * len(search_rows)
         if do_search:
             if source_urls is not None:
                 search_results, step_reward = self.batch_search(search_queries, source_urls, data_source=data_source)
             else:
                 search_results = self.batch_search(search_queries, data_source=data_source)
-            assert len(search_results) == sum([1 for action in cur_actions if action == 'search'])
+            assert len(search_results) == len(search_rows)
         else:
-            search_results = [''] * sum([1 for action in cur_actions if action == 'search'])
+            search_results = [''] * len(search_rows)
+        # scatter the results back to their rows
+        search_results = dict(zip(search_rows, search_results))
+        step_reward = dict(zip(search_rows, step_reward))
 
         for i, (action, active) in enumerate(zip(cur_actions, active_mask)):
             
@@ -430,21 +576,23 @@ class LLMGenerationManager:
                     valid_action.append(1)
                     is_search.append(0)
                 elif action == 'search':
-                    next_obs.append(f'\n\n<evidence>{search_results.pop(0).strip()}</evidence>\n\n')
+                    result = search_results[i]
+                    if isinstance(result, str):
+                        next_obs.append(f'\n\n<evidence>{result.strip()}</evidence>\n\n')
+                    else:
+                        # the segments carry the evidence tags, see _passages2segments
+                        next_obs.append(result)
                     dones.append(0)
                     valid_action.append(1)
                     is_search.append(1)
                     if source_urls is not None:
-                        step_scores[i] = step_reward.pop(0)
+                        step_scores[i] = step_reward[i]
                 else:
-                    next_obs.append(f'\nMy previous action is invalid. \
-If I want to search, I should put the query between <search> and </search>. \
-If I want to give the final answer, I should put the answer between <answer> and </answer>. Let me try again.\n')
+                    next_obs.append(INVALID_ACTION_OBS)
                     dones.append(0)
                     valid_action.append(0)
                     is_search.append(0)
             
-        assert len(search_results) == 0
         if source_urls is not None:
             return next_obs, dones, valid_action, is_search, step_scores
         else:
@@ -465,8 +613,7 @@ If I want to give the final answer, I should put the answer between <answer> and
                 
         for prediction in predictions:
             if isinstance(prediction, str): # for llm output
-                pattern = r'<(search|answer)>(.*?)</\1>'
-                match = re.search(pattern, prediction, re.DOTALL)
+                match = ACTION_PATTERN.search(prediction)
                 if match:
                     content = match.group(2).strip()  # Return only the content inside the tags
                     action = match.group(1)
@@ -489,49 +636,98 @@ If I want to give the final answer, I should put the answer between <answer> and
         Returns:
             search results which is concatenated into a string
         """
-        results = self._batch_search(queries, data_source)['result']
+        results = self._batch_search(queries, data_source)
 
         if source_urls is not None:
             step_scores = [0 for _ in range(len(results))]
-            for idx, result in enumerate(results):
+            for idx, result in enumerate(results if self.config.source_url_reward else []):
                 src_urls = source_urls[idx]
                 retrieved_urls = []
                 for item in result:
-                    if 'url' in item:
-                        retrieved_urls.append(item['url'])
+                    # hits are {'document': ..., 'score': ...}, with ids_only the document keeps just its url
+                    url = item['document'].get('url')
+                    if url is not None:
+                        retrieved_urls.append(url)
                 if len(src_urls) > 0:
                     step_scores[idx] = (len(set(src_urls) & set(retrieved_urls))/len(src_urls)) / 5
                 else:
                     step_scores[idx] = 0
 
-            return [self._passages2string(result) for result in results], step_scores
+            return [self._format_passages(result) for result in results], step_scores
         else:
-            return [self._passages2string(result) for result in results]
+            return [self._format_passages(result) for result in results]
 
     def _batch_search(self, queries, data_source: List[str] = None):
+        if len(queries) == 0:
+            return []
         if data_source is None:
-            assert len(queries) == len(data_source)
-        payload = {
-            "queries": queries,
-            "topk": self.config.topk,
-            "return_scores": True
-        }
-        if data_source[0] == "self":
-            rtn =  requests.post(self.config.search_url, json=payload)
-            try:
-                return rtn.json()
-            except:
-                print(payload)
-                print(f"Error in self: {rtn.text}")
-                return []
-        else:
-            rtn = requests.post(self.config.wiki_url, json=payload)
-            try:
-                return rtn.json()
-            except:
-                print(payload)
-                print(f"Error in batch_search: {rtn.text}")
-                return []
+            data_source = [None] * len(queries)
+        assert len(queries) == len(data_source)
+        # "self" examples search the local corpus, the others wikipedia
+        urls = [self.config.search_url if source == "self" else self.config.wiki_url for source in data_source]
+        payload = dict(topk=self.config.topk, return_scores=True)
+        if self.config.tokenized_evidence:
+            # servers with a token store of this tokenizer send the passage ids instead of the
+            # passages, the url is kept for the step reward
+            payload.update(tokenizer=self.tokenizer.name_or_path, ids_only=True, fields=['url'])
+        timing = {}
+        with self._stage_timer('gen_retrieve'):
+            if self.retrieval_actor is None:
+                results = self.search_client.retrieve(queries, urls, timing=timing, **payload)
+            else:
+                results = self._retrieve_in_cluster(queries, urls, timing, payload)
+        for name, value in timing.items():
+            self._profile(name, value)
+        return results
+
+    def _retrieve_in_cluster(self, queries: List[str], urls: List[str], timing: Dict, payload: Dict) -> List:
+        """Queries of search_url go to the retrieval actor, the others (wiki_url) to their server concurrently."""
+        local = [i for i, url in enumerate(urls) if url == self.config.search_url]
+        remote = [i for i, url in enumerate(urls) if url != self.config.search_url]
+        future = self.retrieval_actor.retrieve.remote([queries[i] for i in local], self.config.topk)
+
+        results = [[] for _ in queries]
+        if remote:
+            remote_results = self.search_client.retrieve([queries[i] for i in remote], [urls[i] for i in remote],
+                                                         timing=timing, **payload)
+            for i, result in zip(remote, remote_results):
+                results[i] = result
+        try:
+            local_results = ray.get(future)
+        except Exception as e:
+            # keep the rollout going, the affected queries get an empty evidence block
+            print(f"[RetrievalActor] Retrieval of {len(local)} queries failed: {e}")
+            local_results = [[] for _ in local]
+        for i, result in zip(local, local_results):
+            results[i] = result
+        return results
+
+    def _format_passages(self, retrieval_result):
+        if self.config.tokenized_evidence:
+            return self._passages2segments(retrieval_result)
+        return self._passages2string(retrieval_result)
+
+    def _passages2segments(self, retrieval_result) -> List:
+        """
+        The observation of _passages2string, evidence tags included, split around the passages
+        so that each passage is tokenized (and cached) on its own. Passages the server sent token
+        ids for are not tokenized at all. The text between two passages is one segment, so it is
+        tokenized as in the whole observation, but merges across the end of a passage (e.g. `.`
+        with the following `\n` or `</`) are lost: with tokenized_evidence the observation ids
+        can differ from the tokenization of the observation text there.
+        """
+        prefix = '\n\n<evidence>'
+        segments = []
+        for idx, doc_item in enumerate(retrieval_result):
+            # the space stays with the passage, as the tokenizer merges it into the first word
+            segments.append(f"{prefix}Doc {idx+1}")
+            token_ids = doc_item['document'].get('token_ids')
+            segments.append(token_ids if token_ids is not None else f" {doc_item['document']['contents']}")
+            prefix = '\n'
+        if not segments:
+            return [f'{prefix}</evidence>\n\n']
+        segments.append('</evidence>\n\n')
+        return segments
 
     def _passages2string(self, retrieval_result):
         format_reference = ''
@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict
+
+
+class RolloutProfiler:
+    """
+    Per-turn instrumentation of the agent loop of one training step.
+    Stage durations and counters (tokens, active rows, truncated observations)
+    are accumulated per turn and reported as `rollout/...` metrics, and every
+    stage is kept as a span of a Chrome trace (chrome://tracing, Perfetto) that
+    can be dumped as a timeline of the step.
+    """
+    def __init__(self):
+        self.turn = 0
+        self.values = defaultdict(float)
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def next_turn(self, turn: int):
+        self.turn = turn
+
+    def add(self, name: str, value: float):
+        """Add `value` to the counter `name` of the current turn."""
+        self.values[(self.turn, name)] += value
+
+    @contextmanager
+    def span(self, name: str):
+        """Time a stage, its duration is added to `{name}_s` of the current turn."""
+        turn = self.turn
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.values[(turn, f'{name}_s')] += end - start
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'args': {'turn': turn},
+            })
+
+    def metrics(self) -> Dict[str, float]:
+        """Totals over the step as `rollout/{name}` and per-turn values as `rollout/turn_{turn}/{name}`."""
+        metrics = defaultdict(float)
+        for (turn, name), value in sorted(self.values.items()):
+            metrics[f'rollout/{name}'] += value
+            metrics[f'rollout/turn_{turn}/{name}'] = value
+        return dict(metrics)
+
+    def dump_trace(self, path: str):
+        """Write the spans as a Chrome trace event file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
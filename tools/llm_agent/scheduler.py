@@ -0,0 +1,265 @@
+import torch
+import numpy as np
+from collections import deque, OrderedDict
+from typing import List, Tuple
+from verl import DataProto
+from verl.utils.torch_functional import pad_sequence_to_length
+from .generation import LLMGenerationManager
+from .tensor_helper import TrajectoryBuffer
+
+
+class ContinuousRolloutScheduler:
+    """
+    Continuous-batching version of `LLMGenerationManager.run_llm_loop`.
+    Rollout runs over a pool of `num_slots` trajectory slots. When a trajectory
+    finishes (answers, or runs out of turns) its slot is refilled with the next
+    submitted prompt, so every turn generates for a full batch instead of the
+    shrinking set of trajectories still searching. Finished trajectories are
+    collected per group of `group_size` samples of the same prompt and whole
+    groups are emitted, so GRPO still sees all samples of a prompt together.
+    Trajectories in flight when a batch is emitted carry over to the next one.
+    Every trajectory records the policy version (`next_batch` call) it started
+    under, and the ones started more than `max_staleness` versions ago are
+    restarted instead of being trained on.
+    """
+    def __init__(self, manager: LLMGenerationManager, num_slots: int, group_size: int = 1, max_staleness: int = 1):
+        self.manager = manager
+        self.config = manager.config
+        self.tensor_fn = manager.tensor_fn
+        self.pad_token_id = manager.tokenizer.pad_token_id
+        self.num_slots = num_slots
+        self.group_size = group_size
+        self.max_staleness = max_staleness
+        # policy version, the number of batches emitted so far
+        self.version = 0
+        # staleness of the last emitted batch, as rollout/... metrics
+        self.stats = {}
+
+        # prompts waiting for a slot: (row, batch, gen_batch, group)
+        self.pending = deque()
+        self.num_groups = 0
+        # finished trajectories by group, in order of the group's first completion
+        self.completed = OrderedDict()
+
+        empty = torch.full((num_slots, 0), self.pad_token_id, dtype=torch.long)
+        self.rolling_buffer = TrajectoryBuffer(empty, self.pad_token_id, capacity=self.config.max_prompt_length)
+        self.right_buffer = TrajectoryBuffer(empty, self.pad_token_id, capacity=self.config.max_prompt_length,
+                                             max_length=self.config.max_prompt_length, track_info_mask=True)
+        self.slots = [None] * num_slots
+        # turns run for the current batch, the profiler reports per scheduler turn
+        self.num_steps = 0
+        self.active_mask = torch.zeros(num_slots, dtype=torch.bool)
+        self.turns = torch.zeros(num_slots, dtype=torch.int)
+        self.turns_stats = torch.ones(num_slots, dtype=torch.int)
+        self.length_penalty = torch.ones(num_slots, dtype=torch.float)
+        self.step_rewards = torch.zeros(num_slots, dtype=torch.float)
+        self.valid_action_stats = torch.zeros(num_slots, dtype=torch.int)
+        self.valid_search_stats = torch.zeros(num_slots, dtype=torch.int)
+
+    def submit(self, batch: DataProto, gen_batch: DataProto):
+        """
+        Queue the prompts of `gen_batch` (with the remaining keys of the same rows in `batch`).
+        Rows are expected to be repeated interleaved, `group_size` consecutive rows per prompt.
+        """
+        for i in range(len(gen_batch)):
+            self.pending.append((i, batch, gen_batch, self.num_groups + i // self.group_size))
+        self.num_groups += -(-len(gen_batch) // self.group_size)
+
+    def _fill_slots(self):
+        free = [slot for slot, state in enumerate(self.slots) if state is None][:len(self.pending)]
+        if not free:
+            return
+        rows = torch.tensor(free, dtype=torch.long)
+        prompts = []
+        for slot in free:
+            request = self.pending.popleft()
+            i, batch, gen_batch, group = request
+            input_ids = gen_batch.batch['input_ids'][i].long()
+            source_urls = gen_batch.meta_info.get('source_urls', [])
+            data_source = gen_batch.meta_info.get('data_source')
+            self.slots[slot] = {
+                'request': request,
+                'group': group,
+                'version': self.version,
+                'prompt': input_ids[-self.config.max_start_length:],
+                'source_urls': source_urls[i] if len(source_urls) else [],
+                'data_source': data_source if data_source is None or isinstance(data_source, str) else data_source[i],
+            }
+            prompts.append(input_ids)
+
+        # the buffers drop pad tokens, so the prompts only need a common width
+        width = max(len(ids) for ids in prompts)
+        segment = torch.full((self.num_slots, width), self.pad_token_id, dtype=torch.long)
+        segment[rows] = torch.stack([pad_sequence_to_length(ids[None], width, self.pad_token_id, left_pad=True)[0]
+                                     for ids in prompts])
+        self.rolling_buffer.clear_rows(rows)
+        self.right_buffer.clear_rows(rows)
+        self.rolling_buffer.append(segment)
+
+        self.active_mask[rows] = True
+        self.turns[rows] = 0
+        self.turns_stats[rows] = 1
+        self.length_penalty[rows] = 1.
+        self.step_rewards[rows] = 0.
+        self.valid_action_stats[rows] = 0
+        self.valid_search_stats[rows] = 0
+
+    def _step(self):
+        """One turn for all occupied slots, trajectories out of turns get their final answer turn."""
+        active_mask = self.active_mask.clone()
+        self.manager._next_turn(self.num_steps, active_mask)
+        self.num_steps += 1
+        input_ids, position_ids = self.rolling_buffer.left_padded(self.config.max_prompt_length)
+        rollings = self.tensor_fn.cut_to_effective_len({
+            'input_ids': input_ids[active_mask],
+            'position_ids': position_ids[active_mask],
+            'attention_mask': self.tensor_fn.create_attention_mask(input_ids[active_mask]),
+        }, keys=['input_ids', 'attention_mask', 'position_ids'])
+        try:
+            with self.manager._stage_timer('gen_generate'):
+                gen_output = self.manager._generate_with_gpu_padding(DataProto.from_dict(rollings))
+        except Exception as e:
+            print(f"Error generating with GPU padding: {e}")
+            print(rollings['input_ids'].shape)
+            # the turn is lost, as in run_llm_loop, and trajectories past their final turn end as they are
+            self.turns[active_mask] += 1
+            for slot in torch.nonzero(active_mask & (self.turns > self.config.max_turns)).squeeze(-1).tolist():
+                self._retire(slot, still_active=True)
+            return
+        responses_ids, responses_str = self.manager._postprocess_responses(gen_output.batch['responses'])
+        responses_ids, responses_str = self.tensor_fn._example_level_pad(responses_ids, responses_str, active_mask)
+
+        final_mask = active_mask & (self.turns >= self.config.max_turns)
+        search_mask = active_mask & ~final_mask
+        source_urls = [state['source_urls'] if state else [] for state in self.slots]
+        data_source = [state['data_source'] if state else None for state in self.slots]
+        with self.manager._stage_timer('gen_search'):
+            next_obs, dones, valid_action, is_search, step_scores = self.manager.execute_predictions(
+                responses_str, self.manager.tokenizer.pad_token, search_mask, source_urls=source_urls, data_source=data_source
+            )
+        curr_active_mask = search_mask & ~torch.tensor(dones, dtype=torch.bool)
+        # rows without their own call stay zero in the outputs of the other
+        valid_action = torch.tensor(valid_action, dtype=torch.int)
+        is_search = torch.tensor(is_search, dtype=torch.int)
+        final_active_mask = torch.zeros_like(final_mask)
+        if final_mask.any():
+            _, final_dones, final_valid_action, final_is_search = self.manager.execute_predictions(
+                responses_str, self.manager.tokenizer.pad_token, final_mask, do_search=False
+            )
+            final_active_mask = final_mask & ~torch.tensor(final_dones, dtype=torch.bool)
+            valid_action += torch.tensor(final_valid_action, dtype=torch.int)
+            is_search += torch.tensor(final_is_search, dtype=torch.int)
+
+        self.step_rewards = torch.maximum(self.step_rewards, step_scores)
+        self.length_penalty = torch.where(curr_active_mask & (self.turns > 1),
+                                          0.95 ** self.turns.float(), self.length_penalty)
+        self.turns_stats[curr_active_mask] += 1
+        self.valid_action_stats += valid_action
+        self.valid_search_stats += is_search
+
+        next_obs_ids = self.manager._process_next_obs(next_obs)
+        with self.manager._stage_timer('gen_update_state'):
+            self.rolling_buffer.append(responses_ids)
+            self.rolling_buffer.append(next_obs_ids)
+            self.rolling_buffer.truncate_left(self.config.max_prompt_length)
+            self.manager._update_right_side(self.right_buffer, responses_ids, next_obs_ids)
+        self.turns[active_mask] += 1
+
+        for slot in torch.nonzero(active_mask & ~curr_active_mask).squeeze(-1).tolist():
+            self._retire(slot, still_active=bool(final_active_mask[slot]))
+
+    def _retire(self, slot: int, still_active: bool):
+        state = self.slots[slot]
+        self.completed.setdefault(state['group'], []).append({
+            'request': state['request'],
+            'version': state['version'],
+            'prompt': state['prompt'],
+            'responses': self.right_buffer.row(slot),
+            'responses_with_info_mask': self.right_buffer.row(slot, info_mask=True),
+            'turns_stats': int(self.turns_stats[slot]),
+            'active_mask': still_active,
+            'valid_action_stats': int(self.valid_action_stats[slot]),
+            'valid_search_stats': int(self.valid_search_stats[slot]),
+            'step_rewards': float(self.step_rewards[slot]),
+            'length_penalty': float(self.length_penalty[slot]),
+        })
+        self.slots[slot] = None
+        self.active_mask[slot] = False
+
+    def _restart_stale(self) -> int:
+        """Requeue the trajectories, in flight or waiting for their group, started more than `max_staleness` versions ago."""
+        min_version = self.version - self.max_staleness
+        requests = []
+        for slot, state in enumerate(self.slots):
+            if state is not None and state['version'] < min_version:
+                requests.append(state['request'])
+                self.slots[slot] = None
+                self.active_mask[slot] = False
+        for group in list(self.completed):
+            trajectories = self.completed[group]
+            requests.extend(t['request'] for t in trajectories if t['version'] < min_version)
+            trajectories[:] = [t for t in trajectories if t['version'] >= min_version]
+            if not trajectories:
+                del self.completed[group]
+        # restarted prompts go first, they have waited the longest
+        self.pending.extendleft(reversed(requests))
+        return len(requests)
+
+    def _ready_groups(self, num_rows: int) -> List[int]:
+        groups, size = [], 0
+        for group, trajectories in self.completed.items():
+            if size >= num_rows:
+                break
+            if len(trajectories) == self.group_size:
+                groups.append(group)
+                size += len(trajectories)
+        return groups if size >= num_rows else None
+
+    def next_batch(self, num_rows: int) -> Tuple[DataProto, DataProto]:
+        """
+        Run turns until `num_rows` trajectories of whole groups are finished and return
+        them as the rows of the submitted `batch` and the matching output of `run_llm_loop`.
+        """
+        self.manager._reset_prefix_cache = True
+        self.num_steps = 0
+        active_num_list = []
+        num_restarted = self._restart_stale()
+        groups = self._ready_groups(num_rows)
+        while groups is None:
+            self._fill_slots()
+            if not self.active_mask.any():
+                raise RuntimeError(f"Not enough submitted prompts for {num_rows} trajectories")
+            active_num_list.append(self.active_mask.sum().item())
+            self._step()
+            groups = self._ready_groups(num_rows)
+        if self.config.reuse_prefix_cache:
+            self.manager.actor_rollout_wg.free_rollout_cache()
+        print("ACTIVE_TRAJ_NUM:", active_num_list)
+
+        trajectories = [trajectory for group in groups for trajectory in self.completed.pop(group)]
+        batch = DataProto.concat([row_batch[i:i + 1] for i, row_batch, _, _ in (t['request'] for t in trajectories)])
+        # group ids are unique over the run, unlike the dataset index once prompts carry over an epoch boundary
+        batch.non_tensor_batch['uid'] = np.array([str(t['request'][3]) for t in trajectories], dtype=object)
+        staleness = [self.version - t['version'] for t in trajectories]
+        self.stats = {
+            'rollout/stale_fraction': float(np.mean([lag > 0 for lag in staleness])),
+            'rollout/mean_staleness': float(np.mean(staleness)),
+            'rollout/restarted_stale': num_restarted,
+        }
+        self.version += 1
+
+        def stack(key, left_pad=False):
+            width = max(len(t[key]) for t in trajectories)
+            return torch.stack([pad_sequence_to_length(t[key][None], width, self.pad_token_id, left_pad=left_pad)[0]
+                                for t in trajectories])
+
+        meta_info = {key: [t[key] for t in trajectories]
+                     for key in ['turns_stats', 'active_mask', 'valid_action_stats', 'valid_search_stats']}
+        meta_info['step_rewards'] = torch.tensor([t['step_rewards'] for t in trajectories], dtype=torch.float)
+        meta_info['length_penalty'] = torch.tensor([t['length_penalty'] for t in trajectories], dtype=torch.float)
+        gen_output = self.manager._compose_final_output(
+            {'input_ids': stack('prompt', left_pad=True)},
+            {'responses': stack('responses'), 'responses_with_info_mask': stack('responses_with_info_mask')},
+            meta_info,
+        )
+        return batch, gen_output
@@ -0,0 +1,103 @@
+import time
+import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+@dataclass
+class SearchClientConfig:
+    timeout: float = 60.0
+    retries: int = 3
+    backoff_factor: float = 0.5
+    pool_size: int = 8
+    # ask for msgpack responses, servers without msgpack answer with JSON
+    binary: bool = True
+
+class SearchClient:
+    """
+    Keep-alive HTTP client for the /retrieve endpoints of the retrieval servers.
+    Connections are pooled across turns, failed requests are retried with
+    exponential backoff, and the sub-batches of different servers are sent concurrently.
+    The response format is negotiated per request: msgpack if both sides have it, JSON otherwise.
+    """
+    def __init__(self, config: SearchClientConfig):
+        self.config = config
+        retry = Retry(
+            total=config.retries,
+            backoff_factor=config.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=config.pool_size, pool_maxsize=config.pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=config.pool_size)
+        if config.binary and msgpack is not None:
+            self.session.headers["Accept"] = f"{MSGPACK_MEDIA_TYPE}, application/json"
+
+    def _post(self, url: str, payload: Dict[str, Any]) -> Dict:
+        start = time.perf_counter()
+        response = self.session.post(url, json=payload, timeout=self.config.timeout)
+        response.raise_for_status()
+        if response.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE):
+            output = msgpack.unpackb(response.content, raw=False)
+            self._unpack_token_ids(output['result'])
+        else:
+            output = response.json()
+        output['round_trip_s'] = time.perf_counter() - start
+        return output
+
+    @staticmethod
+    def _unpack_token_ids(results: List):
+        # binary responses carry the token ids as int32 bytes
+        for hits in results:
+            for hit in hits:
+                doc = hit.get('document', hit)
+                if isinstance(doc.get('token_ids'), bytes):
+                    doc['token_ids'] = np.frombuffer(doc['token_ids'], dtype='<i4').tolist()
+
+    def retrieve(self, queries: List[str], urls: List[str], timing: Dict[str, float] = None, **payload) -> List[List[Dict]]:
+        """
+        Retrieve the results of each query from its own server.
+        Queries are grouped by url, the groups are posted concurrently and the
+        results are merged back in query order. With `timing` given, the round trip
+        and the server-side queue and search times of the slowest group are set in it.
+        """
+        groups = {}
+        for i, url in enumerate(urls):
+            groups.setdefault(url, []).append(i)
+
+        futures = {
+            url: self.executor.submit(self._post, url, {**payload, "queries": [queries[i] for i in idxs]})
+            for url, idxs in groups.items()
+        }
+
+        results = [[] for _ in queries]
+        for url, idxs in groups.items():
+            try:
+                output = futures[url].result()
+            except Exception as e:
+                # keep the rollout going, the affected queries get an empty evidence block
+                print(f"[SearchClient] Retrieval of {len(idxs)} queries from {url} failed: {e}")
+                continue
+            group_results = output['result']
+            if timing is not None and output['round_trip_s'] > timing.get('retrieve_round_trip_s', 0.0):
+                server_timing = output.get('timing', {})
+                timing['retrieve_round_trip_s'] = output['round_trip_s']
+                timing['retrieve_server_queue_s'] = server_timing.get('queue_s', 0.0)
+                timing['retrieve_server_search_s'] = server_timing.get('search_s', 0.0)
+            for i, result in zip(idxs, group_results):
+                results[i] = result
+        return results
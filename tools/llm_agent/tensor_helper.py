@@ -72,4 +72,100 @@ class TensorHelper:
                 padded_responses_str[i] = responses_str[s]
                 s += 1
                 
-        return padded_responses, padded_responses_str
\ No newline at end of file
+        return padded_responses, padded_responses_str
+
+
+class TrajectoryBuffer:
+    """
+    Token history of each row, appended in place and read as padded views.
+    Pad tokens of appended segments are dropped and the rest is written after the
+    row's current length, so a turn costs O(batch * segment) instead of re-sorting
+    the whole [batch, seq] history. Storage is preallocated and grows by doubling.
+    """
+    def __init__(self, input_ids: torch.Tensor, pad_token_id: int, capacity: int,
+                 max_length: int = None, track_info_mask: bool = False):
+        self.pad_token_id = pad_token_id
+        # tokens past max_length are dropped, None keeps the full history
+        self.max_length = max_length
+        batch_size = input_ids.shape[0]
+        self.tokens = torch.full((batch_size, capacity), pad_token_id, dtype=input_ids.dtype, device=input_ids.device)
+        # same tokens with the information blocks replaced by pad tokens
+        self.info_masked_tokens = self.tokens.clone() if track_info_mask else None
+        self.lengths = torch.zeros(batch_size, dtype=torch.long, device=input_ids.device)
+        self.append(input_ids)
+
+    def _reserve(self, length: int):
+        capacity = self.tokens.shape[1]
+        if length <= capacity:
+            return
+        new_capacity = max(length, 2 * capacity)
+        grow = lambda t: torch.cat([t, torch.full((t.shape[0], new_capacity - capacity), self.pad_token_id,
+                                                  dtype=t.dtype, device=t.device)], dim=1)
+        self.tokens = grow(self.tokens)
+        if self.info_masked_tokens is not None:
+            self.info_masked_tokens = grow(self.info_masked_tokens)
+
+    def append(self, segment: torch.Tensor, is_info: bool = False):
+        """Append the non-pad tokens of each row of `segment`, `is_info` marks an information (observation) block."""
+        mask = segment != self.pad_token_id
+        positions = self.lengths[:, None] + torch.cumsum(mask, dim=1) - 1
+        if self.max_length is not None:
+            mask &= positions < self.max_length
+        new_lengths = self.lengths + mask.sum(dim=1)
+        if new_lengths.numel() > 0:
+            self._reserve(int(new_lengths.max()))
+
+        rows = torch.nonzero(mask, as_tuple=True)[0]
+        cols = positions[mask]
+        values = segment[mask].to(self.tokens.dtype)
+        self.tokens[rows, cols] = values
+        if self.info_masked_tokens is not None:
+            self.info_masked_tokens[rows, cols] = self.pad_token_id if is_info else values
+        self.lengths = new_lengths
+
+    def clear_rows(self, rows: torch.Tensor):
+        """Empty the given rows, e.g. to start a new trajectory in a freed slot."""
+        self.lengths[rows] = 0
+        self.tokens[rows] = self.pad_token_id
+        if self.info_masked_tokens is not None:
+            self.info_masked_tokens[rows] = self.pad_token_id
+
+    def row(self, i: int, info_mask: bool = False) -> torch.Tensor:
+        """Tokens of row `i`, without padding."""
+        tokens = self.info_masked_tokens if info_mask else self.tokens
+        return tokens[i, :int(self.lengths[i])].clone()
+
+    def _width(self, max_length: int = None) -> int:
+        width = int(self.lengths.max()) if self.lengths.numel() > 0 else 0
+        return width if max_length is None else min(width, max_length)
+
+    def left_padded(self, max_length: int = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Left-padded view of the last `max_length` tokens of each row, as wide as the
+        longest row, and its position ids (positions count from the start of the buffer).
+        """
+        width = self._width(max_length)
+        idx = self.lengths[:, None] - width + torch.arange(width, device=self.lengths.device)[None, :]
+        padding = idx < 0
+        view = self.tokens.gather(1, idx.clamp(min=0)).masked_fill_(padding, self.pad_token_id)
+        position_ids = idx.masked_fill_(padding, 0)
+        return view, position_ids
+
+    def truncate_left(self, max_length: int):
+        """Drop the oldest tokens of the rows longer than `max_length`."""
+        shift = (self.lengths - max_length).clamp(min=0)
+        if not shift.any():
+            return
+        capacity = self.tokens.shape[1]
+        idx = torch.arange(capacity, device=self.lengths.device)[None, :] + shift[:, None]
+        self.lengths = self.lengths - shift
+        padding = torch.arange(capacity, device=self.lengths.device)[None, :] >= self.lengths[:, None]
+        shifted = lambda t: t.gather(1, idx.clamp(max=capacity - 1)).masked_fill_(padding, self.pad_token_id)
+        self.tokens = shifted(self.tokens)
+        if self.info_masked_tokens is not None:
+            self.info_masked_tokens = shifted(self.info_masked_tokens)
+
+    def right_padded(self, info_mask: bool = False) -> torch.Tensor:
+        """Right-padded view of each row, as wide as the longest row."""
+        tokens = self.info_masked_tokens if info_mask else self.tokens
+        return tokens[:, :self._width()]
@@ -12,6 +12,17 @@ CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 python index_builder.py \
     --use_fp16 \
     --max_length 256 \
     --batch_size 512 \
+    --length_bucketing \
     --pooling_method mean \
     --faiss_type Flat \
     --save_embedding
+
+# Compressed indexes can be served from cpu, e.g. IVF-PQ with a recall@k check against exact search:
+#   --faiss_type IVF65536,PQ64 --train_size 1000000 --nprobe 64 \
+#   --benchmark_recall --benchmark_nprobe 16 32 64 128
+
+# Sharded encoding without DataParallel: one process per gpu by default, or cpu processes with
+#   --device cpu --num_workers 16
+# Across nodes sharing $save_dir, encode one shard per node, then build the index once all are done:
+#   --num_shards 4 --shard_id $NODE_RANK         (on every node)
+#   --num_shards 4 [--index_shards]              (on one node, --index_shards keeps one index file per shard)
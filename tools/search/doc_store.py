@@ -0,0 +1,168 @@
+"""
+Columnar, memory-mapped document store for the retrieval corpus.
+
+Every field of the corpus jsonl is stored as one contiguous UTF-8 blob
+(`{field}.bin`) plus an int64 offsets array (`{field}.offsets.npy`), so that
+documents can be fetched by row id without keeping the parsed corpus in memory.
+The store is built once from the jsonl and opened with mmap afterwards.
+"""
+import os
+import json
+import mmap
+import argparse
+from array import array
+from typing import List, Dict
+
+import numpy as np
+from tqdm import tqdm
+
+
+META_FILE = "meta.json"
+
+
+def _corpus_fingerprint(corpus_path: str) -> Dict:
+    stat = os.stat(corpus_path)
+    return {"path": os.path.abspath(corpus_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def build_doc_store(corpus_path: str, store_dir: str):
+    r"""Convert a corpus jsonl into a columnar doc store under `store_dir`.
+
+    The schema is taken from the first document: string fields are stored as raw
+    UTF-8, any other field is stored json-encoded.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    fields = {}
+    blob_files = {}
+    offsets = {}
+    positions = {}
+    num_docs = 0
+
+    with open(corpus_path, "r") as f:
+        for line in tqdm(f, desc="Building doc store"):
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if num_docs == 0:
+                for key, value in doc.items():
+                    fields[key] = "str" if isinstance(value, str) else "json"
+                    blob_files[key] = open(os.path.join(store_dir, f"{key}.bin"), "wb")
+                    offsets[key] = array("q", [0])
+                    positions[key] = 0
+
+            for key, field_type in fields.items():
+                value = doc.get(key)
+                if field_type == "str":
+                    data = (value if isinstance(value, str) else "").encode("utf-8")
+                else:
+                    data = json.dumps(value).encode("utf-8")
+                blob_files[key].write(data)
+                positions[key] += len(data)
+                offsets[key].append(positions[key])
+            num_docs += 1
+
+    for key in fields:
+        blob_files[key].close()
+        np.save(os.path.join(store_dir, f"{key}.offsets.npy"), np.frombuffer(offsets[key], dtype=np.int64))
+
+    meta = {"num_docs": num_docs, "fields": fields, "source": _corpus_fingerprint(corpus_path)}
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+class DocStore:
+    r"""Read-only, mmap-backed view over a doc store built by `build_doc_store`."""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.num_docs = self.meta["num_docs"]
+        self.fields = self.meta["fields"]
+
+        self._blobs = {}
+        self._offsets = {}
+        for key in self.fields:
+            blob_path = os.path.join(store_dir, f"{key}.bin")
+            if os.path.getsize(blob_path) > 0:
+                with open(blob_path, "rb") as f:
+                    self._blobs[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._blobs[key] = b""
+            self._offsets[key] = np.load(os.path.join(store_dir, f"{key}.offsets.npy"), mmap_mode="r")
+
+    @classmethod
+    def open_or_build(cls, corpus_path: str, store_dir: str) -> "DocStore":
+        r"""Open the doc store, (re)building it first if it is missing or was built from another corpus file."""
+        meta_path = os.path.join(store_dir, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                source = json.load(f)["source"]
+            if not corpus_path or not os.path.exists(corpus_path) or source == _corpus_fingerprint(corpus_path):
+                return cls(store_dir)
+            print(f"Corpus {corpus_path} changed since the doc store was built, rebuilding...")
+        build_doc_store(corpus_path, store_dir)
+        return cls(store_dir)
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, idx):
+        return self.get_many([idx])[0]
+
+    def _get_column(self, key: str, flat_idxs: np.ndarray) -> List:
+        offsets = self._offsets[key]
+        # faiss pads missing hits (e.g. fewer than k vectors searched) with -1, they map to an empty value
+        missing = flat_idxs < 0
+        row_idxs = np.where(missing, 0, flat_idxs)
+        starts = offsets[row_idxs].tolist()
+        ends = offsets[row_idxs + 1].tolist()
+        blob = self._blobs[key]
+        values = [blob[s:e].decode("utf-8") for s, e in zip(starts, ends)]
+        if self.fields[key] == "json":
+            values = [json.loads(value) for value in values]
+        empty = "" if self.fields[key] == "str" else None
+        return [empty if is_missing else value for is_missing, value in zip(missing.tolist(), values)]
+
+    def get_column(self, key: str, idxs) -> List:
+        r"""Fetch a single field for an (optionally nested) array of ids, keeping its shape as nested lists."""
+        idxs = np.asarray(idxs).astype(np.int64)
+        values = self._get_column(key, idxs.reshape(-1))
+        return self._unflatten(values, idxs.shape)
+
+    def get_many(self, idxs, fields: List[str] = None) -> List:
+        r"""Fetch documents for an (optionally nested) array of ids, e.g. a (batch, topk) id matrix from faiss.
+
+        Return:
+            list: document dicts, nested the same way as `idxs`
+        """
+        fields = list(self.fields) if fields is None else fields
+        idxs = np.asarray(idxs).astype(np.int64)
+        flat_idxs = idxs.reshape(-1)
+        columns = [self._get_column(key, flat_idxs) for key in fields]
+        docs = [dict(zip(fields, values)) for values in zip(*columns)]
+        return self._unflatten(docs, idxs.shape)
+
+    @staticmethod
+    def _unflatten(values: List, shape) -> List:
+        if len(shape) <= 1:
+            return values
+        row_size = int(np.prod(shape[1:]))
+        rows = [values[i * row_size:(i + 1) * row_size] for i in range(shape[0])]
+        if len(shape) > 2:
+            rows = [DocStore._unflatten(row, shape[1:]) for row in rows]
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a columnar doc store from a corpus jsonl.")
+    parser.add_argument("--corpus_path", type=str, required=True, help="Local corpus file.")
+    parser.add_argument("--save_dir", type=str, required=True, help="Directory to write the doc store to.")
+    args = parser.parse_args()
+
+    build_doc_store(args.corpus_path, args.save_dir)
+    print("Finish!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Helpers shared by the index builder and the retrievers for (compressed) faiss indexes.
+"""
+import os
+import json
+import warnings
+from typing import Dict, List, Optional
+
+import faiss
+
+
+def index_file_name(retrieval_method: str, faiss_type: str) -> str:
+    r"""File name of a dense index, e.g. `e5_Flat.index` or `e5_IVF4096_PQ64.index`."""
+    return f"{retrieval_method}_{faiss_type.replace(',', '_')}.index"
+
+
+def index_meta_path(index_path: str) -> str:
+    return index_path + ".meta.json"
+
+
+def save_index_meta(index_path: str, meta: Dict):
+    with open(index_meta_path(index_path), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_index_meta(index_path: str) -> Dict:
+    r"""Load the build parameters saved next to an index, empty for indexes built before they were recorded."""
+    meta_path = index_meta_path(index_path)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def index_shards_path(index_path: str) -> str:
+    return index_path + ".shards.json"
+
+
+def shard_index_path(index_path: str, shard_id: int, num_shards: int) -> str:
+    r"""File of one shard of a sharded index, e.g. `e5_Flat.shard000-of-004.index`."""
+    root, ext = os.path.splitext(index_path)
+    return f"{root}.shard{shard_id:03d}-of-{num_shards:03d}{ext}"
+
+
+def save_index_shards(index_path: str, shard_paths: List[str], ntotals: List[int]):
+    r"""Write the manifest of a sharded index, shard `i` holds the ids starting at `id_offset`."""
+    shards = []
+    id_offset = 0
+    for shard_path, ntotal in zip(shard_paths, ntotals):
+        shards.append({"path": os.path.basename(shard_path), "id_offset": id_offset, "ntotal": ntotal})
+        id_offset += ntotal
+    with open(index_shards_path(index_path), "w") as f:
+        json.dump({"ntotal": id_offset, "shards": shards}, f, indent=2)
+
+
+def load_index_shards(index_path: str) -> Optional[Dict]:
+    r"""Load the manifest of a sharded index, None for indexes saved as a single file."""
+    shards_path = index_shards_path(index_path)
+    if not os.path.exists(shards_path):
+        return None
+    with open(shards_path, "r") as f:
+        return json.load(f)
+
+
+def resolve_index_path(index_path: str) -> str:
+    r"""The file that identifies an index on disk: the index itself, or the manifest of a sharded one."""
+    return index_shards_path(index_path) if load_index_shards(index_path) is not None else index_path
+
+
+def can_mmap_codes() -> bool:
+    r"""Whether this faiss can memory-map the codes of flat (IndexFlatCodes) and HNSW indexes, not only IVF lists."""
+    return hasattr(faiss, "IO_FLAG_MMAP_IFC")
+
+
+def mmap_io_flags() -> int:
+    r"""Read flags memory-mapping an index read-only, see `read_mmapped_index`."""
+    io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    if can_mmap_codes():
+        io_flags |= faiss.IO_FLAG_MMAP_IFC
+    return io_flags
+
+
+def read_mmapped_index(path: str):
+    r"""
+    Read an index file memory-mapped. `IO_FLAG_MMAP` only maps the inverted lists of IVF
+    indexes, the codes of flat and HNSW indexes need `IO_FLAG_MMAP_IFC` of newer faiss
+    releases. Without it they are loaded into the memory of every process, with a warning.
+    """
+    index = faiss.read_index(path, mmap_io_flags())
+    if not can_mmap_codes():
+        try:
+            faiss.extract_index_ivf(index)
+        except (RuntimeError, AttributeError):
+            warnings.warn(f"This faiss has no IO_FLAG_MMAP_IFC, {path} ({type(index).__name__}) is loaded into memory "
+                          f"instead of memory-mapped, upgrade faiss to share it between processes.")
+    return index
+
+
+def read_index(index_path: str, mmap: bool = False):
+    r"""
+    Read a faiss index, or an `IndexShards` over the shard files of a sharded build.
+    With `mmap` the index data is memory-mapped read-only instead of loaded (see
+    `read_mmapped_index`), so processes serving the same index share its pages
+    through the os page cache.
+    """
+    read = read_mmapped_index if mmap else faiss.read_index
+    manifest = load_index_shards(index_path)
+    if manifest is None:
+        return read(index_path)
+    index_dir = os.path.dirname(index_path)
+    shards = [read(os.path.join(index_dir, shard["path"])) for shard in manifest["shards"]]
+    # threaded search over the shards, ids of shard i are offset by the size of the previous ones
+    index = faiss.IndexShards(shards[0].d, True, True)
+    for shard in shards:
+        index.add_shard(shard)
+    # the shards are not owned by the c++ object, keep them alive with it
+    index.referenced_objects = shards
+    return index
+
+
+def set_search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    r"""Set query-time parameters of IVF (`nprobe`) and HNSW (`efSearch`) indexes, ignored by other index types."""
+    if nprobe is None and ef_search is None:
+        return
+    # GpuParameterSpace also handles cpu indexes, but only exists in faiss-gpu builds
+    params = faiss.GpuParameterSpace() if hasattr(faiss, "GpuParameterSpace") else faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None:
+            continue
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            # the index does not have this parameter, e.g. nprobe on HNSW
+            pass
+
+
+def get_search_params(index) -> Dict:
+    r"""Read the current `nprobe` / `efSearch` of a cpu index, None for the ones it does not have."""
+    search_params = {"nprobe": None, "ef_search": None}
+    if isinstance(index, faiss.IndexShards):
+        # the shards of a sharded build share their parameters
+        index = faiss.downcast_index(index.at(0))
+    try:
+        search_params["nprobe"] = faiss.extract_index_ivf(index).nprobe
+    except (RuntimeError, AttributeError):
+        pass
+    hnsw_index = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexPreTransform) else index
+    if hasattr(hnsw_index, "hnsw"):
+        search_params["ef_search"] = hnsw_index.hnsw.efSearch
+    return search_params
@@ -1,4 +1,5 @@
 import os
+import glob
 import faiss
 import json
 import warnings
@@ -7,22 +8,29 @@ from typing import cast, List, Dict
 import shutil
 import subprocess
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from tqdm import tqdm
 # from LongRAG.retriever.utils import load_model, load_corpus, pooling
 import datasets
 from transformers import AutoTokenizer, AutoModel, AutoConfig
 
+from faiss_utils import (index_file_name, index_shards_path, load_index_shards, read_index, save_index_meta,
+                         save_index_shards, set_search_params, shard_index_path)
+
 
 def load_model(
         model_path: str, 
-        use_fp16: bool = False
+        use_fp16: bool = False,
+        device: str = "cuda"
     ):
     model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
     model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
     model.eval()
-    model.cuda()
-    if use_fp16: 
+    model.to(device)
+    # fp16 matmuls are slow or missing on cpu
+    if use_fp16 and device != "cpu": 
         model = model.half()
     tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, trust_remote_code=True)
 
@@ -72,7 +80,17 @@ class Index_Builder:
             faiss_type=None,
             embedding_path=None,
             save_embedding=False,
-            faiss_gpu=False
+            faiss_gpu=False,
+            train_size=None,
+            nprobe=None,
+            ef_search=None,
+            length_bucketing=False,
+            max_tokens_per_batch=None,
+            device=None,
+            num_workers=None,
+            num_shards=1,
+            shard_id=None,
+            index_shards=False
         ):
         
         self.retrieval_method = retrieval_method.lower()
@@ -87,8 +105,23 @@ class Index_Builder:
         self.embedding_path = embedding_path
         self.save_embedding = save_embedding
         self.faiss_gpu = faiss_gpu
+        self.train_size = train_size
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.length_bucketing = length_bucketing
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.index_shards = index_shards
 
         self.gpu_num = torch.cuda.device_count()
+        self.device = device if device is not None else ("cuda" if self.gpu_num > 0 else "cpu")
+        if num_workers is None:
+            num_workers = self.gpu_num if self.device == "cuda" else 1
+        self.num_workers = max(num_workers, 1)
+        # local workers split the corpus themselves, unless the shards are spread over nodes
+        self.num_shards = num_shards if num_shards > 1 else self.num_workers
+        self.shard_id = shard_id
+        if self.shard_id is not None and not 0 <= self.shard_id < self.num_shards:
+            raise ValueError(f"shard_id {self.shard_id} out of range for {self.num_shards} shards")
         # prepare save dir
         print(self.save_dir)
         if not os.path.exists(self.save_dir):
@@ -97,9 +130,12 @@ class Index_Builder:
             if not self._check_dir(self.save_dir):
                 warnings.warn("Some files already exists in save dir and may be overwritten.", UserWarning)
 
-        self.index_save_path = os.path.join(self.save_dir, f"{self.retrieval_method}_{self.faiss_type}.index")
+        self.index_save_path = os.path.join(self.save_dir, index_file_name(self.retrieval_method, self.faiss_type))
 
         self.embedding_save_path = os.path.join(self.save_dir, f"emb_{self.retrieval_method}.memmap")
+        # batches encoded between two progress checkpoints, and rows per faiss add call
+        self.checkpoint_steps = 50
+        self.add_batch_size = 100000
 
         self.corpus = load_corpus(self.corpus_path)
        
@@ -168,78 +204,268 @@ class Index_Builder:
             ).reshape(corpus_size, hidden_size)
         return all_embeddings
 
-    def _save_embedding(self, all_embeddings):
-        memmap = np.memmap(
-            self.embedding_save_path,
-            shape=all_embeddings.shape,
-            mode="w+",
-            dtype=all_embeddings.dtype
+    def _shard_range(self, shard_id, corpus_size):
+        return corpus_size * shard_id // self.num_shards, corpus_size * (shard_id + 1) // self.num_shards
+
+    def _segment_path(self, shard_id):
+        if self.num_shards == 1:
+            return self.embedding_save_path
+        return embedding_segment_path(self.embedding_save_path, shard_id, self.num_shards)
+
+    def _load_progress(self, embedding_path, start, end):
+        r"""Return the number of rows of [start, end) already encoded into the embedding memmap by a previous run."""
+        progress_path = embedding_path + ".progress"
+        if not os.path.exists(progress_path) or not os.path.exists(embedding_path):
+            return 0
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+        if progress.get("start") != start or progress.get("end") != end \
+                or progress.get("hidden_size") != self.hidden_size \
+                or progress.get("corpus_path") != os.path.abspath(self.corpus_path):
+            warnings.warn("Found encoding progress of another corpus or model, encoding from scratch.", UserWarning)
+            return 0
+        return progress["offset"]
+
+    def _save_progress(self, embedding_path, start, end, offset):
+        progress_path = embedding_path + ".progress"
+        tmp_path = progress_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "offset": offset,
+                "start": start,
+                "end": end,
+                "hidden_size": self.hidden_size,
+                "corpus_path": os.path.abspath(self.corpus_path),
+            }, f)
+        # atomic, a crash never leaves a truncated progress file behind
+        os.replace(tmp_path, progress_path)
+
+    def _corpus_texts(self, start_idx, end_idx):
+        batch_data_title = self.corpus[start_idx:end_idx]['title']
+        batch_data_text = self.corpus[start_idx:end_idx]['text']
+        batch_data = ['"' + title + '"\n' + text for title, text in zip(batch_data_title, batch_data_text)]
+
+        if self.retrieval_method == "e5":
+            batch_data = [f"passage: {doc}" for doc in batch_data]
+        return batch_data
+
+    def _encode_batch(self, batch_data):
+        inputs = self.tokenizer(
+                    batch_data,
+                    padding=True,
+                    truncation=True,
+                    return_tensors='pt',
+                    max_length=self.max_length,
         )
-        length = all_embeddings.shape[0]
-        # add in batch
-        save_batch_size = 10000
-        if length > save_batch_size:
-            for i in tqdm(range(0, length, save_batch_size), leave=False, desc="Saving Embeddings"):
-                j = min(i + save_batch_size, length)
-                memmap[i: j] = all_embeddings[i: j]
+        return self._encode_inputs(inputs)
+
+    def _encode_inputs(self, inputs):
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+
+        #TODO: support encoder-only T5 model
+        if "T5" in type(self.encoder).__name__:
+            # T5-based retrieval model
+            decoder_input_ids = torch.zeros(
+                (inputs['input_ids'].shape[0], 1), dtype=torch.long
+            ).to(inputs['input_ids'].device)
+            output = self.encoder(
+                **inputs, decoder_input_ids=decoder_input_ids, return_dict=True
+            )
+            embeddings = output.last_hidden_state[:, 0, :]
+
         else:
-            memmap[:] = all_embeddings
+            output = self.encoder(**inputs, return_dict=True)
+            embeddings = pooling(output.pooler_output, 
+                                output.last_hidden_state, 
+                                inputs['attention_mask'],
+                                self.pooling_method)
+            if  "dpr" not in self.retrieval_method:
+                embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
+
+        embeddings = cast(torch.Tensor, embeddings)
+        return embeddings.detach().cpu().numpy().astype(np.float32)
 
     def encode_all(self):
-        if self.gpu_num > 1:
-            print("Use multi gpu!")
-            self.encoder = torch.nn.DataParallel(self.encoder)
-            self.batch_size = self.batch_size * self.gpu_num
-
-        all_embeddings = []
-
-        for start_idx in tqdm(range(0, len(self.corpus), self.batch_size), desc='Inference Embeddings:'):
-
-            batch_data_title = self.corpus[start_idx:start_idx+self.batch_size]['title']
-            batch_data_text = self.corpus[start_idx:start_idx+self.batch_size]['text']
-            batch_data = ['"' + title + '"\n' + text for title, text in zip(batch_data_title, batch_data_text)]
-
-            if self.retrieval_method == "e5":
-                batch_data = [f"passage: {doc}" for doc in batch_data]
-
-            inputs = self.tokenizer(
-                        batch_data,
-                        padding=True,
-                        truncation=True,
-                        return_tensors='pt',
-                        max_length=self.max_length,
-            ).to('cuda')
-
-            inputs = {k: v.cuda() for k, v in inputs.items()}
-
-            #TODO: support encoder-only T5 model
-            if "T5" in type(self.encoder).__name__:
-                # T5-based retrieval model
-                decoder_input_ids = torch.zeros(
-                    (inputs['input_ids'].shape[0], 1), dtype=torch.long
-                ).to(inputs['input_ids'].device)
-                output = self.encoder(
-                    **inputs, decoder_input_ids=decoder_input_ids, return_dict=True
-                )
-                embeddings = output.last_hidden_state[:, 0, :]
-
-            else:
-                output = self.encoder(**inputs, return_dict=True)
-                embeddings = pooling(output.pooler_output, 
-                                    output.last_hidden_state, 
-                                    inputs['attention_mask'],
-                                    self.pooling_method)
-                if  "dpr" not in self.retrieval_method:
-                    embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
-
-            embeddings = cast(torch.Tensor, embeddings)
-            embeddings = embeddings.detach().cpu().numpy()
-            all_embeddings.append(embeddings)
-
-        all_embeddings = np.concatenate(all_embeddings, axis=0)
-        all_embeddings = all_embeddings.astype(np.float32)
+        r"""Encode the corpus into one embedding memmap segment per shard, and return the segments.
+
+        With several workers every shard is encoded by its own process, one per gpu
+        or cpu processes splitting the cores. When `shard_id` is set only that shard
+        is encoded, so the shards of one build can be spread over nodes sharing the
+        save dir. A single pending shard is split into one part per worker instead,
+        merged into the shard segment once all parts are encoded. Shards finished by
+        a previous run are skipped.
+        """
+        corpus_size = len(self.corpus)
+        shard_ids = list(range(self.num_shards)) if self.shard_id is None else [self.shard_id]
+        pending = [shard_id for shard_id in shard_ids if not self._segment_done(shard_id, corpus_size)]
+        if len(pending) == 1 and self.num_workers > 1:
+            ranges = self._part_ranges(pending[0], corpus_size)
+        else:
+            ranges = [(*self._shard_range(shard_id, corpus_size), self._segment_path(shard_id)) for shard_id in pending]
+
+        num_workers = min(self.num_workers, len(ranges))
+        if num_workers > 1:
+            print(f"Encoding {len(ranges)} segments with {num_workers} {self.device} workers")
+            ctx = torch.multiprocessing.get_context("spawn")
+            workers = [
+                ctx.Process(target=_encode_ranges_worker,
+                            args=(self, ranges[rank::num_workers], self._worker_device(rank), num_workers))
+                for rank in range(num_workers)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+            if len(failed) > 0:
+                raise RuntimeError(f"{len(failed)} encoding workers failed, rerun to resume from the last checkpoint.")
+        elif len(ranges) > 0:
+            self._encode_ranges(ranges, self.device)
+        if len(ranges) > len(pending):
+            self._merge_parts(pending[0], ranges)
+
+        segments = []
+        for shard_id in shard_ids:
+            start, end = self._shard_range(shard_id, corpus_size)
+            segments.append(self._load_embedding(self._segment_path(shard_id), end - start, self.hidden_size))
+        return segments
+
+    def _part_ranges(self, shard_id, corpus_size):
+        r"""Split the rows of a shard into one part per worker, each encoded into its own memmap."""
+        start, end = self._shard_range(shard_id, corpus_size)
+        segment_path = self._segment_path(shard_id)
+        # no empty parts, a shard with fewer rows than workers gets one row per part
+        num_parts = min(self.num_workers, end - start)
+        if num_parts <= 1:
+            return [(start, end, segment_path)]
+        bounds = [start + (end - start) * part_id // num_parts for part_id in range(num_parts + 1)]
+        return [(bounds[part_id], bounds[part_id + 1], f"{segment_path}.part{part_id:03d}-of-{num_parts:03d}")
+                for part_id in range(num_parts)]
+
+    def _merge_parts(self, shard_id, parts):
+        r"""Copy the encoded parts of a shard into its segment, chunk by chunk, and remove them."""
+        start, end = self._shard_range(shard_id, len(self.corpus))
+        segment_path = self._segment_path(shard_id)
+        embeddings = np.memmap(segment_path, shape=(end - start, self.hidden_size), mode="w+", dtype=np.float32)
+        for part_start, part_end, part_path in parts:
+            part = self._load_embedding(part_path, part_end - part_start, self.hidden_size)
+            for start_idx in range(0, len(part), self.add_batch_size):
+                chunk = part[start_idx:start_idx + self.add_batch_size]
+                embeddings[part_start - start + start_idx:part_start - start + start_idx + len(chunk)] = chunk
+            del part
+        embeddings.flush()
+        del embeddings
+        self._save_progress(segment_path, start, end, end - start)
+        for _, _, part_path in parts:
+            os.remove(part_path)
+            os.remove(part_path + ".progress")
+
+    def _segment_done(self, shard_id, corpus_size):
+        start, end = self._shard_range(shard_id, corpus_size)
+        return self._load_progress(self._segment_path(shard_id), start, end) == end - start
+
+    def _worker_device(self, rank):
+        if self.device == "cpu":
+            return "cpu"
+        return f"cuda:{rank % self.gpu_num}"
 
-        return all_embeddings
+    @torch.no_grad()
+    def _encode_ranges(self, ranges, device):
+        self.device = device
+        self.encoder, self.tokenizer = load_model(model_path = self.model_path,
+                                                  use_fp16 = self.use_fp16,
+                                                  device = device)
+        for start, end, embedding_path in ranges:
+            self.encode_range(start, end, embedding_path)
+
+    def encode_range(self, start, end, embedding_path):
+        r"""Encode corpus rows [start, end) straight into the memmap at `embedding_path`.
+
+        Progress is checkpointed every `checkpoint_steps` batches, so a restarted
+        build resumes from the last completed offset. Peak memory is one batch.
+        """
+        offset = self._load_progress(embedding_path, start, end)
+        if offset > 0:
+            print(f"Resuming encoding of rows [{start}, {end}) from row {start + offset}")
+        embeddings = np.memmap(
+            embedding_path,
+            shape=(end - start, self.hidden_size),
+            mode="r+" if offset > 0 else "w+",
+            dtype=np.float32
+        )
+
+        if self.length_bucketing:
+            self._encode_bucketed(embeddings, start, end, offset, embedding_path)
+        else:
+            steps = range(start + offset, end, self.batch_size)
+            for step, start_idx in enumerate(tqdm(steps, desc='Inference Embeddings:')):
+                end_idx = min(start_idx + self.batch_size, end)
+                embeddings[start_idx - start:end_idx - start] = self._encode_batch(self._corpus_texts(start_idx, end_idx))
+
+                if (step + 1) % self.checkpoint_steps == 0 or end_idx == end:
+                    embeddings.flush()
+                    self._save_progress(embedding_path, start, end, end_idx - start)
+
+        del embeddings
+
+    def _tokenize_window(self, start_idx, end_idx):
+        return self.tokenizer(
+                    self._corpus_texts(start_idx, end_idx),
+                    padding=False,
+                    truncation=True,
+                    max_length=self.max_length,
+        )
+
+    @staticmethod
+    def _length_batches(lengths, max_tokens_per_batch):
+        r"""Group positions, sorted by length, into batches of at most `max_tokens_per_batch` padded tokens."""
+        batches = []
+        batch = []
+        for idx in np.argsort(lengths, kind="stable"):
+            # lengths are ascending, so the current passage sets the padded length of the batch
+            if batch and (len(batch) + 1) * lengths[idx] > max_tokens_per_batch:
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _encode_bucketed(self, embeddings, start, end, offset, embedding_path):
+        r"""Encode corpus rows [start, end) in windows of `batch_size * checkpoint_steps` passages.
+
+        Inside a window passages are sorted by token length and grouped into
+        token-budgeted batches, so short passages are no longer padded to the
+        longest one of a file-order batch. Embeddings are scattered back to their
+        corpus position before the window is written, and the next windows are
+        tokenized by a background worker while the current one is encoded.
+        """
+        max_tokens_per_batch = self.max_tokens_per_batch or self.batch_size * self.max_length
+        window_size = self.batch_size * self.checkpoint_steps
+        windows = [(start_idx, min(start_idx + window_size, end))
+                   for start_idx in range(start + offset, end, window_size)]
+
+        # a single worker is enough, fast tokenizers batch-encode on all cores without holding the GIL
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = [pool.submit(self._tokenize_window, *window) for window in windows[:2]]
+            for window_id, (start_idx, end_idx) in enumerate(tqdm(windows, desc='Inference Embeddings:')):
+                encodings = pending.pop(0).result()
+                if window_id + 2 < len(windows):
+                    pending.append(pool.submit(self._tokenize_window, *windows[window_id + 2]))
+
+                lengths = np.array([len(ids) for ids in encodings['input_ids']])
+                window_embeddings = np.empty((end_idx - start_idx, self.hidden_size), dtype=np.float32)
+                for batch in self._length_batches(lengths, max_tokens_per_batch):
+                    inputs = self.tokenizer.pad(
+                                {k: [v[i] for i in batch] for k, v in encodings.items()},
+                                padding=True,
+                                return_tensors='pt',
+                    )
+                    window_embeddings[batch] = self._encode_inputs(inputs)
+
+                embeddings[start_idx - start:end_idx - start] = window_embeddings
+                embeddings.flush()
+                self._save_progress(embedding_path, start, end, end_idx - start)
 
     @torch.no_grad()
     def build_dense_index(self):
@@ -250,39 +476,203 @@ class Index_Builder:
         if os.path.exists(self.index_save_path):
             print("The index file already exists and will be overwritten.")
         
-        self.encoder, self.tokenizer = load_model(model_path = self.model_path, 
-                                                  use_fp16 = self.use_fp16)
+        self.hidden_size = AutoConfig.from_pretrained(self.model_path, trust_remote_code=True).hidden_size
         if self.embedding_path is not None:
-            hidden_size = self.encoder.config.hidden_size
-            corpus_size = len(self.corpus)
-            all_embeddings = self._load_embedding(self.embedding_path, corpus_size, hidden_size)
+            segments = [self._load_embedding(self.embedding_path, len(self.corpus), self.hidden_size)]
         else:
-            all_embeddings = self.encode_all()
-            if self.save_embedding:
-                self._save_embedding(all_embeddings)
+            segments = self.encode_all()
+            if self.shard_id is not None:
+                print(f"Finish encoding shard {self.shard_id}, build the index once all {self.num_shards} shards are encoded.")
+                return
             del self.corpus
 
-        # build index
+        if self.index_shards and len(segments) > 1:
+            ntotal = self._build_index_shards(segments)
+        else:
+            faiss_index = self._build_faiss_index(segments)
+            faiss.write_index(faiss_index, self.index_save_path)
+            ntotal = faiss_index.ntotal
+            # a stale manifest would shadow the new index
+            if os.path.exists(index_shards_path(self.index_save_path)):
+                os.remove(index_shards_path(self.index_save_path))
+
+        # the default query-time parameters are picked up by the retrieval servers
+        save_index_meta(self.index_save_path, {
+            "retrieval_method": self.retrieval_method,
+            "faiss_type": self.faiss_type,
+            "dim": self.hidden_size,
+            "ntotal": ntotal,
+            "metric": "inner_product",
+            "nprobe": self.nprobe,
+            "ef_search": self.ef_search,
+            "num_shards": len(segments) if self.index_shards else 1,
+        })
+
+        if self.embedding_path is None:
+            del segments
+            for shard_id in range(self.num_shards):
+                segment_path = self._segment_path(shard_id)
+                os.remove(segment_path + ".progress")
+                if not self.save_embedding:
+                    os.remove(segment_path)
+        print("Finish!")
+
+    def _build_faiss_index(self, segments):
         print("Creating index")
-        dim = all_embeddings.shape[-1]
-        faiss_index = faiss.index_factory(dim, self.faiss_type, faiss.METRIC_INNER_PRODUCT)
+        faiss_index = faiss.index_factory(self.hidden_size, self.faiss_type, faiss.METRIC_INNER_PRODUCT)
         
-        if self.faiss_gpu:
+        # HNSW indexes have no gpu implementation
+        if self.faiss_gpu and "HNSW" not in self.faiss_type:
             co = faiss.GpuMultipleClonerOptions()
             co.useFloat16 = True
             co.shard = True
             faiss_index = faiss.index_cpu_to_all_gpus(faiss_index, co)
             if not faiss_index.is_trained:
-                faiss_index.train(all_embeddings)
-            faiss_index.add(all_embeddings)
+                faiss_index.train(self._sample_train_embeddings(segments))
+            self._add_embeddings(faiss_index, segments)
             faiss_index = faiss.index_gpu_to_cpu(faiss_index)
         else:
             if not faiss_index.is_trained:
-                faiss_index.train(all_embeddings)
-            faiss_index.add(all_embeddings)
-
-        faiss.write_index(faiss_index, self.index_save_path)
-        print("Finish!")
+                faiss_index.train(self._sample_train_embeddings(segments))
+            self._add_embeddings(faiss_index, segments)
+        return faiss_index
+
+    def _build_index_shards(self, segments):
+        r"""Build one index per embedding segment, searched together as a faiss `IndexShards`."""
+        shard_paths = []
+        ntotals = []
+        for shard_id, segment in enumerate(segments):
+            faiss_index = self._build_faiss_index([segment])
+            shard_path = shard_index_path(self.index_save_path, shard_id, len(segments))
+            faiss.write_index(faiss_index, shard_path)
+            shard_paths.append(shard_path)
+            ntotals.append(faiss_index.ntotal)
+        save_index_shards(self.index_save_path, shard_paths, ntotals)
+        # a stale single-file index would be confusing next to the manifest
+        if os.path.exists(self.index_save_path):
+            os.remove(self.index_save_path)
+        return sum(ntotals)
+
+    def _add_embeddings(self, faiss_index, segments):
+        r"""Add the (memmapped) embeddings to the index chunk by chunk, so they never need to fit in memory."""
+        for segment in segments:
+            for start_idx in tqdm(range(0, len(segment), self.add_batch_size), desc="Adding to index"):
+                chunk = segment[start_idx:start_idx + self.add_batch_size]
+                faiss_index.add(np.ascontiguousarray(chunk, dtype=np.float32))
+
+    def _sample_train_embeddings(self, segments):
+        r"""Sample the training set of quantizer-based indexes (IVF / PQ / SQ), training on the full corpus is rarely needed."""
+        num_embeddings = sum(len(segment) for segment in segments)
+        if self.train_size is None or self.train_size >= num_embeddings:
+            return np.ascontiguousarray(np.concatenate(segments), dtype=np.float32)
+        print(f"Training index on {self.train_size} sampled embeddings")
+        sample_idxs = np.sort(np.random.default_rng(0).choice(num_embeddings, self.train_size, replace=False))
+        return _gather_rows(segments, sample_idxs)
+
+
+def _encode_ranges_worker(index_builder, ranges, device, num_workers):
+    if device == "cpu":
+        # split the cores between the worker processes
+        torch.set_num_threads(max(1, os.cpu_count() // num_workers))
+    index_builder._encode_ranges(ranges, device)
+
+
+def embedding_segment_path(embedding_path, shard_id, num_shards):
+    r"""Memmap of one corpus shard, e.g. `emb_e5.shard000-of-004.memmap`."""
+    root, ext = os.path.splitext(embedding_path)
+    return f"{root}.shard{shard_id:03d}-of-{num_shards:03d}{ext}"
+
+
+def find_embedding_segments(embedding_path):
+    r"""Return the embedding memmap, or the segments of a sharded build in corpus order."""
+    if os.path.exists(embedding_path):
+        return [embedding_path]
+    root, ext = os.path.splitext(embedding_path)
+    return sorted(glob.glob(f"{root}.shard[0-9]*-of-[0-9]*{ext}"))
+
+
+def _gather_rows(segments, idxs):
+    r"""Gather rows, by sorted global position, from embedding segments laid out back to back."""
+    bounds = np.cumsum([0] + [len(segment) for segment in segments])
+    rows = []
+    for segment, start, end in zip(segments, bounds[:-1], bounds[1:]):
+        local_idxs = idxs[(idxs >= start) & (idxs < end)] - start
+        if len(local_idxs) > 0:
+            rows.append(np.asarray(segment[local_idxs], dtype=np.float32))
+    return np.ascontiguousarray(np.concatenate(rows), dtype=np.float32)
+
+
+def _exact_topk(queries, segments, topk, chunk_size=50000):
+    r"""Brute-force inner product top-k over (memmapped) embedding segments, scanned in chunks.
+
+    Each chunk is searched with a flat index, which keeps the top-k while it scans
+    instead of materializing the (queries, chunk) score matrix.
+    """
+    best_scores = np.full((len(queries), topk), -np.inf, dtype=np.float32)
+    best_idxs = np.full((len(queries), topk), -1, dtype=np.int64)
+    bounds = np.cumsum([0] + [len(segment) for segment in segments])
+    chunks = [(segment, base, start) for segment, base in zip(segments, bounds[:-1])
+              for start in range(0, len(segment), chunk_size)]
+    for segment, base, start in tqdm(chunks, desc="Exact search"):
+        chunk = np.ascontiguousarray(segment[start:start + chunk_size], dtype=np.float32)
+        flat_index = faiss.IndexFlatIP(chunk.shape[1])
+        flat_index.add(chunk)
+        scores, idxs = flat_index.search(queries, min(topk, len(chunk)))
+        cand_scores = np.concatenate([best_scores, scores], axis=1)
+        cand_idxs = np.concatenate([best_idxs, idxs + base + start], axis=1)
+        order = np.argsort(-cand_scores, axis=1)[:, :topk]
+        best_scores = np.take_along_axis(cand_scores, order, axis=1)
+        best_idxs = np.take_along_axis(cand_idxs, order, axis=1)
+    return best_idxs
+
+
+def _index_size(index_path):
+    manifest = load_index_shards(index_path)
+    if manifest is None:
+        return os.path.getsize(index_path)
+    index_dir = os.path.dirname(index_path)
+    return sum(os.path.getsize(os.path.join(index_dir, shard["path"])) for shard in manifest["shards"])
+
+
+def benchmark_recall(index_path, embedding_paths, num_queries=1000, topk=10, nprobe_list=None, ef_search_list=None):
+    r"""Measure recall@k of an index against exact (Flat) search, for each nprobe / efSearch setting.
+
+    Queries are sampled from the corpus embeddings, given as one memmap or the
+    segments of a sharded build in corpus order. The report is printed and saved
+    next to the index as `{index}.recall.json`.
+    """
+    index = read_index(index_path)
+    segments = [np.memmap(path, mode="r", dtype=np.float32).reshape(-1, index.d) for path in embedding_paths]
+    num_embeddings = sum(len(segment) for segment in segments)
+    num_queries = min(num_queries, num_embeddings)
+    query_idxs = np.sort(np.random.default_rng(0).choice(num_embeddings, num_queries, replace=False))
+    queries = _gather_rows(segments, query_idxs)
+    ground_truth = _exact_topk(queries, segments, topk)
+
+    settings = [{}]
+    settings += [{"nprobe": nprobe} for nprobe in (nprobe_list or [])]
+    settings += [{"ef_search": ef_search} for ef_search in (ef_search_list or [])]
+
+    results = []
+    for params in settings:
+        set_search_params(index, **params)
+        start = time.perf_counter()
+        _, idxs = index.search(queries, topk)
+        elapsed = time.perf_counter() - start
+        recall = np.mean([len(set(pred) & set(gt)) / topk for pred, gt in zip(idxs.tolist(), ground_truth.tolist())])
+        results.append({**params, f"recall@{topk}": float(recall), "ms_per_query": elapsed * 1000 / num_queries})
+        print(f"{params if params else 'default params'}: recall@{topk}={recall:.4f}, {results[-1]['ms_per_query']:.3f} ms/query")
+
+    report = {
+        "index_path": index_path,
+        "index_size_gb": _index_size(index_path) / 1e9,
+        "num_queries": num_queries,
+        "topk": topk,
+        "results": results,
+    }
+    with open(index_path + ".recall.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
 
 
 MODEL2POOLING = {
@@ -311,8 +701,38 @@ def main():
     parser.add_argument('--embedding_path', default=None, type=str)
     parser.add_argument('--save_embedding', action='store_true', default=False)
     parser.add_argument('--faiss_gpu', default=False, action='store_true')
+    parser.add_argument('--length_bucketing', default=False, action='store_true', help='Batch passages of similar token length together.')
+    parser.add_argument('--max_tokens_per_batch', type=int, default=None, help='Padded token budget of a bucketed batch, defaults to batch_size * max_length.')
+    # Sharded encoding, e.g. --device cpu --num_workers 16, or --num_shards 4 --shard_id $NODE_RANK on each node
+    parser.add_argument('--device', type=str, default=None, choices=['cuda', 'cpu'])
+    parser.add_argument('--num_workers', type=int, default=None, help='Local encoding processes, defaults to one per gpu.')
+    parser.add_argument('--num_shards', type=int, default=1, help='Number of corpus shards, defaults to num_workers.')
+    parser.add_argument('--shard_id', type=int, default=None, help='Only encode this shard, split over the local workers. Rerun without it to build the index.')
+    parser.add_argument('--index_shards', default=False, action='store_true', help='Save one index per shard, searched as a faiss IndexShards.')
+    # Parameters for compressed indexes, e.g. --faiss_type IVF4096,PQ64 / HNSW32 / SQ8 / OPQ64,IVF4096,PQ64
+    parser.add_argument('--train_size', type=int, default=1000000, help='Number of sampled embeddings used to train IVF/PQ/SQ indexes.')
+    parser.add_argument('--nprobe', type=int, default=None, help='Default nprobe of IVF indexes, saved with the index.')
+    parser.add_argument('--ef_search', type=int, default=None, help='Default efSearch of HNSW indexes, saved with the index.')
+
+    # Recall@k benchmark against exact search
+    parser.add_argument('--benchmark_recall', action='store_true', default=False, help='Benchmark recall@k vs. Flat after building.')
+    parser.add_argument('--benchmark_only', action='store_true', default=False, help='Benchmark an existing index without building it.')
+    parser.add_argument('--benchmark_queries', type=int, default=1000)
+    parser.add_argument('--benchmark_topk', type=int, default=10)
+    parser.add_argument('--benchmark_nprobe', type=int, nargs='*', default=None)
+    parser.add_argument('--benchmark_ef_search', type=int, nargs='*', default=None)
     
     args = parser.parse_args()
+    faiss_type = args.faiss_type if args.faiss_type is not None else 'Flat'
+    index_path = os.path.join(args.save_dir, index_file_name(args.retrieval_method.lower(), faiss_type))
+    embedding_path = args.embedding_path or os.path.join(args.save_dir, f"emb_{args.retrieval_method.lower()}.memmap")
+
+    if args.benchmark_only:
+        benchmark_recall(index_path, find_embedding_segments(embedding_path), args.benchmark_queries, args.benchmark_topk,
+                         args.benchmark_nprobe, args.benchmark_ef_search)
+        return
+    if args.benchmark_recall and args.embedding_path is None and not args.save_embedding:
+        raise ValueError("--benchmark_recall needs the corpus embeddings, pass --save_embedding or --embedding_path")
 
     if args.pooling_method is None:
         pooling_method = 'mean'
@@ -339,10 +759,24 @@ def main():
                         faiss_type = args.faiss_type,
                         embedding_path = args.embedding_path,
                         save_embedding = args.save_embedding,
-                        faiss_gpu = args.faiss_gpu
+                        faiss_gpu = args.faiss_gpu,
+                        train_size = args.train_size,
+                        nprobe = args.nprobe,
+                        ef_search = args.ef_search,
+                        length_bucketing = args.length_bucketing,
+                        max_tokens_per_batch = args.max_tokens_per_batch,
+                        device = args.device,
+                        num_workers = args.num_workers,
+                        num_shards = args.num_shards,
+                        shard_id = args.shard_id,
+                        index_shards = args.index_shards
                     )
     index_builder.build_index()
 
+    if args.benchmark_recall and args.shard_id is None:
+        benchmark_recall(index_path, find_embedding_segments(embedding_path), args.benchmark_queries, args.benchmark_topk,
+                         args.benchmark_nprobe, args.benchmark_ef_search)
+
 
 if __name__ == "__main__":
     main()
@@ -12,8 +12,13 @@ from transformers import AutoConfig, AutoTokenizer, AutoModel
 import argparse
 import datasets
 
+from doc_store import DocStore
+from faiss_utils import index_file_name, read_index
 
-def load_corpus(corpus_path: str):
+
+def load_corpus(corpus_path: str, doc_store_path: str = None):
+    if doc_store_path:
+        return DocStore.open_or_build(corpus_path, doc_store_path)
     corpus = datasets.load_dataset(
             'json', 
             data_files=corpus_path,
@@ -33,6 +38,8 @@ def read_jsonl(file_path):
 
 
 def load_docs(corpus, doc_idxs):
+    if isinstance(corpus, DocStore):
+        return corpus.get_many(doc_idxs)
     results = [corpus[int(idx)] for idx in doc_idxs]
 
     return results
@@ -139,6 +146,7 @@ class BaseRetriever:
         
         self.index_path = config.index_path
         self.corpus_path = config.corpus_path
+        self.doc_store_path = getattr(config, 'doc_store_path', None)
 
         # self.cache_save_path = os.path.join(config.save_dir, 'retrieval_cache.json')
 
@@ -171,8 +179,8 @@ class BM25Retriever(BaseRetriever):
         self.searcher = LuceneSearcher(self.index_path)
         self.contain_doc = self._check_contain_doc()
         if not self.contain_doc:
-            self.corpus = load_corpus(self.corpus_path)
-        self.max_process_num = 8
+            self.corpus = load_corpus(self.corpus_path, self.doc_store_path)
+        self.max_process_num = getattr(config, 'bm25_threads', 8)
         
     def _check_contain_doc(self):
         r"""Check if the index contains document content
@@ -196,28 +204,59 @@ class BM25Retriever(BaseRetriever):
         else:
             hits = hits[:num]
 
-        if self.contain_doc:
-            all_contents = [json.loads(self.searcher.doc(hit.docid).raw())['contents'] for hit in hits]
-            results = [{'title': content.split("\n")[0].strip("\""), 
-                        'text': "\n".join(content.split("\n")[1:]),
-                        'contents': content} for content in all_contents]
-        else:
-            results = load_docs(self.corpus, [hit.docid for hit in hits])
+        results = self._load_hits([[hit.docid for hit in hits]])[0]
 
         if return_score:
             return results, scores
         else:
             return results
 
+    def _batch_search_ids(self, query_list: List[str], num: int):
+        r"""Return the hit scores and docids of each query.
+
+        Distinct queries are searched once, with pyserini's batch search running
+        `max_process_num` lucene threads.
+        """
+        unique_queries = list(dict.fromkeys(query_list))
+        qids = [str(i) for i in range(len(unique_queries))]
+        batch_hits = self.searcher.batch_search(unique_queries, qids, k=num, threads=self.max_process_num)
+        query_hits = {query: batch_hits[qid][:num] for query, qid in zip(unique_queries, qids)}
+        if any(len(hits) < num for hits in query_hits.values()):
+            warnings.warn('Not enough documents retrieved!')
+
+        scores = [[hit.score for hit in query_hits[query]] for query in query_list]
+        docids = [[hit.docid for hit in query_hits[query]] for query in query_list]
+        return scores, docids
+
+    def _load_hits(self, docids: List[List[str]]):
+        r"""Fetch the documents of a batch of hit lists, each distinct document once."""
+        unique_docids = list(dict.fromkeys(docid for row in docids for docid in row))
+        if self.contain_doc:
+            docs = {
+                docid: self._doc_from_contents(json.loads(self.searcher.doc(docid).raw())['contents'])
+                for docid in unique_docids
+            }
+        else:
+            # a single lookup for the whole batch, vectorized when the corpus is a doc store
+            docs = dict(zip(unique_docids, load_docs(self.corpus, unique_docids)))
+        return [[docs[docid] for docid in row] for row in docids]
+
+    @staticmethod
+    def _doc_from_contents(content: str):
+        return {
+            'title': content.split("\n")[0].strip("\""),
+            'text': "\n".join(content.split("\n")[1:]),
+            'contents': content
+        }
+
     def _batch_search(self, query_list, num: int = None, return_score = False):
-        # TODO: modify batch method
-        results = []
-        scores = []
-        for query in query_list:
-            item_result, item_score = self._search(query, num,True)
-            results.append(item_result)
-            scores.append(item_score)
+        if isinstance(query_list, str):
+            query_list = [query_list]
+        if num is None:
+            num = self.topk
 
+        scores, docids = self._batch_search_ids(query_list, num)
+        results = self._load_hits(docids)
         if return_score:
             return results, scores
         else:
@@ -238,15 +277,16 @@ class DenseRetriever(BaseRetriever):
 
     def __init__(self, config: dict):
         super().__init__(config)
-        self.index = faiss.read_index(self.index_path)
-        if config.faiss_gpu:
+        self.index = read_index(self.index_path)
+        # sharded indexes are searched on cpu by one thread per shard
+        if config.faiss_gpu and not isinstance(self.index, faiss.IndexShards):
             co = faiss.GpuMultipleClonerOptions()
             co.useFloat16 = True
             co.shard = True
             self.index = faiss.index_cpu_to_all_gpus(self.index, co=co)
             # self.index = faiss.index_cpu_to_all_gpus(self.index)
 
-        self.corpus = load_corpus(self.corpus_path)
+        self.corpus = load_corpus(self.corpus_path, self.doc_store_path)
         self.encoder = Encoder(
              model_name = self.retrieval_method, 
              model_path = config.retrieval_model_path,
@@ -292,13 +332,16 @@ class DenseRetriever(BaseRetriever):
             # print(f'################### encode time {b-a} #####################')
             batch_scores, batch_idxs = self.index.search(batch_emb, k=num)
             batch_scores = batch_scores.tolist()
-            batch_idxs = batch_idxs.tolist()
             # print(f'################### search time {time()-b} #####################')
             # exit()
             
-            flat_idxs = sum(batch_idxs, [])
-            batch_results = load_docs(self.corpus, flat_idxs)
-            batch_results = [batch_results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
+            if isinstance(self.corpus, DocStore):
+                # the doc store fetches the whole (batch, topk) id matrix in one call
+                batch_results = self.corpus.get_many(batch_idxs)
+            else:
+                flat_idxs = batch_idxs.reshape(-1).tolist()
+                batch_results = load_docs(self.corpus, flat_idxs)
+                batch_results = [batch_results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
             
             scores.extend(batch_scores)
             results.extend(batch_results)
@@ -339,9 +382,11 @@ if __name__ == '__main__':
     parser.add_argument('--retrieval_topk', type=int, default=10)
     parser.add_argument('--index_path', type=str, default=None)
     parser.add_argument('--corpus_path', type=str)
+    parser.add_argument('--doc_store_path', default=None, type=str)
     parser.add_argument('--dataset_path', default=None, type=str)
 
     parser.add_argument('--faiss_gpu', default=True, type=bool)
+    parser.add_argument('--faiss_type', default='Flat', type=str)
     parser.add_argument('--data_split', default="train", type=str)
     
     parser.add_argument('--retrieval_model_path', type=str, default=None)
@@ -349,10 +394,11 @@ if __name__ == '__main__':
     parser.add_argument('--retrieval_query_max_length', default=256, type=str)
     parser.add_argument('--retrieval_use_fp16', action='store_true', default=False)
     parser.add_argument('--retrieval_batch_size', default=512, type=int)
+    parser.add_argument('--bm25_threads', default=8, type=int)
     
     args = parser.parse_args()
 
-    args.index_path = os.path.join(args.index_path, f'{args.retrieval_method}_Flat.index') if args.retrieval_method != 'bm25' else os.path.join(args.index_path, 'bm25')
+    args.index_path = os.path.join(args.index_path, index_file_name(args.retrieval_method, args.faiss_type)) if args.retrieval_method != 'bm25' else os.path.join(args.index_path, 'bm25')
 
     # load dataset
     all_split = get_dataset(args)
@@ -0,0 +1,181 @@
+"""
+Caches used by the retrieval server to skip the encoder and faiss for repeated queries.
+"""
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    r"""Collapse whitespace so that trivially different rollout queries share a cache entry."""
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+class RetrievalCache:
+    r"""Thread-safe LRU cache with optional TTL eviction and hit/miss counters.
+
+    Args:
+        capacity: maximum number of entries, the least recently used one is evicted first
+        ttl: seconds an entry stays valid, None to keep entries until evicted
+    """
+
+    def __init__(self, capacity: int, ttl: Optional[float] = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            timestamp, value = item
+            if self.ttl is not None and time.time() - timestamp > self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, timestamp: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.time() if timestamp is None else timestamp, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def fingerprint_of(*parts: str) -> str:
+    r"""Hash of the strings that decide a set of cached results."""
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def index_fingerprint(index_path: str, *extra: str) -> str:
+    r"""Identify an index file by path, size and mtime, so cached results are dropped when the index is rebuilt.
+
+    `extra` adds whatever else decides the results, e.g. the encoder and the default nprobe / efSearch.
+    """
+    stat = os.stat(index_path)
+    return fingerprint_of(os.path.abspath(index_path), str(stat.st_size), str(stat.st_mtime_ns), *extra)
+
+
+class PersistentCacheStore:
+    r"""SQLite (WAL mode) store of top-k results that survives server restarts.
+
+    Rows are keyed by a hash of (index fingerprint, topk, normalised query). Rows
+    written for another fingerprint are deleted when the store is opened, so the
+    cache invalidates itself whenever the index file changes.
+    """
+
+    def __init__(self, db_path: str, fingerprint: str):
+        self.db_path = db_path
+        self.fingerprint = fingerprint
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, fingerprint TEXT, query TEXT, topk INTEGER, "
+            "scores BLOB, idxs BLOB, created REAL)"
+        )
+        deleted = self._conn.execute("DELETE FROM results WHERE fingerprint != ?", (fingerprint,)).rowcount
+        self._conn.commit()
+        if deleted > 0:
+            print(f"[PersistentCacheStore] Index changed, dropped {deleted} stale cache entries.")
+
+    def _key(self, query: str, topk: int) -> str:
+        return hashlib.sha1(f"{self.fingerprint}\x00{topk}\x00{query}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _decode(scores: bytes, idxs: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        return np.frombuffer(scores, dtype=np.float32).copy(), np.frombuffer(idxs, dtype=np.int64).copy()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def load_recent(self, limit: int) -> List[Tuple[str, int, np.ndarray, np.ndarray, float]]:
+        r"""Return the `limit` most recent entries, oldest first, to warm up an in-memory LRU cache."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT query, topk, scores, idxs, created FROM "
+                "(SELECT * FROM results ORDER BY created DESC LIMIT ?) ORDER BY created ASC",
+                (limit,)
+            ).fetchall()
+        return [(query, topk, *self._decode(scores, idxs), created) for query, topk, scores, idxs, created in rows]
+
+    def get_many(self, queries: List[str], topk: int) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        keys = {self._key(query, topk): query for query in queries}
+        found = {}
+        key_list = list(keys.keys())
+        with self._lock:
+            # stay below the sqlite limit on bound parameters
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, scores, idxs FROM results WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, scores, idxs in rows:
+                    found[keys[key]] = self._decode(scores, idxs)
+        return found
+
+    def put_many(self, items: List[Tuple[str, int, np.ndarray, np.ndarray]]):
+        now = time.time()
+        rows = [
+            (self._key(query, topk), self.fingerprint, query, topk,
+             np.ascontiguousarray(scores, dtype=np.float32).tobytes(),
+             np.ascontiguousarray(idxs, dtype=np.int64).tobytes(), now)
+            for query, topk, scores, idxs in items
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
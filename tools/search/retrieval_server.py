@@ -1,6 +1,10 @@
 import json
 import os
+import copy
 import warnings
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 import argparse
 
@@ -12,19 +16,63 @@ from tqdm import tqdm
 import datasets
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from doc_store import DocStore
+from token_store import open_token_stores, tokenizer_name
+from faiss_utils import load_index_meta, get_search_params, set_search_params, read_index, resolve_index_path, can_mmap_codes
+from retrieval_cache import RetrievalCache, PersistentCacheStore, index_fingerprint, fingerprint_of, normalize_query
+from shard_index import (IndexShard, RemoteShardIndex, launch_local_shards, local_shard_urls,
+                         encode_array, decode_array, MSGPACK_MEDIA_TYPE)
+
 
 parser = argparse.ArgumentParser(description="Launch the local faiss retriever.")
 parser.add_argument("--index_path", type=str, default="", help="Corpus indexing file.")
 parser.add_argument("--corpus_path", type=str, default="", help="Local corpus file.")
+parser.add_argument("--doc_store_path", type=str, default=None, help="Directory of the mmap doc store, built from the corpus on first launch.")
 parser.add_argument("--topk", type=int, default=3, help="Number of retrieved passages for one query.")
 parser.add_argument("--retriever_model", type=str, default="intfloat/e5-base-v2", help="Name of the retriever model.")
+parser.add_argument("--retrieval_method", type=str, default="e5", help="Dense retriever name (e5, bge, ...) or bm25 for a pyserini index.")
+parser.add_argument("--bm25_threads", type=int, default=8, help="Lucene threads of a batched bm25 search.")
+parser.add_argument("--bm25_index_path", type=str, default=None, help="Pyserini index of the same corpus, fuses bm25 with the dense results when set.")
+parser.add_argument("--fusion", type=str, default="rrf", choices=["rrf", "weighted"], help="Hybrid fusion: reciprocal rank fusion or weighted min-max normalised scores.")
+parser.add_argument("--rrf_k", type=int, default=60, help="Rank offset of reciprocal rank fusion.")
+parser.add_argument("--dense_weight", type=float, default=0.5, help="Weight of the dense scores in weighted fusion, bm25 gets the rest.")
+parser.add_argument("--dense_depth", type=int, default=50, help="Dense candidates per query fed to the fusion.")
+parser.add_argument("--bm25_depth", type=int, default=50, help="Bm25 candidates per query fed to the fusion.")
+parser.add_argument("--faiss_cpu", action="store_true", default=False, help="Serve the index from cpu memory, e.g. compressed IVF-PQ / HNSW / SQ8 indexes.")
+parser.add_argument("--batch_window_ms", type=float, default=5.0, help="How long to wait for concurrent requests before running a merged batch.")
+parser.add_argument("--max_batch_size", type=int, default=512, help="Maximum number of queries merged into one retrieval batch.")
+parser.add_argument("--cache_size", type=int, default=100000, help="Number of cached queries (embeddings and top-k results), 0 to disable.")
+parser.add_argument("--cache_ttl", type=float, default=None, help="Seconds a cached query stays valid, unlimited by default.")
+parser.add_argument("--token_store_path", type=str, nargs="*", default=[], help="Pre-tokenized passage stores (token_store.py), returned as token ids to requests naming their tokenizer.")
+parser.add_argument("--cache_db_path", type=str, default=None, help="SQLite file backing the result cache across runs, requires --cache_size > 0.")
+parser.add_argument("--workers", type=int, default=1, help="Server processes, each with its own encoder replica and a view of the same index and doc store.")
+parser.add_argument("--faiss_mmap", action="store_true", default=False, help="Memory-map the (cpu) index read-only, shared by all workers. Flat and HNSW indexes need a faiss with IO_FLAG_MMAP_IFC, older ones only map IVF lists. Implied by --workers > 1 with --faiss_cpu.")
+parser.add_argument("--shard_id", type=int, default=None, help="Serve only this shard of a sharded index on /search_emb, for a coordinator.")
+parser.add_argument("--shard_urls", type=str, nargs="*", default=[], help="Coordinator mode: search the index on these shard servers instead of loading it.")
+parser.add_argument("--launch_local_shards", action="store_true", default=False, help="Coordinator mode with one local shard server process per shard of --index_path.")
+parser.add_argument("--shard_base_port", type=int, default=None, help="First port of the local shard servers, --port + 1 by default.")
+parser.add_argument("--shard_timeout", type=float, default=30.0, help="Seconds per shard request.")
+parser.add_argument("--health_interval", type=float, default=10.0, help="Seconds between health checks of the shards.")
+parser.add_argument("--host", type=str, default="0.0.0.0")
+parser.add_argument("--port", type=int, default=28706)
 
 args = parser.parse_args()
-
-def load_corpus(corpus_path: str):
+if args.workers > 1 and args.faiss_cpu and args.retrieval_method != "bm25" and not (args.shard_urls or args.launch_local_shards) \
+        and not can_mmap_codes() and "IVF" not in load_index_meta(args.index_path).get("faiss_type", ""):
+    # without IO_FLAG_MMAP_IFC only IVF lists are mapped, every worker would load its own copy of the index
+    parser.error("--workers > 1 shares the index by mmap, flat and HNSW indexes need a faiss with IO_FLAG_MMAP_IFC")
+
+def load_corpus(corpus_path: str, doc_store_path: str = None):
+    if doc_store_path:
+        return DocStore.open_or_build(corpus_path, doc_store_path)
     corpus = datasets.load_dataset(
         'json', 
         data_files=corpus_path,
@@ -41,6 +89,8 @@ def read_jsonl(file_path):
     return data
 
 def load_docs(corpus, doc_idxs):
+    if isinstance(corpus, DocStore):
+        return corpus.get_many(doc_idxs)
     results = [corpus[int(idx)] for idx in doc_idxs]
     return results
 
@@ -139,6 +189,17 @@ class BaseRetriever:
         
         self.index_path = config.index_path
         self.corpus_path = config.corpus_path
+        self.doc_store_path = config.doc_store_path
+        # pre-tokenized passages keyed by tokenizer name, see token_store.py
+        self.token_stores = open_token_stores(config.token_store_paths)
+
+    def _attach_doc_ids(self, results: List[List[Dict]], doc_idxs):
+        """Attach the corpus row and the (mmap) passage ids of every token store to the documents of a batch, given their corpus rows."""
+        for docs, idxs in zip(results, doc_idxs):
+            for doc, idx in zip(docs, idxs):
+                doc['doc_idx'] = int(idx)
+                if self.token_stores:
+                    doc['token_ids'] = {name: store[int(idx)] for name, store in self.token_stores.items()}
 
     def _search(self, query: str, num: int, return_score: bool):
         raise NotImplementedError
@@ -149,18 +210,23 @@ class BaseRetriever:
     def search(self, query: str, num: int = None, return_score: bool = False):
         return self._search(query, num, return_score)
     
-    def batch_search(self, query_list: List[str], num: int = None, return_score: bool = False):
+    def batch_search(self, query_list: List[str], num: int = None, return_score: bool = False, search_params: Dict = None):
+        self._set_search_params(search_params)
         return self._batch_search(query_list, num, return_score)
 
+    def _set_search_params(self, search_params: Dict = None):
+        # only indexes with query-time parameters (IVF nprobe / HNSW efSearch) use them
+        pass
+
 class BM25Retriever(BaseRetriever):
-    def __init__(self, config):
+    def __init__(self, config, corpus=None):
         super().__init__(config)
         from pyserini.search.lucene import LuceneSearcher
         self.searcher = LuceneSearcher(self.index_path)
         self.contain_doc = self._check_contain_doc()
         if not self.contain_doc:
-            self.corpus = load_corpus(self.corpus_path)
-        self.max_process_num = 8
+            self.corpus = corpus if corpus is not None else load_corpus(self.corpus_path, self.doc_store_path)
+        self.max_process_num = config.bm25_threads
     
     def _check_contain_doc(self):
         return self.searcher.doc(0).raw() is not None
@@ -180,34 +246,62 @@ class BM25Retriever(BaseRetriever):
         else:
             hits = hits[:num]
 
-        if self.contain_doc:
-            all_contents = [
-                json.loads(self.searcher.doc(hit.docid).raw())['contents'] 
-                for hit in hits
-            ]
-            results = [
-                {
-                    'title': content.split("\n")[0].strip("\""),
-                    'text': "\n".join(content.split("\n")[1:]),
-                    'contents': content
-                } 
-                for content in all_contents
-            ]
-        else:
-            results = load_docs(self.corpus, [hit.docid for hit in hits])
+        results = self._load_hits([[hit.docid for hit in hits]])[0]
 
         if return_score:
             return results, scores
         else:
             return results
 
+    def _batch_search_ids(self, query_list: List[str], num: int):
+        r"""Return the hit scores and docids of each query.
+
+        Distinct queries are searched once, with pyserini's batch search running
+        `max_process_num` lucene threads.
+        """
+        unique_queries = list(dict.fromkeys(query_list))
+        qids = [str(i) for i in range(len(unique_queries))]
+        batch_hits = self.searcher.batch_search(unique_queries, qids, k=num, threads=self.max_process_num)
+        query_hits = {query: batch_hits[qid][:num] for query, qid in zip(unique_queries, qids)}
+        if any(len(hits) < num for hits in query_hits.values()):
+            warnings.warn('Not enough documents retrieved!')
+
+        scores = [[hit.score for hit in query_hits[query]] for query in query_list]
+        docids = [[hit.docid for hit in query_hits[query]] for query in query_list]
+        return scores, docids
+
+    def _load_hits(self, docids: List[List[str]]):
+        r"""Fetch the documents of a batch of hit lists, each distinct document once."""
+        unique_docids = list(dict.fromkeys(docid for row in docids for docid in row))
+        if self.contain_doc:
+            docs = {
+                docid: self._doc_from_contents(json.loads(self.searcher.doc(docid).raw())['contents'])
+                for docid in unique_docids
+            }
+        else:
+            # a single lookup for the whole batch, vectorized when the corpus is a doc store
+            docs = dict(zip(unique_docids, load_docs(self.corpus, unique_docids)))
+        return [[docs[docid] for docid in row] for row in docids]
+
+    @staticmethod
+    def _doc_from_contents(content: str):
+        return {
+            'title': content.split("\n")[0].strip("\""),
+            'text': "\n".join(content.split("\n")[1:]),
+            'contents': content
+        }
+
     def _batch_search(self, query_list: List[str], num: int = None, return_score: bool = False):
-        results = []
-        scores = []
-        for query in query_list:
-            item_result, item_score = self._search(query, num, True)
-            results.append(item_result)
-            scores.append(item_score)
+        if isinstance(query_list, str):
+            query_list = [query_list]
+        if num is None:
+            num = self.topk
+
+        scores, docids = self._batch_search_ids(query_list, num)
+        results = self._load_hits(docids)
+        if not self.contain_doc:
+            # only an index of the corpus rows has them as docids, stored documents keep their own ids
+            self._attach_doc_ids(results, docids)
         if return_score:
             return results, scores
         else:
@@ -216,14 +310,17 @@ class BM25Retriever(BaseRetriever):
 class DenseRetriever(BaseRetriever):
     def __init__(self, config):
         super().__init__(config)
-        self.index = faiss.read_index(self.index_path)
-        if config.faiss_gpu:
-            co = faiss.GpuMultipleClonerOptions()
-            co.useFloat16 = True
-            co.shard = True
-            self.index = faiss.index_cpu_to_all_gpus(self.index, co=co)
+        if config.shard_urls:
+            # coordinator: the shard servers hold the index and apply its default search params
+            self.index = RemoteShardIndex(config.shard_urls, timeout=config.shard_timeout,
+                                          health_interval=config.health_interval)
+            self.default_search_params = dict(self.index.default_search_params)
+        else:
+            self._load_index(config)
+        self.search_params = dict(self.default_search_params)
+        self.search_variant = ""
 
-        self.corpus = load_corpus(self.corpus_path)
+        self.corpus = load_corpus(self.corpus_path, self.doc_store_path)
         self.encoder = Encoder(
             model_name = self.retrieval_method,
             model_path = config.retrieval_model_path,
@@ -234,6 +331,81 @@ class DenseRetriever(BaseRetriever):
         self.topk = config.retrieval_topk
         self.batch_size = config.retrieval_batch_size
 
+        # caches are keyed by (normalised query, [topk, search params,] retriever)
+        index_name = ",".join(config.shard_urls) if config.shard_urls else os.path.abspath(self.index_path)
+        self.cache_namespace = f"{self.retrieval_method}:{index_name}"
+        self.cache_store = None
+        if config.cache_size > 0:
+            self.emb_cache = RetrievalCache(config.cache_size, ttl=config.cache_ttl)
+            self.result_cache = RetrievalCache(config.cache_size, ttl=config.cache_ttl)
+            if config.cache_db_path:
+                # persisted rows are the results of the default search params, which the index meta can change
+                extra = (self.retrieval_method, config.retrieval_model_path, json.dumps(self.default_search_params, sort_keys=True))
+                if isinstance(self.index, RemoteShardIndex):
+                    # the coordinator has no index file, the shards describe theirs on /health
+                    fingerprint = fingerprint_of(self.index.layout_fingerprint(), *extra)
+                else:
+                    fingerprint = index_fingerprint(resolve_index_path(self.index_path), *extra)
+                self.cache_store = PersistentCacheStore(config.cache_db_path, fingerprint)
+                self._warm_load_cache()
+        else:
+            self.emb_cache = None
+            self.result_cache = None
+
+    def _load_index(self, config):
+        self.index = read_index(self.index_path, mmap=config.faiss_mmap)
+        # query-time parameters saved by the index builder, overridable per request
+        index_meta = load_index_meta(self.index_path)
+        self.default_search_params = get_search_params(self.index)
+        for key in self.default_search_params:
+            if index_meta.get(key) is not None:
+                self.default_search_params[key] = index_meta[key]
+        # HNSW indexes have no gpu implementation, sharded indexes are searched on cpu by one thread per shard
+        if config.faiss_gpu and "HNSW" not in type(self.index).__name__ and not isinstance(self.index, faiss.IndexShards):
+            co = faiss.GpuMultipleClonerOptions()
+            co.useFloat16 = True
+            co.shard = True
+            self.index = faiss.index_cpu_to_all_gpus(self.index, co=co)
+        set_search_params(self.index, **self.default_search_params)
+
+    def shard_stats(self) -> List[Dict]:
+        return self.index.stats() if isinstance(self.index, RemoteShardIndex) else []
+
+    def _warm_load_cache(self):
+        entries = self.cache_store.load_recent(self.result_cache.capacity)
+        for query, num, scores, idxs, created in entries:
+            self.result_cache.put((query, num, self.cache_namespace, ""), (scores, idxs), timestamp=created)
+        print(f"Warm loaded {len(entries)} cached queries from {self.cache_store.db_path}")
+
+    def cache_stats(self) -> Dict:
+        if self.result_cache is None:
+            return {}
+        stats = {
+            "embedding_cache": self.emb_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
+        if self.cache_store is not None:
+            stats["persistent_cache"] = {"path": self.cache_store.db_path, "size": len(self.cache_store)}
+        return stats
+
+    def _set_search_params(self, search_params: Dict = None):
+        search_params = {
+            key: value if (search_params or {}).get(key) is None else search_params[key]
+            for key, value in self.default_search_params.items()
+        }
+        if search_params == self.search_params:
+            return
+        if isinstance(self.index, RemoteShardIndex):
+            # sent along with every shard request
+            self.index.search_params = search_params
+        else:
+            set_search_params(self.index, **search_params)
+        self.search_params = search_params
+        if search_params == self.default_search_params:
+            self.search_variant = ""
+        else:
+            self.search_variant = ",".join(f"{key}={value}" for key, value in search_params.items())
+
     def _search(self, query: str, num: int = None, return_score: bool = False):
         if num is None:
             num = self.topk
@@ -247,33 +419,180 @@ class DenseRetriever(BaseRetriever):
         else:
             return results
 
+    def _encode(self, query_list: List[str]) -> np.ndarray:
+        """Encode queries, running the encoder only on the ones missing from the embedding cache."""
+        if self.emb_cache is None:
+            return self.encoder.encode(query_list)
+
+        embs = [self.emb_cache.get((query, self.cache_namespace)) for query in query_list]
+        miss = [i for i, emb in enumerate(embs) if emb is None]
+        if len(miss) > 0:
+            miss_embs = self.encoder.encode([query_list[i] for i in miss])
+            for i, emb in zip(miss, miss_embs):
+                embs[i] = emb
+                self.emb_cache.put((query_list[i], self.cache_namespace), emb)
+        return np.stack(embs).astype(np.float32, copy=False)
+
+    def _batch_search_ids(self, query_list: List[str], num: int):
+        """
+        Return the (len(query_list), num) score and doc id matrices.
+        Only queries missing from the result cache are encoded and searched, and
+        duplicated queries inside one batch are searched once.
+        """
+        batch_scores = np.zeros((len(query_list), num), dtype=np.float32)
+        batch_idxs = np.full((len(query_list), num), -1, dtype=np.int64)
+
+        pending = {}
+        for i, query in enumerate(query_list):
+            if self.result_cache is not None:
+                query = normalize_query(query)
+                hit = self.result_cache.get((query, num, self.cache_namespace, self.search_variant))
+                if hit is not None:
+                    batch_scores[i], batch_idxs[i] = hit
+                    continue
+            pending.setdefault(query, []).append(i)
+
+        # only results of the default search params are persisted
+        use_cache_store = self.cache_store is not None and self.search_variant == ""
+        if use_cache_store and len(pending) > 0:
+            for query, (score, idx) in self.cache_store.get_many(list(pending.keys()), num).items():
+                rows = pending.pop(query)
+                batch_scores[rows] = score
+                batch_idxs[rows] = idx
+                self.result_cache.put((query, num, self.cache_namespace, self.search_variant), (score, idx))
+
+        miss_queries = list(pending.keys())
+        for start_idx in tqdm(range(0, len(miss_queries), self.batch_size), desc='Retrieval process: '):
+            query_batch = miss_queries[start_idx:start_idx + self.batch_size]
+            batch_emb = self._encode(query_batch)
+            if isinstance(self.index, RemoteShardIndex):
+                # results missing the hits of failed shards are returned, but never cached
+                scores, idxs, complete = self.index.search_partial(batch_emb, k=num)
+            else:
+                scores, idxs = self.index.search(batch_emb, k=num)
+                complete = True
+            for query, score, idx in zip(query_batch, scores, idxs):
+                batch_scores[pending[query]] = score
+                batch_idxs[pending[query]] = idx
+                if self.result_cache is not None and complete:
+                    self.result_cache.put((query, num, self.cache_namespace, self.search_variant), (score.copy(), idx.copy()))
+            if use_cache_store and complete:
+                self.cache_store.put_many([
+                    (query, num, score, idx) for query, score, idx in zip(query_batch, scores, idxs)
+                ])
+
+            del batch_emb, scores, idxs, query_batch
+            torch.cuda.empty_cache()
+
+        return batch_scores, batch_idxs
+
     def _batch_search(self, query_list: List[str], num: int = None, return_score: bool = False):
         if isinstance(query_list, str):
             query_list = [query_list]
         if num is None:
             num = self.topk
-        
-        results = []
-        scores = []
-        for start_idx in tqdm(range(0, len(query_list), self.batch_size), desc='Retrieval process: '):
-            query_batch = query_list[start_idx:start_idx + self.batch_size]
-            batch_emb = self.encoder.encode(query_batch)
-            batch_scores, batch_idxs = self.index.search(batch_emb, k=num)
-            batch_scores = batch_scores.tolist()
-            batch_idxs = batch_idxs.tolist()
 
+        batch_scores, batch_idxs = self._batch_search_ids(query_list, num)
+
+        if isinstance(self.corpus, DocStore):
+            # the doc store fetches the whole (batch, topk) id matrix in one call
+            results = self.corpus.get_many(batch_idxs)
+        else:
             # load_docs is not vectorized, but is a python list approach
-            flat_idxs = sum(batch_idxs, [])
-            batch_results = load_docs(self.corpus, flat_idxs)
+            flat_idxs = batch_idxs.reshape(-1).tolist()
+            results = load_docs(self.corpus, flat_idxs)
             # chunk them back
-            batch_results = [batch_results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
-            
-            results.extend(batch_results)
-            scores.extend(batch_scores)
-            
-            del batch_emb, batch_scores, batch_idxs, query_batch, flat_idxs, batch_results
-            torch.cuda.empty_cache()
-            
+            results = [results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
+        self._attach_doc_ids(results, batch_idxs)
+        scores = batch_scores.tolist()
+
+        if return_score:
+            return results, scores
+        else:
+            return results
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses dense and bm25 results, e.g. with reciprocal rank fusion.
+    Both sides search `dense_depth` / `bm25_depth` candidates in parallel threads,
+    so the latency stays close to the slower of the two, and share the dense
+    retriever's corpus (bm25 docids are corpus row ids).
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.dense = DenseRetriever(config)
+        bm25_config = copy.copy(config)
+        bm25_config.index_path = config.bm25_index_path
+        self.bm25 = BM25Retriever(bm25_config, corpus=self.dense.corpus)
+        self.corpus = self.dense.corpus
+
+        self.fusion = config.fusion
+        self.rrf_k = config.rrf_k
+        self.dense_weight = config.dense_weight
+        self.dense_depth = config.dense_depth
+        self.bm25_depth = config.bm25_depth
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+    def cache_stats(self) -> Dict:
+        return self.dense.cache_stats()
+
+    def shard_stats(self) -> List[Dict]:
+        return self.dense.shard_stats()
+
+    def _set_search_params(self, search_params: Dict = None):
+        self.dense._set_search_params(search_params)
+
+    def _fuse(self, dense_scores, dense_idxs, bm25_scores, bm25_idxs, num: int):
+        """Return the fused top-`num` (scores, doc ids) of one query."""
+        fused = {}
+        for weight, scores, idxs in ((self.dense_weight, dense_scores, dense_idxs),
+                                     (1 - self.dense_weight, bm25_scores, bm25_idxs)):
+            if len(idxs) == 0:
+                continue
+            if self.fusion == "rrf":
+                contributions = [1.0 / (self.rrf_k + rank + 1) for rank in range(len(idxs))]
+            else:
+                # min-max normalise, raw bm25 and inner product scores are not comparable
+                low, high = min(scores), max(scores)
+                contributions = [weight * ((score - low) / (high - low) if high > low else 1.0) for score in scores]
+            for idx, contribution in zip(idxs, contributions):
+                fused[idx] = fused.get(idx, 0.0) + contribution
+        top = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:num]
+        return [score for _, score in top], [idx for idx, _ in top]
+
+    def _batch_search(self, query_list: List[str], num: int = None, return_score: bool = False):
+        if isinstance(query_list, str):
+            query_list = [query_list]
+        if num is None:
+            num = self.topk
+
+        dense_future = self.executor.submit(self.dense._batch_search_ids, query_list, max(num, self.dense_depth))
+        bm25_future = self.executor.submit(self.bm25._batch_search_ids, query_list, max(num, self.bm25_depth))
+        dense_scores, dense_idxs = dense_future.result()
+        bm25_scores, bm25_docids = bm25_future.result()
+
+        scores = []
+        doc_idxs = []
+        for i in range(len(query_list)):
+            # faiss pads missing hits with -1
+            valid = dense_idxs[i] >= 0
+            query_scores, query_idxs = self._fuse(
+                dense_scores[i][valid].tolist(), dense_idxs[i][valid].tolist(),
+                bm25_scores[i], [int(docid) for docid in bm25_docids[i]],
+                num
+            )
+            scores.append(query_scores)
+            doc_idxs.append(query_idxs)
+
+        # one lookup for the whole batch, then split per query
+        flat_results = load_docs(self.corpus, [idx for query_idxs in doc_idxs for idx in query_idxs])
+        results = []
+        start = 0
+        for query_idxs in doc_idxs:
+            results.append(flat_results[start:start + len(query_idxs)])
+            start += len(query_idxs)
+        self._attach_doc_ids(results, doc_idxs)
+
         if return_score:
             return results, scores
         else:
@@ -282,6 +601,8 @@ class DenseRetriever(BaseRetriever):
 def get_retriever(config):
     if config.retrieval_method == "bm25":
         return BM25Retriever(config)
+    elif config.bm25_index_path:
+        return HybridRetriever(config)
     else:
         return DenseRetriever(config)
 
@@ -301,33 +622,157 @@ class Config:
         retrieval_topk: int = 10,
         index_path: str = "./index/bm25",
         corpus_path: str = "./data/corpus.jsonl",
+        doc_store_path: str = None,
         dataset_path: str = "./data",
         data_split: str = "train",
         faiss_gpu: bool = True,
+        faiss_mmap: bool = False,
         retrieval_model_path: str = "./model",
         retrieval_pooling_method: str = "mean",
         retrieval_query_max_length: int = 256,
         retrieval_use_fp16: bool = False,
-        retrieval_batch_size: int = 128
+        retrieval_batch_size: int = 128,
+        cache_size: int = 0,
+        cache_ttl: float = None,
+        cache_db_path: str = None,
+        bm25_threads: int = 8,
+        bm25_index_path: str = None,
+        fusion: str = "rrf",
+        rrf_k: int = 60,
+        dense_weight: float = 0.5,
+        dense_depth: int = 50,
+        bm25_depth: int = 50,
+        token_store_paths: List[str] = None,
+        shard_urls: List[str] = None,
+        shard_timeout: float = 30.0,
+        health_interval: float = 10.0
     ):
         self.retrieval_method = retrieval_method
         self.retrieval_topk = retrieval_topk
         self.index_path = index_path
         self.corpus_path = corpus_path
+        self.doc_store_path = doc_store_path
         self.dataset_path = dataset_path
         self.data_split = data_split
         self.faiss_gpu = faiss_gpu
+        self.faiss_mmap = faiss_mmap
         self.retrieval_model_path = retrieval_model_path
         self.retrieval_pooling_method = retrieval_pooling_method
         self.retrieval_query_max_length = retrieval_query_max_length
         self.retrieval_use_fp16 = retrieval_use_fp16
         self.retrieval_batch_size = retrieval_batch_size
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_db_path = cache_db_path
+        self.bm25_threads = bm25_threads
+        self.bm25_index_path = bm25_index_path
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.dense_weight = dense_weight
+        self.dense_depth = dense_depth
+        self.bm25_depth = bm25_depth
+        self.token_store_paths = token_store_paths or []
+        self.shard_urls = shard_urls or []
+        self.shard_timeout = shard_timeout
+        self.health_interval = health_interval
 
 
 class QueryRequest(BaseModel):
     queries: List[str]
     topk: Optional[int] = None
     return_scores: bool = False
+    # query-time parameters of compressed indexes, defaults come from the index meta
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    # return the passages' token ids of this tokenizer, if the server has a token store for it
+    tokenizer: Optional[str] = None
+    # documents only carry their corpus row ("doc_idx"), the listed fields and the token ids,
+    # or their contents if there are no token ids for the tokenizer
+    ids_only: bool = False
+    fields: Optional[List[str]] = None
+
+
+class QueryBatcher:
+    """
+    Coalesces the queries of concurrent /retrieve requests into one retriever call.
+    Requests are collected for at most `batch_window_ms` (or until `max_batch_size`
+    queries are pending), searched with a single encode + index.search, and the
+    results are scattered back to each caller.
+    """
+    def __init__(self, retriever, batch_window_ms: float = 5.0, max_batch_size: int = 512):
+        self.retriever = retriever
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        # the retriever is not thread safe, so all batches go through a single thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, queries: List[str], topk: int, search_params: Dict = None):
+        """Results and scores of the queries, and the time they waited for and spent in the search."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self.queue.put((queries, topk, search_params or {}, future, loop.time()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            num_queries = len(pending[0][0])
+            deadline = loop.time() + self.batch_window
+            while num_queries < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout <= 0:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                pending.append(item)
+                num_queries += len(item[0])
+            # requests with different search params cannot share an index.search call
+            groups = {}
+            for item in pending:
+                groups.setdefault(tuple(sorted(item[2].items())), []).append(item)
+            for group in groups.values():
+                await self._flush(group)
+
+    async def _flush(self, pending):
+        query_list = [query for queries, _, _, _, _ in pending for query in queries]
+        # search once with the largest topk and truncate per request, hits are sorted by score
+        num = max(topk for _, topk, _, _, _ in pending)
+        search_params = pending[0][2]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            results, scores = await loop.run_in_executor(
+                self.executor,
+                functools.partial(self.retriever.batch_search, query_list, num=num, return_score=True,
+                                  search_params=search_params)
+            )
+        except Exception as e:
+            for _, _, _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        search_time = loop.time() - start
+
+        offset = 0
+        for queries, topk, _, future, enqueued in pending:
+            end = offset + len(queries)
+            if not future.done():
+                future.set_result((
+                    [list(result[:topk]) for result in results[offset:end]],
+                    [list(score[:topk]) for score in scores[offset:end]],
+                    {"queue_s": start - enqueued, "search_s": search_time},
+                ))
+            offset = end
 
 
 app = FastAPI()
@@ -335,42 +780,113 @@ app = FastAPI()
 # 1) Build a config (could also parse from arguments).
 #    In real usage, you'd parse your CLI arguments or environment variables.
 config = Config(
-    retrieval_method = "e5",  # or "dense"
+    retrieval_method = args.retrieval_method,
     index_path=args.index_path,
     corpus_path=args.corpus_path,
+    doc_store_path=args.doc_store_path,
     retrieval_topk=args.topk,
-    faiss_gpu=True,
+    faiss_gpu=not args.faiss_cpu,
+    faiss_mmap=args.faiss_mmap or (args.workers > 1 and args.faiss_cpu),
     retrieval_model_path=args.retriever_model,
     retrieval_pooling_method="mean",
     retrieval_query_max_length=256,
     retrieval_use_fp16=True,
     retrieval_batch_size=512,
+    cache_size=args.cache_size,
+    cache_ttl=args.cache_ttl,
+    cache_db_path=args.cache_db_path,
+    bm25_threads=args.bm25_threads,
+    bm25_index_path=args.bm25_index_path,
+    fusion=args.fusion,
+    rrf_k=args.rrf_k,
+    dense_weight=args.dense_weight,
+    dense_depth=args.dense_depth,
+    bm25_depth=args.bm25_depth,
+    token_store_paths=args.token_store_path,
+    shard_urls=args.shard_urls,
+    shard_timeout=args.shard_timeout,
+    health_interval=args.health_interval,
 )
+shard_base_port = args.shard_base_port or args.port + 1
+if args.launch_local_shards:
+    config.shard_urls = local_shard_urls(args.index_path, shard_base_port)
+
+# 2) The retriever is loaded once per server process on startup and reused. It is not built at
+#    import, so the supervisor of a multi-worker server (which imports this module too) stays light.
+retriever = None
+batcher = None
+# shard server mode (--shard_id): one shard of the index, searched by a coordinator on /search_emb
+shard = None
+shard_executor = ThreadPoolExecutor(max_workers=1)
+
+
+@app.on_event("startup")
+async def start_batcher():
+    global retriever, batcher, shard
+    if args.shard_id is not None:
+        shard = IndexShard(args.index_path, args.shard_id, faiss_gpu=config.faiss_gpu, mmap=config.faiss_mmap)
+        return
+    if args.workers > 1:
+        # the workers search in parallel, so each gets its share of the cores
+        faiss.omp_set_num_threads(max(1, os.cpu_count() // args.workers))
+    retriever = get_retriever(config)
+    batcher = QueryBatcher(retriever, batch_window_ms=args.batch_window_ms, max_batch_size=args.max_batch_size)
+    batcher.start()
+
+
+def _output_doc(doc: Dict, name: Optional[str], ids_only: bool = False, fields: List[str] = None,
+                binary: bool = False) -> Dict:
+    """
+    Copy of a document as it is returned, documents may be shared between rows.
+    In binary responses the token ids are packed as little-endian int32 bytes.
+    """
+    token_ids = doc.get('token_ids', {})
+    if ids_only:
+        # documents of a BM25 index with stored contents have no corpus row
+        out = {'doc_idx': doc.get('doc_idx'), **{key: doc[key] for key in fields or [] if key in doc}}
+        if name not in token_ids:
+            out['contents'] = doc['contents']
+    else:
+        out = {key: value for key, value in doc.items() if key not in ('token_ids', 'doc_idx')}
+    if name in token_ids:
+        ids = token_ids[name]
+        out['token_ids'] = ids.astype('<i4').tobytes() if binary else ids.tolist()
+    return out
 
-# 2) Instantiate a global retriever so it is loaded once and reused.
-retriever = get_retriever(config)
 
 @app.post("/retrieve")
-def retrieve_endpoint(request: QueryRequest):
+async def retrieve_endpoint(request: QueryRequest, http_request: Request):
     """
     Endpoint that accepts queries and performs retrieval.
+    Queries from concurrent requests are merged into one batch by the QueryBatcher.
     Input format:
     {
       "queries": ["What is Python?", "Tell me about neural networks."],
       "topk": 3,
-      "return_scores": true
+      "return_scores": true,
+      "nprobe": 64,  # optional, IVF indexes only (ef_search for HNSW)
+      "tokenizer": "Qwen2.5-7B",  # optional, adds the "token_ids" of each document from the matching token store
+      "ids_only": true,  # optional, compact documents: "doc_idx", "token_ids" (or "contents") and the "fields"
+      "fields": ["url"]
     }
+    The response is msgpack instead of JSON if the request accepts application/msgpack
+    and msgpack is installed.
     """
     if not request.topk:
         request.topk = config.retrieval_topk  # fallback to default
 
+    search_params = {
+        key: value for key, value in (("nprobe", request.nprobe), ("ef_search", request.ef_search))
+        if value is not None
+    }
     # Perform batch retrieval
-    results, scores = retriever.batch_search(
-        query_list=request.queries,
-        num=request.topk,
-        return_score=request.return_scores
-    )
-    
+    results, scores, timing = await batcher.submit(request.queries, request.topk, search_params)
+
+    binary = msgpack is not None and MSGPACK_MEDIA_TYPE in http_request.headers.get("accept", "")
+    name = tokenizer_name(request.tokenizer) if request.tokenizer else None
+    results = [[_output_doc(doc, name, request.ids_only, request.fields, binary) for doc in single_result]
+               for single_result in results]
+
     # Format response
     resp = []
     for i, single_result in enumerate(results):
@@ -382,9 +898,64 @@ def retrieve_endpoint(request: QueryRequest):
             resp.append(combined)
         else:
             resp.append(single_result)
-    return {"result": resp}
+    if binary:
+        return Response(content=msgpack.packb({"result": resp, "timing": timing}, use_bin_type=True),
+                        media_type=MSGPACK_MEDIA_TYPE)
+    return {"result": resp, "timing": timing}
+
+
+@app.get("/stats")
+def stats_endpoint():
+    """
+    Cache hit/miss counters of the retriever, and the health and latency of each shard of a coordinator.
+    """
+    stats = retriever.cache_stats() if hasattr(retriever, "cache_stats") else {}
+    if hasattr(retriever, "shard_stats") and retriever.shard_stats():
+        stats = {**stats, "shards": retriever.shard_stats()}
+    return stats
+
+
+@app.post("/search_emb")
+async def search_emb_endpoint(http_request: Request):
+    """
+    Shard servers only: top-k scores and corpus row ids of a batch of query embeddings.
+    Input format (msgpack, embeddings as float32 bytes, or JSON, embeddings as lists):
+    {"embeddings": ..., "n": 512, "d": 768, "k": 3, "nprobe": 64}
+    """
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Not a shard server, start it with --shard_id")
+    binary = http_request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE)
+    if binary and msgpack is None:
+        raise HTTPException(status_code=415, detail="msgpack is not installed on this shard")
+    body = await http_request.body()
+    payload = msgpack.unpackb(body, raw=False) if binary else json.loads(body)
+    embs = decode_array(payload["embeddings"], np.float32, (payload["n"], payload["d"]))
+    search_params = {key: payload.get(key) for key in ("nprobe", "ef_search")}
+    scores, idxs = await asyncio.get_running_loop().run_in_executor(
+        shard_executor, shard.search, embs, payload["k"], search_params)
+    output = {"scores": encode_array(scores, binary), "ids": encode_array(idxs, binary), "k": scores.shape[1]}
+    if binary:
+        return Response(content=msgpack.packb(output, use_bin_type=True), media_type=MSGPACK_MEDIA_TYPE)
+    return output
+
+
+@app.get("/health")
+def health_endpoint():
+    """Liveness of the server, with the layout of the shard on shard servers."""
+    if shard is not None:
+        return shard.info()
+    return {"ready": retriever is not None}
 
 
 if __name__ == "__main__":
-    # 3) Launch the server. By default, it listens on http://127.0.0.1:8000
-    uvicorn.run(app, host="0.0.0.0", port=28706)
+    # 3) Launch the server. By default, it listens on http://0.0.0.0:28706
+    if args.launch_local_shards:
+        launch_local_shards(args.index_path, shard_base_port, faiss_gpu=config.faiss_gpu, mmap=config.faiss_mmap)
+    if args.workers > 1:
+        if config.faiss_gpu:
+            warnings.warn("Every worker copies the index to the gpus, use --faiss_cpu to share one mmap'd index.")
+        # workers are separate processes importing this module, they get the same command line
+        uvicorn.run(f"{os.path.splitext(os.path.basename(__file__))[0]}:app", host=args.host, port=args.port,
+                    workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
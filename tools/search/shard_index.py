@@ -0,0 +1,283 @@
+"""
+Scatter-gather search over the shards of a sharded index (`index_builder.py --index_shards`),
+each served by its own retrieval server process, possibly on another node.
+
+A shard server (`retrieval_server.py --shard_id i`) holds one shard file of the
+manifest and answers `/search_emb` with the top-k of a batch of query embeddings,
+ids already offset to corpus rows. The coordinator keeps the encoder and the doc
+store and uses a `RemoteShardIndex` in place of the faiss index: every batch is
+sent to all healthy shards concurrently and the per-shard top-k are merged by score.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import faiss
+import requests
+from requests.adapters import HTTPAdapter
+
+from faiss_utils import load_index_meta, load_index_shards, get_search_params, set_search_params, read_mmapped_index
+from retrieval_cache import index_fingerprint, fingerprint_of
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+
+def encode_array(array: np.ndarray, binary: bool):
+    r"""Arrays travel as raw bytes in msgpack bodies and as nested lists in JSON ones."""
+    return np.ascontiguousarray(array).tobytes() if binary else array.tolist()
+
+
+def decode_array(value, dtype, shape) -> np.ndarray:
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype=dtype).reshape(shape)
+    return np.asarray(value, dtype=dtype).reshape(shape)
+
+
+class IndexShard:
+    r"""One shard of a sharded index, searched with corpus-wide ids."""
+
+    def __init__(self, index_path: str, shard_id: int, faiss_gpu: bool = False, mmap: bool = False):
+        manifest = load_index_shards(index_path)
+        if manifest is None:
+            raise ValueError(f"{index_path} has no shards manifest, build it with --index_shards")
+        shard = manifest["shards"][shard_id]
+        self.shard_id = shard_id
+        self.num_shards = len(manifest["shards"])
+        self.id_offset = shard["id_offset"]
+        shard_path = os.path.join(os.path.dirname(index_path), shard["path"])
+        self.index = read_mmapped_index(shard_path) if mmap else faiss.read_index(shard_path)
+        # changes when the shard file is rebuilt, for the persistent cache of the coordinator
+        self.fingerprint = index_fingerprint(shard_path)
+
+        self.default_search_params = get_search_params(self.index)
+        index_meta = load_index_meta(index_path)
+        for key in self.default_search_params:
+            if index_meta.get(key) is not None:
+                self.default_search_params[key] = index_meta[key]
+        if faiss_gpu and "HNSW" not in type(self.index).__name__:
+            co = faiss.GpuMultipleClonerOptions()
+            co.useFloat16 = True
+            co.shard = True
+            self.index = faiss.index_cpu_to_all_gpus(self.index, co=co)
+        set_search_params(self.index, **self.default_search_params)
+        self.search_params = dict(self.default_search_params)
+
+    def info(self) -> Dict:
+        return {
+            "shard_id": self.shard_id,
+            "num_shards": self.num_shards,
+            "id_offset": self.id_offset,
+            "ntotal": self.index.ntotal,
+            "d": self.index.d,
+            "metric_type": int(self.index.metric_type),
+            "search_params": self.default_search_params,
+            "fingerprint": self.fingerprint,
+        }
+
+    def search(self, embs: np.ndarray, k: int, search_params: Dict = None):
+        search_params = {
+            key: value if (search_params or {}).get(key) is None else search_params[key]
+            for key, value in self.default_search_params.items()
+        }
+        if search_params != self.search_params:
+            set_search_params(self.index, **search_params)
+            self.search_params = search_params
+        scores, idxs = self.index.search(embs, k)
+        # -1 marks missing hits, e.g. of a shard smaller than k
+        idxs = np.where(idxs >= 0, idxs + self.id_offset, -1)
+        return scores, idxs
+
+
+class RemoteShardIndex:
+    r"""
+    Stand-in for a faiss index whose shards are served by shard servers.
+    Shards are health-checked on creation and every `health_interval` seconds,
+    unhealthy ones are left out of the fan-out until they answer again. Results
+    then miss the hits of those shards, `search_partial` tells them apart.
+    Per-shard latencies and errors are kept for /stats. The shard states are
+    shared by the health thread and the request threads and guarded by a lock.
+    """
+
+    def __init__(self, shard_urls: List[str], timeout: float = 30.0, health_interval: float = 10.0,
+                 startup_timeout: float = 600.0):
+        self.timeout = timeout
+        self.binary = msgpack is not None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(shard_urls), pool_maxsize=len(shard_urls))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=len(shard_urls))
+        self.shards = [{
+            "url": url.rstrip("/"), "healthy": False, "info": None,
+            "requests": 0, "errors": 0, "last_latency_s": None, "total_latency_s": 0.0,
+        } for url in shard_urls]
+        self._lock = threading.Lock()
+        self.search_params = {}
+
+        # shard servers started alongside the coordinator may still be loading their index
+        deadline = time.time() + startup_timeout
+        while not self.check_health():
+            if time.time() > deadline:
+                raise RuntimeError(f"Retrieval shards not healthy: {[s['url'] for s in self.shards if not s['healthy']]}")
+            time.sleep(5)
+        info = self.shards[0]["info"]
+        self.d = info["d"]
+        self.metric_type = info["metric_type"]
+        self.ntotal = info["ntotal"] if len(self.shards) == 1 else None
+        self.default_search_params = info["search_params"]
+
+        self._health_thread = threading.Thread(target=self._health_loop, args=(health_interval,), daemon=True)
+        self._health_thread.start()
+
+    def layout_fingerprint(self) -> str:
+        r"""Identify the served index by the layout, default search params and files of its shards."""
+        with self._lock:
+            infos = [dict(shard["info"]) for shard in self.shards]
+        keys = ("shard_id", "num_shards", "id_offset", "ntotal", "search_params", "fingerprint")
+        return fingerprint_of(*(json.dumps({key: info.get(key) for key in keys}, sort_keys=True) for info in infos))
+
+    def check_health(self) -> bool:
+        r"""Refresh the health of every shard, True if all of them answer."""
+        for shard in self.shards:
+            try:
+                response = self.session.get(f"{shard['url']}/health", timeout=self.timeout)
+                response.raise_for_status()
+                info = response.json()
+            except Exception as e:
+                with self._lock:
+                    was_healthy = shard["healthy"]
+                    shard["healthy"] = False
+                if was_healthy:
+                    print(f"[RemoteShardIndex] Shard {shard['url']} unhealthy: {e}")
+                continue
+            with self._lock:
+                shard["info"] = info
+                shard["healthy"] = True
+        with self._lock:
+            return all(shard["healthy"] for shard in self.shards)
+
+    def _health_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.check_health()
+
+    def _search_shard(self, shard: Dict, embs: np.ndarray, k: int):
+        payload = {"embeddings": encode_array(embs, self.binary), "n": embs.shape[0], "d": embs.shape[1], "k": k,
+                   **{key: value for key, value in self.search_params.items() if value is not None}}
+        start = time.perf_counter()
+        try:
+            if self.binary:
+                response = self.session.post(f"{shard['url']}/search_emb", data=msgpack.packb(payload, use_bin_type=True),
+                                             headers={"Content-Type": MSGPACK_MEDIA_TYPE}, timeout=self.timeout)
+                response.raise_for_status()
+                output = msgpack.unpackb(response.content, raw=False)
+            else:
+                response = self.session.post(f"{shard['url']}/search_emb", json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                output = response.json()
+        except Exception:
+            with self._lock:
+                shard["errors"] += 1
+                shard["healthy"] = False
+            raise
+        latency = time.perf_counter() - start
+        with self._lock:
+            shard["requests"] += 1
+            shard["last_latency_s"] = latency
+            shard["total_latency_s"] += latency
+        shape = (embs.shape[0], output["k"])
+        return decode_array(output["scores"], np.float32, shape), decode_array(output["ids"], np.int64, shape)
+
+    def search(self, embs: np.ndarray, k: int):
+        r"""Global top-`k` scores and ids, merged from the top-`k` of every healthy shard."""
+        scores, idxs, _ = self.search_partial(embs, k)
+        return scores, idxs
+
+    def search_partial(self, embs: np.ndarray, k: int):
+        r"""`search`, plus whether every shard answered. Without all of them the top-`k` is degraded."""
+        embs = np.ascontiguousarray(embs, dtype=np.float32)
+        with self._lock:
+            shards = [shard for shard in self.shards if shard["healthy"]]
+        if not shards:
+            raise RuntimeError("No healthy retrieval shard")
+        futures = [(shard, self.executor.submit(self._search_shard, shard, embs, k)) for shard in shards]
+        all_scores, all_idxs = [], []
+        for shard, future in futures:
+            try:
+                scores, idxs = future.result()
+            except Exception as e:
+                print(f"[RemoteShardIndex] Search on {shard['url']} failed: {e}")
+                continue
+            all_scores.append(scores)
+            all_idxs.append(idxs)
+        if not all_scores:
+            raise RuntimeError("Search failed on all retrieval shards")
+
+        scores = np.concatenate(all_scores, axis=1)
+        idxs = np.concatenate(all_idxs, axis=1)
+        # inner product ranks high scores first, l2 distances low ones
+        keys = -scores if self.metric_type == faiss.METRIC_INNER_PRODUCT else scores
+        order = np.argsort(keys, axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(scores, order, axis=1)
+        idxs = np.take_along_axis(idxs, order, axis=1)
+        if scores.shape[1] < k:
+            pad = k - scores.shape[1]
+            scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=0)
+            idxs = np.pad(idxs, ((0, 0), (0, pad)), constant_values=-1)
+        complete = len(all_scores) == len(self.shards)
+        if not complete:
+            print(f"[RemoteShardIndex] Degraded search, {len(all_scores)} of {len(self.shards)} shards answered")
+        return scores, idxs, complete
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [{
+                "url": shard["url"],
+                "healthy": shard["healthy"],
+                "requests": shard["requests"],
+                "errors": shard["errors"],
+                "last_latency_s": shard["last_latency_s"],
+                "mean_latency_s": shard["total_latency_s"] / shard["requests"] if shard["requests"] else None,
+            } for shard in self.shards]
+
+
+def local_shard_urls(index_path: str, base_port: int) -> List[str]:
+    r"""Urls of the shard servers `launch_local_shards` starts, one port per shard from `base_port`."""
+    manifest = load_index_shards(index_path)
+    if manifest is None:
+        raise ValueError(f"{index_path} has no shards manifest, build it with --index_shards")
+    return [f"http://127.0.0.1:{base_port + shard_id}" for shard_id in range(len(manifest["shards"]))]
+
+
+def launch_local_shards(index_path: str, base_port: int, faiss_gpu: bool = False, mmap: bool = False):
+    r"""
+    Start one shard server process per shard of `index_path` on this machine, see
+    `local_shard_urls`. The processes are terminated when the coordinator exits.
+    """
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "retrieval_server.py")
+    processes = []
+    for shard_id in range(len(local_shard_urls(index_path, base_port))):
+        cmd = [sys.executable, server, "--index_path", index_path, "--shard_id", str(shard_id),
+               "--port", str(base_port + shard_id)]
+        if not faiss_gpu:
+            cmd.append("--faiss_cpu")
+        if mmap:
+            cmd.append("--faiss_mmap")
+        processes.append(subprocess.Popen(cmd))
+
+    def terminate():
+        for process in processes:
+            process.terminate()
+    atexit.register(terminate)
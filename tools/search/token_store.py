@@ -0,0 +1,127 @@
+"""
+Pre-tokenized passage store for the retrieval corpus.
+
+The passages of the corpus are tokenized once with the tokenizer of the policy
+model, and the ids are stored as one contiguous int32 blob (`ids.bin`) plus an
+int64 offsets array (`offsets.npy`), memory-mapped when served. Each passage is
+tokenized as it appears in an evidence block of the rollout, i.e. after the rank
+prefix ("Doc 1") with a leading space, so the rollout can concatenate the ids
+instead of tokenizing the same passages again every turn.
+"""
+import os
+import json
+import argparse
+from typing import List, Dict
+
+import numpy as np
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from doc_store import DocStore, _corpus_fingerprint
+
+
+META_FILE = "meta.json"
+
+
+def tokenizer_name(name_or_path: str) -> str:
+    r"""Name a tokenizer is matched by, the same model loaded from the hub or a local copy shares it."""
+    return os.path.basename(name_or_path.rstrip("/"))
+
+
+def _iter_contents(corpus_path: str, doc_store_path: str = None, field: str = "contents", chunk_size: int = 10000):
+    if doc_store_path:
+        store = DocStore.open_or_build(corpus_path, doc_store_path)
+        for start in range(0, len(store), chunk_size):
+            yield store.get_column(field, np.arange(start, min(start + chunk_size, len(store))))
+        return
+    chunk = []
+    with open(corpus_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(json.loads(line).get(field) or "")
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_token_store(corpus_path: str, tokenizer_path: str, store_dir: str,
+                      doc_store_path: str = None, field: str = "contents"):
+    r"""Tokenize the `field` of every corpus document with `tokenizer_path` into a token store under `store_dir`."""
+    os.makedirs(store_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True, trust_remote_code=True)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(os.path.join(store_dir, "ids.bin"), "wb") as f:
+        for contents in tqdm(_iter_contents(corpus_path, doc_store_path, field), desc="Building token store"):
+            encoded = tokenizer([f" {content}" for content in contents], add_special_tokens=False)["input_ids"]
+            lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+            f.write(np.fromiter((i for ids in encoded for i in ids), dtype=np.int32, count=int(lengths.sum())).tobytes())
+            offsets.append(position + np.cumsum(lengths))
+            position += int(lengths.sum())
+    offsets = np.concatenate(offsets)
+    np.save(os.path.join(store_dir, "offsets.npy"), offsets)
+
+    meta = {
+        "num_docs": len(offsets) - 1,
+        "field": field,
+        "tokenizer": tokenizer_name(tokenizer_path),
+        "vocab_size": len(tokenizer),
+        "source": _corpus_fingerprint(corpus_path),
+    }
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+class TokenStore:
+    r"""Read-only, mmap-backed view over a token store built by `build_token_store`."""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.num_docs = self.meta["num_docs"]
+        self.tokenizer = self.meta["tokenizer"]
+        self._offsets = np.load(os.path.join(store_dir, "offsets.npy"), mmap_mode="r")
+        ids_path = os.path.join(store_dir, "ids.bin")
+        if os.path.getsize(ids_path) > 0:
+            self._ids = np.memmap(ids_path, dtype=np.int32, mode="r")
+        else:
+            self._ids = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            # -1 pads missing faiss hits, which have no passage
+            return self._ids[:0]
+        return self._ids[self._offsets[idx]:self._offsets[idx + 1]]
+
+
+def open_token_stores(store_dirs: List[str]) -> Dict[str, TokenStore]:
+    r"""Open the token stores, keyed by the name of their tokenizer."""
+    stores = {}
+    for store_dir in store_dirs or []:
+        store = TokenStore(store_dir)
+        stores[store.tokenizer] = store
+    return stores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a pre-tokenized passage store from a corpus jsonl.")
+    parser.add_argument("--corpus_path", type=str, required=True, help="Local corpus file.")
+    parser.add_argument("--doc_store_path", type=str, default=None, help="Read the passages from this doc store instead of the jsonl.")
+    parser.add_argument("--tokenizer", type=str, required=True, help="Tokenizer (path) of the policy model.")
+    parser.add_argument("--save_dir", type=str, required=True, help="Directory to write the token store to.")
+    parser.add_argument("--field", type=str, default="contents", help="Document field that is tokenized.")
+    args = parser.parse_args()
+
+    build_token_store(args.corpus_path, args.tokenizer, args.save_dir, doc_store_path=args.doc_store_path, field=args.field)
+    print("Finish!")
+
+
+if __name__ == "__main__":
+    main()
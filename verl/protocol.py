@@ -63,6 +63,47 @@ def unpad_dataproto(data: 'DataProto', pad_size):
     return data
 
 
+# bool batch key marking the placeholder rows added by `ragged_pad_dataproto`
+RAGGED_PADDING_KEY = 'ragged_padding'
+
+
+def ragged_pad_dataproto(data: 'DataProto', size_divisor: int):
+    """Pad a DataProto to size divisible by size_divisor with placeholder rows marked in RAGGED_PADDING_KEY.
+
+    The placeholder rows are appended at the end, so after an even chunking the real rows fill the
+    first chunks and the last ranks only receive placeholders, which workers may skip (e.g. the vLLM
+    rollout does not generate them). `unpad_ragged_dataproto` drops them again.
+
+    Args:
+        size_divisor (int): size divisor
+
+    Returns:
+        data: (DataProto): the padded DataProto
+    """
+    assert isinstance(data, DataProto), 'data must be a DataProto'
+    pad_size = -len(data) % size_divisor
+    if pad_size == 0:
+        return data
+    padding = torch.zeros(len(data) + pad_size, dtype=torch.bool)
+    padding[len(data):] = True
+    data = DataProto.concat([data] + [data[:1]] * pad_size)
+    data.batch[RAGGED_PADDING_KEY] = padding if data.batch.device is None else padding.to(data.batch.device)
+    return data
+
+
+def unpad_ragged_dataproto(data: 'DataProto') -> 'DataProto':
+    """Drop the placeholder rows (and the marker) of a DataProto padded by `ragged_pad_dataproto`."""
+    if data.batch is None or RAGGED_PADDING_KEY not in data.batch.keys():
+        return data
+    keep = ~data.batch.pop(RAGGED_PADDING_KEY).cpu()
+    if bool(keep.all()):
+        return data
+    keep_np = keep.numpy()
+    data.batch = data.batch[keep]
+    data.non_tensor_batch = {key: val[keep_np] for key, val in data.non_tensor_batch.items()}
+    return data
+
+
 def union_tensor_dict(tensor_dict1: TensorDict, tensor_dict2: TensorDict) -> TensorDict:
     """Union two tensordicts."""
     assert tensor_dict1.batch_size == tensor_dict2.batch_size, \
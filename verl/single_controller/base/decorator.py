@@ -42,17 +42,28 @@ class Execute(Enum):
     RANK_ZERO = 1
 
 
+def _ragged_pad(data, chunks):
+    """
+    A DataProto with meta_info['ragged_dispatch'] may have any size. It is padded with placeholder
+    rows to a multiple of `chunks`, which fill the last ranks and are dropped again on collect.
+    """
+    from verl.protocol import DataProto, ragged_pad_dataproto
+    if isinstance(data, DataProto) and data.meta_info.get('ragged_dispatch', False):
+        return ragged_pad_dataproto(data, chunks)
+    return data
+
+
 def _split_args_kwargs_data_proto(chunks, *args, **kwargs):
     from verl.protocol import DataProto, DataProtoFuture
     splitted_args = []
     for arg in args:
         assert isinstance(arg, (DataProto, DataProtoFuture))
-        splitted_args.append(arg.chunk(chunks=chunks))
+        splitted_args.append(_ragged_pad(arg, chunks).chunk(chunks=chunks))
 
     splitted_kwargs = {}
     for key, val in kwargs.items():
         assert isinstance(val, (DataProto, DataProtoFuture))
-        splitted_kwargs[key] = val.chunk(chunks=chunks)
+        splitted_kwargs[key] = _ragged_pad(val, chunks).chunk(chunks=chunks)
 
     return splitted_args, splitted_kwargs
 
@@ -127,7 +138,7 @@ def dispatch_megatron_compute_data_proto(worker_group, *args, **kwargs):
 
 
 def _concat_data_proto_or_future(output: List):
-    from verl.protocol import DataProto, DataProtoFuture
+    from verl.protocol import DataProto, DataProtoFuture, unpad_ragged_dataproto
     import ray
 
     # make sure all the elements in output has the same type
@@ -137,7 +148,7 @@ def _concat_data_proto_or_future(output: List):
     o = output[0]
 
     if isinstance(o, DataProto):
-        return DataProto.concat(output)
+        return unpad_ragged_dataproto(DataProto.concat(output))
     elif isinstance(o, ray.ObjectRef):
         return DataProtoFuture.concat(output)
     else:
@@ -391,6 +402,23 @@ def _materialize_futures(*args, **kwargs):
     return new_args, kwargs
 
 
+def _forward_ragged_padding(args, kwargs, output):
+    """
+    Copy the placeholder marker of a ragged input to an output of the same rows that does not
+    carry it already, so that the placeholders are dropped on collect whatever the worker did.
+    """
+    from verl.protocol import DataProto, RAGGED_PADDING_KEY
+    if not isinstance(output, DataProto) or output.batch is None or RAGGED_PADDING_KEY in output.batch.keys():
+        return output
+    for data in list(args) + list(kwargs.values()):
+        if isinstance(data, DataProto) and data.batch is not None and RAGGED_PADDING_KEY in data.batch.keys():
+            if len(data) == len(output):
+                device = next(iter(output.batch.values())).device
+                output.batch[RAGGED_PADDING_KEY] = data.batch[RAGGED_PADDING_KEY].to(device)
+            break
+    return output
+
+
 def register(dispatch_mode=Dispatch.ALL_TO_ALL, execute_mode=Execute.ALL, blocking=True, materialize_futures=True):
     _check_dispatch_mode(dispatch_mode=dispatch_mode)
     _check_execute_mode(execute_mode=execute_mode)
@@ -401,7 +429,7 @@ def register(dispatch_mode=Dispatch.ALL_TO_ALL, execute_mode=Execute.ALL, blocki
         def inner(*args, **kwargs):
             if materialize_futures:
                 args, kwargs = _materialize_futures(*args, **kwargs)
-            return func(*args, **kwargs)
+            return _forward_ragged_padding(args, kwargs, func(*args, **kwargs))
 
         attrs = {'dispatch_mode': dispatch_mode, 'execute_mode': execute_mode, 'blocking': blocking}
         setattr(inner, MAGIC_ATTR, attrs)
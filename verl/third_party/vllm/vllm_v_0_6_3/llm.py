@@ -148,6 +148,9 @@ class LLM(LLM):
     def free_cache_engine(self):
         self.llm_engine.free_cache_engine()
 
+    def reset_prefix_cache(self):
+        self.llm_engine.reset_prefix_cache()
+
     def get_tokenizer(self) -> Union[PreTrainedTokenizer, PreTrainedTokenizerFast]:
         return self.llm_engine.tokenizer
 
@@ -349,6 +349,21 @@ class LLMEngine(LLMEngine):
     def free_cache_engine(self):
         self.model_executor.free_cache_engine()
 
+    # NOTE: add for verl, vllm 0.6.3 has no way to drop the prefix cache
+    def reset_prefix_cache(self):
+        # The block manager maps token hashes to cached kv blocks. The mapping is stale once the
+        # weights are updated or the cache engine is freed, so it is replaced by an empty one.
+        # Only valid between generate calls, when no sequence holds blocks.
+        for scheduler in self.scheduler:
+            assert not scheduler.has_unfinished_seqs(), "cannot reset the prefix cache during generation"
+            scheduler.block_manager = type(scheduler.block_manager)(
+                block_size=self.cache_config.block_size,
+                num_gpu_blocks=self.cache_config.num_gpu_blocks,
+                num_cpu_blocks=self.cache_config.num_cpu_blocks,
+                sliding_window=self.cache_config.sliding_window,
+                enable_caching=self.cache_config.enable_prefix_caching,
+            )
+
     # NOTE(sgm): currently, we only support GPU executor
     # The GPUExecutor remove the Ray dependency
     @classmethod
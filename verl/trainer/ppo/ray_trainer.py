@@ -41,6 +41,8 @@ from verl.utils.seqlen_balancing import get_seqlen_balanced_partitions, log_seql
 
 import re
 from tools.llm_agent.generation import LLMGenerationManager, GenerationConfig
+from tools.llm_agent.scheduler import ContinuousRolloutScheduler
+from tools.llm_agent.profiler import RolloutProfiler
 
 WorkerType = Type[Worker]
 
@@ -474,6 +476,13 @@ class RayPPOTrainer(object):
             search_url = self.config.retriever.url,
             wiki_url = self.config.retriever.wiki_url,
             topk = self.config.retriever.topk,
+            search_timeout = self.config.retriever.timeout,
+            search_retries = self.config.retriever.retries,
+            pipeline_chunks = self.config.pipeline_chunks,
+            reuse_prefix_cache = self.config.actor_rollout_ref.rollout.get('enable_prefix_caching', False),
+            stop_at_action_tags = self.config.stop_at_action_tags,
+            tokenized_evidence = self.config.tokenized_evidence,
+            source_url_reward = self.config.get('source_url_reward', False),
         )
 
         # Agent config preparation
@@ -482,6 +491,7 @@ class RayPPOTrainer(object):
             actor_rollout_wg=self.actor_rollout_wg,
             config=gen_config,
             is_validation = True,
+            retrieval_actor=self.retrieval_actor,
         )
 
         if not self.config.do_search:
@@ -670,6 +680,13 @@ class RayPPOTrainer(object):
         self.actor_rollout_wg = all_wg['actor_rollout']
         self.actor_rollout_wg.init_model()
 
+        # in-cluster retrieval replaces the retrieval server at retriever.url
+        self.retrieval_actor = None
+        if self.config.retriever.get('backend', 'http') == 'ray':
+            # faiss and the encoder are only needed on the driver with this backend
+            from verl.workers.retriever_workers import create_retrieval_actor
+            self.retrieval_actor = create_retrieval_actor(self.config.retriever.ray)
+
     def _save_checkpoint(self):
         actor_local_path = os.path.join(self.config.trainer.default_local_dir, 'actor',
                                         f'global_step_{self.global_steps}')
@@ -747,13 +764,29 @@ class RayPPOTrainer(object):
             search_url = self.config.retriever.url,
             wiki_url = self.config.retriever.wiki_url,
             topk = self.config.retriever.topk,
+            search_timeout = self.config.retriever.timeout,
+            search_retries = self.config.retriever.retries,
+            pipeline_chunks = self.config.pipeline_chunks,
+            reuse_prefix_cache = self.config.actor_rollout_ref.rollout.get('enable_prefix_caching', False),
+            stop_at_action_tags = self.config.stop_at_action_tags,
+            tokenized_evidence = self.config.tokenized_evidence,
+            source_url_reward = self.config.get('source_url_reward', False),
+            n_agent = self.config.actor_rollout_ref.rollout.n_agent,
         )
 
         generation_manager = LLMGenerationManager(
             tokenizer=self.tokenizer,
             actor_rollout_wg=self.actor_rollout_wg,
             config=gen_config,
+            retrieval_actor=self.retrieval_actor,
         )
+        # with rollout_slots > 0 finished trajectories are replaced by new prompts during rollout
+        scheduler = None
+        if self.config.get('rollout_slots', 0) > 0:
+            scheduler = ContinuousRolloutScheduler(generation_manager,
+                                                   num_slots=self.config.rollout_slots,
+                                                   group_size=self.config.actor_rollout_ref.rollout.n_agent,
+                                                   max_staleness=self.config.get('rollout_max_staleness', 1))
 
         # start training loop
         for epoch in range(self.config.trainer.total_epochs):
@@ -764,6 +797,8 @@ class RayPPOTrainer(object):
 
                 batch: DataProto = DataProto.from_single_dict(batch_dict)
                 batch = batch.repeat(repeat_times=self.config.actor_rollout_ref.rollout.n_agent, interleave=True)
+                if self.config.get('profile_rollout', False):
+                    generation_manager.profiler = RolloutProfiler()
 
                 # pop those keys for generation
                 gen_batch = batch.pop(batch_keys=['input_ids', 'attention_mask', 'position_ids'])
@@ -786,6 +821,14 @@ class RayPPOTrainer(object):
                 # Below is aLL about agents - the "LLM + forloop"
                 ####################
                 # with _timer('step', timing_raw):
+                    elif scheduler is not None:
+                        with _timer('gen', timing_raw):
+                            generation_manager.timing_raw = timing_raw
+                            num_rows = len(gen_batch)
+                            scheduler.submit(batch, gen_batch)
+                            # rows finished in this step, not necessarily the ones just submitted
+                            batch, final_gen_batch_output = scheduler.next_batch(num_rows)
+                            metrics.update(scheduler.stats)
                     else:
                         first_input_ids = gen_batch.batch['input_ids'][:, -gen_config.max_start_length:].clone().long()
 
@@ -795,6 +838,14 @@ class RayPPOTrainer(object):
                                 gen_batch=gen_batch,
                                 initial_input_ids=first_input_ids,
                             )
+
+                    if self.config.do_search:
+                        if generation_manager.profiler is not None:
+                            metrics.update(generation_manager.profiler.metrics())
+                            if self.config.get('rollout_trace_dir'):
+                                generation_manager.profiler.dump_trace(os.path.join(
+                                    self.config.rollout_trace_dir, f'rollout_step_{self.global_steps}.json'))
+
                         # final_gen_batch_output.batch.apply(lambda x: x.long(), inplace=True)
                         for key in final_gen_batch_output.batch.keys():
                             final_gen_batch_output.batch[key] = final_gen_batch_output.batch[key].long()
@@ -805,7 +856,9 @@ class RayPPOTrainer(object):
 
                         # batch.non_tensor_batch['uid'] = np.array([str(uuid.uuid4()) for _ in range(len(batch.batch))],
                         #                                         dtype=object)
-                        batch.non_tensor_batch['uid'] = batch.non_tensor_batch['index'].copy()
+                        if scheduler is None:
+                            # the scheduler sets a uid per group, the index repeats when prompts carry over an epoch
+                            batch.non_tensor_batch['uid'] = batch.non_tensor_batch['index'].copy()
                                             
                         # repeat to align with repeated responses in rollout
                         batch = batch.repeat(repeat_times=self.config.actor_rollout_ref.rollout.n, interleave=True)
@@ -476,6 +476,14 @@ class ActorRolloutRefWorker(Worker):
         log_gpu_memory_usage('After recompute log prob', logger=logger)
         return output
 
+    @register(dispatch_mode=Dispatch.ONE_TO_ALL)
+    def free_rollout_cache(self):
+        """Free the kv cache engine kept by generate_sequences(keep_cache_engine=True)"""
+        assert self._is_rollout
+        if hasattr(self.rollout, 'free_cache_engine'):
+            self.rollout.free_cache_engine()
+        torch.cuda.empty_cache()
+
     @register(dispatch_mode=Dispatch.DP_COMPUTE_PROTO)
     def compute_ref_log_prob(self, data: DataProto):
         assert self._is_ref
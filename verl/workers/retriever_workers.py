@@ -9,17 +9,25 @@ import os
 import warnings
 from typing import List, Dict
 import functools
-from tqdm import tqdm
 from multiprocessing import Pool
 import faiss
 import torch
 import numpy as np
 from transformers import AutoConfig, AutoTokenizer, AutoModel
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datasets
+import ray
+from omegaconf import OmegaConf
+
+from tools.search.doc_store import DocStore
+from tools.search.faiss_utils import index_file_name, read_index
 
 
-def load_corpus(corpus_path: str):
+def load_corpus(corpus_path: str, doc_store_path: str = None):
+    if doc_store_path:
+        return DocStore.open_or_build(corpus_path, doc_store_path)
     corpus = datasets.load_dataset(
             'json', 
             data_files=corpus_path,
@@ -39,6 +47,8 @@ def read_jsonl(file_path):
 
 
 def load_docs(corpus, doc_idxs):
+    if isinstance(corpus, DocStore):
+        return corpus.get_many(doc_idxs)
     results = [corpus[int(idx)] for idx in doc_idxs]
 
     return results
@@ -46,13 +56,15 @@ def load_docs(corpus, doc_idxs):
 
 def load_model(
         model_path: str, 
-        use_fp16: bool = False
+        use_fp16: bool = False,
+        device: str = "cuda"
     ):
     model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
     model = AutoModel.from_pretrained(model_path, trust_remote_code=True)
     model.eval()
-    model.cuda()
-    if use_fp16: 
+    model.to(device)
+    # half precision only pays off (and is only supported well) on gpu
+    if use_fp16 and device != "cpu":
         model = model.half()
     tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, trust_remote_code=True)
 
@@ -83,9 +95,12 @@ class Encoder:
         self.pooling_method = pooling_method
         self.max_length = max_length
         self.use_fp16 = use_fp16
+        # actors without a gpu encode on cpu
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.model, self.tokenizer = load_model(model_path=model_path,
-                                                use_fp16=use_fp16)
+                                                use_fp16=use_fp16,
+                                                device=self.device)
 
     @torch.no_grad()
     def encode(self, query_list: List[str], is_query=True) -> np.ndarray:
@@ -109,7 +124,7 @@ class Encoder:
                                 truncation=True,
                                 return_tensors="pt"
                                 )
-        inputs = {k: v.cuda() for k, v in inputs.items()}
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
 
         if "T5" in type(self.model).__name__:
             # T5-based retrieval model
@@ -145,6 +160,7 @@ class BaseRetriever:
         
         self.index_path = config.index_path
         self.corpus_path = config.corpus_path
+        self.doc_store_path = getattr(config, 'doc_store_path', None)
 
         # self.cache_save_path = os.path.join(config.save_dir, 'retrieval_cache.json')
 
@@ -178,7 +194,7 @@ class BM25Retriever(BaseRetriever):
         self.searcher = LuceneSearcher(self.index_path)
         self.contain_doc = self._check_contain_doc()
         if not self.contain_doc:
-            self.corpus = load_corpus(self.corpus_path)
+            self.corpus = load_corpus(self.corpus_path, self.doc_store_path)
         self.max_process_num = 8
         
     def _check_contain_doc(self):
@@ -232,7 +248,7 @@ class BM25Retriever(BaseRetriever):
 
 
 class DenseRetriever(BaseRetriever):
-    r"""Dense retriever based on pre-built faiss index."""
+    r"""Dense retriever based on pre-built faiss index, held in-process or by a `FAISSIndexServer` actor."""
 
     def __init__(self, config: dict, index):
         super().__init__(config)
@@ -245,7 +261,7 @@ class DenseRetriever(BaseRetriever):
         #     self.index = faiss.index_cpu_to_all_gpus(self.index, co=co)
         #     # self.index = faiss.index_cpu_to_all_gpus(self.index)
 
-        self.corpus = load_corpus(self.corpus_path)
+        self.corpus = load_corpus(self.corpus_path, self.doc_store_path)
         self.encoder = Encoder(
              model_name = self.retrieval_method, 
              model_path = config.retrieval_model_path,
@@ -257,19 +273,17 @@ class DenseRetriever(BaseRetriever):
         self.batch_size = self.config.retrieval_batch_size
 
     def _search(self, query: str, num: int = None, return_score = False):
-        raise NotImplementedError
-        if num is None:
-            num = self.topk
-        query_emb = self.encoder.encode(query)
-        scores, idxs = self.index.search(query_emb, k=num)
-        idxs = idxs[0]
-        scores = scores[0]
-
-        results = load_docs(self.corpus, idxs)
+        results, scores = self._batch_search([query], num, return_score=True)
         if return_score:
-            return results, scores
+            return results[0], scores[0]
         else:
-            return results
+            return results[0]
+
+    def _search_index(self, batch_emb: np.ndarray, k: int):
+        if isinstance(self.index, ray.actor.ActorHandle):
+            # the embeddings and the returned score / id matrices move through the object store
+            return ray.get(self.index.batch_search.remote(ray.put(batch_emb), k=k))
+        return self.index.search(batch_emb, k)
 
     def _batch_search(self, query_list: List[str], num: int = None, return_score = False):
         if isinstance(query_list, str):
@@ -282,7 +296,7 @@ class DenseRetriever(BaseRetriever):
         results = []
         scores = []
 
-        for start_idx in tqdm(range(0, len(query_list), batch_size), desc='Retrieval process: '):
+        for start_idx in range(0, len(query_list), batch_size):
             query_batch = query_list[start_idx:start_idx + batch_size]
             
             # from time import time
@@ -290,15 +304,18 @@ class DenseRetriever(BaseRetriever):
             batch_emb = self.encoder.encode(query_batch)
             # b = time()
             # print(f'################### encode time {b-a} #####################')
-            batch_scores, batch_idxs = ray.get(self.index.batch_search.remote(batch_emb, k=num))
+            batch_scores, batch_idxs = self._search_index(batch_emb, k=num)
             batch_scores = batch_scores.tolist()
-            batch_idxs = batch_idxs.tolist()
             # print(f'################### search time {time()-b} #####################')
             # exit()
             
-            flat_idxs = sum(batch_idxs, [])
-            batch_results = load_docs(self.corpus, flat_idxs)
-            batch_results = [batch_results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
+            if isinstance(self.corpus, DocStore):
+                # the doc store fetches the whole (batch, topk) id matrix in one call
+                batch_results = self.corpus.get_many(batch_idxs)
+            else:
+                flat_idxs = batch_idxs.reshape(-1).tolist()
+                batch_results = load_docs(self.corpus, flat_idxs)
+                batch_results = [batch_results[i*num : (i+1)*num] for i in range(len(batch_idxs))]
             
             scores.extend(batch_scores)
             results.extend(batch_results)
@@ -325,12 +342,28 @@ def get_retriever(config, index):
 
 
 
+def load_index(config):
+    """Load the faiss index of `config`, cloned to all visible GPUs with `faiss_gpu`."""
+    if config.retrieval_method == 'bm25':
+        raise ValueError("bm25 has no faiss index, serve it with the retrieval server (retriever.backend: http)")
+    index_path = os.path.join(config.index_path, index_file_name(config.retrieval_method, config.get('faiss_type', 'Flat')))
+    index = read_index(index_path)
+
+    # sharded indexes are searched on cpu by one thread per shard
+    if config.faiss_gpu and faiss.get_num_gpus() > 0 and not isinstance(index, faiss.IndexShards):
+        co = faiss.GpuMultipleClonerOptions()
+        co.useFloat16 = True  # Reduce memory footprint
+        co.shard = True  # Distribute index across all GPUs
+        index = faiss.index_cpu_to_all_gpus(index, co=co)
+    return index
+
+
 class RetrieveWorker(Worker):
     """Environment worker that handles GPU-based environment operations."""
     
     def __init__(self, config, faiss_server):
         super().__init__()
-        config.index_path = os.path.join(config.index_path, f'{config.retrieval_method}_Flat.index') if config.retrieval_method != 'bm25' else os.path.join(config.index_path, 'bm25')
+        config.index_path = os.path.join(config.index_path, index_file_name(config.retrieval_method, getattr(config, 'faiss_type', 'Flat'))) if config.retrieval_method != 'bm25' else os.path.join(config.index_path, 'bm25')
 
         self.config = config  # Initialize environment later
         self.faiss_server = faiss_server
@@ -345,39 +378,65 @@ class RetrieveWorker(Worker):
         return self.retriever.batch_search(queries)
 
 
-import ray
-import faiss
-import torch
-
-@ray.remote(num_gpus=8)  # Allocate all GPUs
+@ray.remote
 class FAISSIndexServer:
-    """Ray Actor that loads and serves a shared FAISS index with FAISS GPU optimization."""
+    """
+    Ray actor that loads and serves a shared FAISS index.
+    Create it with `.options(num_gpus=...)`, with no GPUs the index is searched on cpu.
+    Searches run on a worker thread, so the actor keeps accepting calls while one is running.
+    """
 
     def __init__(self, config):
-        """Initialize the FAISS index only once."""
         print("[FAISSIndexServer] Loading FAISS index...")
         self.config = config
-        self.index = self.load_index(config)
+        self.index = load_index(config)
+        # faiss releases the gil, but a single index is not safe for concurrent searches
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
-    def load_index(self, config):
-        """Loads the FAISS index into GPU memory with sharding."""
-        index_path = os.path.join(config.index_path, f'{config.retrieval_method}_Flat.index')
-        index = faiss.read_index(index_path)
+    async def batch_search(self, batch_emb, k):
+        """Scores and ids of the top-`k` hits of each embedding."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.index.search, batch_emb, k)
 
-        if self.config.faiss_gpu:
 
-            # Apply FAISS GPU settings
-            co = faiss.GpuMultipleClonerOptions()
-            co.useFloat16 = True  # Reduce memory footprint
-            co.shard = True  # Distribute index across all GPUs
-            
-            print("[FAISSIndexServer] Moving FAISS index to all GPUs with sharding enabled...")
-            index = faiss.index_cpu_to_all_gpus(index, co=co)
+@ray.remote
+class RetrievalActor:
+    """
+    In-cluster retrieval backend, an alternative to the HTTP retrieval server.
+    Holds the encoder, the doc store and the index (or a handle of a shared
+    `FAISSIndexServer`) and returns the same `{"document", "score"}` hits as
+    /retrieve with `return_scores`, passed back as python objects instead of JSON.
+    Requests are served on a worker thread, one batch at a time.
+    """
+
+    def __init__(self, config, index_server=None):
+        self.config = config
+        index = index_server if index_server is not None else load_index(config)
+        self.retriever = get_retriever(config, index)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _retrieve(self, queries: List[str], topk: int):
+        results, scores = self.retriever.batch_search(queries, num=topk, return_score=True)
+        return [[{"document": doc, "score": float(score)} for doc, score in zip(docs, doc_scores)]
+                for docs, doc_scores in zip(results, scores)]
 
-            print("[FAISSIndexServer] FAISS index successfully moved to GPUs.")
-        return index
+    async def retrieve(self, queries: List[str], topk: int = None):
+        if not queries:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._retrieve, queries, topk or self.config.retrieval_topk)
 
-    def batch_search(self, batch_emb, k):
-        """Perform batch search on the FAISS index."""
-        print(f"[FAISSIndexServer] Received {len(batch_emb)} queries.")
-        return self.index.search(batch_emb, k)  # Adjust 'k' as needed
+
+def create_retrieval_actor(config):
+    """
+    Start a `RetrievalActor` for the `retriever.ray` section of the trainer config.
+    `num_gpus: 0` runs encoder and index on cpu, with `shared_index` the index is
+    served by a separate `FAISSIndexServer` actor that other retrieval actors can share.
+    """
+    config = OmegaConf.create(OmegaConf.to_container(config, resolve=True))
+    if config.retrieval_method == 'bm25':
+        # BM25Retriever is not implemented in the workers, see RetrieveWorker
+        raise ValueError("The ray retrieval backend only serves dense indexes, use retriever.backend: http for bm25")
+    index_server = None
+    if config.get('shared_index', False):
+        index_server = FAISSIndexServer.options(num_gpus=config.index_num_gpus).remote(config)
+    return RetrievalActor.options(num_cpus=config.num_cpus, num_gpus=config.num_gpus).remote(config, index_server)
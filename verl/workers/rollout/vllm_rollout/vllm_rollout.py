@@ -33,7 +33,8 @@ from tensordict import TensorDict
 from torch import nn
 
 from verl import DataProto
-from verl.utils.torch_functional import get_eos_mask, pad_sequence_to_length
+from verl.protocol import RAGGED_PADDING_KEY
+from verl.utils.torch_functional import get_eos_mask
 from verl.workers.rollout.base import BaseRollout
 from verl.third_party.vllm import LLM, vllm_version
 from verl.third_party.vllm import parallel_state as vllm_ps
@@ -88,6 +89,15 @@ class vLLMRollout(BaseRollout):
 
         assert model_hf_config.max_position_embeddings >= config.prompt_length + config.response_length, \
             "model context length should be greater than total sequence length"
+
+        # automatic prefix caching: a multi-turn rollout only prefills the tokens appended since its
+        # previous turn, as long as the kv cache engine is kept between the turns (see `keep_cache_engine`)
+        self.enable_prefix_caching = config.get('enable_prefix_caching', False)
+        engine_kwargs = {}
+        if self.enable_prefix_caching:
+            assert vllm_version == '0.6.3', "prefix caching in the rollout requires vllm 0.6.3"
+            engine_kwargs['enable_prefix_caching'] = True
+
         self.inference_engine = LLM(actor_module,
                                     tokenizer=tokenizer,
                                     model_hf_config=model_hf_config,
@@ -97,7 +107,8 @@ class vLLMRollout(BaseRollout):
                                     gpu_memory_utilization=config.gpu_memory_utilization,
                                     skip_tokenizer_init=False,
                                     max_model_len=config.prompt_length + config.response_length,
-                                    load_format=config.load_format)
+                                    load_format=config.load_format,
+                                    **engine_kwargs)
 
         # Offload vllm model to reduce peak memory usage
         self.inference_engine.offload_model_weights()
@@ -138,12 +149,21 @@ class vLLMRollout(BaseRollout):
         for key, value in old_sampling_params_args.items():
             setattr(self.sampling_params, key, value)
 
+    def free_cache_engine(self):
+        if self.config.free_cache_engine:
+            self.inference_engine.free_cache_engine()
+
     @torch.no_grad()
     def generate_sequences(self, prompts: DataProto, **kwargs) -> DataProto:
-        # rebuild vllm cache engine
+        # rebuild vllm cache engine, a no-op if it was kept from the previous turn
         if self.config.free_cache_engine:
             self.inference_engine.init_cache_engine()
 
+        # the cached blocks hold kv of the previous weights or of a freed cache engine,
+        # only later turns of the same rollout pass reset_prefix_cache=False
+        if self.enable_prefix_caching and prompts.meta_info.get('reset_prefix_cache', True):
+            self.inference_engine.reset_prefix_cache()
+
         idx = prompts.batch['input_ids']  # (bs, prompt_length)
         # left-padded attention_mask
         attention_mask = prompts.batch['attention_mask']
@@ -154,9 +174,13 @@ class vLLMRollout(BaseRollout):
 
         batch_size = idx.size(0)
 
+        # placeholder rows of a ragged dispatch are not generated, their responses are all padding
+        padding = prompts.batch[RAGGED_PADDING_KEY] if RAGGED_PADDING_KEY in prompts.batch.keys() else None
+        rows = list(range(batch_size)) if padding is None else torch.nonzero(~padding).squeeze(-1).tolist()
+
         idx_list = []
         # parse idx from torch.Tensor to List[List[str]]
-        for i in range(batch_size):
+        for i in rows:
             idx_list.append(_pre_process_inputs(self.pad_token_id, idx[i]))
 
         do_sample = prompts.meta_info.get('do_sample', True)
@@ -170,28 +194,45 @@ class vLLMRollout(BaseRollout):
                 'n': 1  # if greedy, only 1 response
             }
 
-        # users can customize different sampling_params at different run
-        with self.update_sampling_params(**kwargs):
-            output = self.inference_engine.generate(
-                prompts=None,  # because we have already convert it to prompt token id
-                sampling_params=self.sampling_params,
-                prompt_token_ids=idx_list,
-                use_tqdm=False)
-
-        # TODO(sgm): disable logprob when recompute_log_prob is enable
-        # if n = 1: (bs, response_length) ; if n > 1: (bs * n, response_length)
-        response = output[0].to(idx.device)
-        log_probs = output[1].to(idx.device)
-
-        if response.shape[1] < self.config.response_length:
-            response = pad_sequence_to_length(response, self.config.response_length, self.pad_token_id)
-            log_probs = pad_sequence_to_length(log_probs, self.config.response_length, self.pad_token_id)
-
-        if self.config.n > 1 and do_sample:
-            idx = idx.repeat_interleave(self.config.n, dim=0)
-            attention_mask = attention_mask.repeat_interleave(self.config.n, dim=0)
-            position_ids = position_ids.repeat_interleave(self.config.n, dim=0)
-            batch_size = batch_size * self.config.n
+        # per-call stop strings / stop token ids, e.g. the closing tags of an agent action. Stop strings
+        # are matched on the detokenized text, the returned ids end with the token that completed it
+        stop = prompts.meta_info.get('stop', None)
+        if stop:
+            kwargs.update(stop=list(stop), include_stop_str_in_output=True, detokenize=True)
+        stop_token_ids = prompts.meta_info.get('stop_token_ids', None)
+        if stop_token_ids:
+            kwargs['stop_token_ids'] = list(stop_token_ids)
+
+        # a per-call `n` samples that many responses of each prompt, e.g. the n_agent trajectories
+        # of an agent rollout, which share the prefill of their prompt
+        num_samples = prompts.meta_info.get('n', self.config.n) if do_sample else 1
+        if do_sample and 'n' in prompts.meta_info:
+            kwargs.update(n=num_samples, best_of=num_samples)
+        response = torch.full((batch_size * num_samples, self.config.response_length), self.pad_token_id,
+                              dtype=idx.dtype, device=idx.device)
+        if len(idx_list) > 0:
+            # users can customize different sampling_params at different run
+            with self.update_sampling_params(**kwargs):
+                output = self.inference_engine.generate(
+                    prompts=None,  # because we have already convert it to prompt token id
+                    sampling_params=self.sampling_params,
+                    prompt_token_ids=idx_list,
+                    use_tqdm=False)
+
+            # TODO(sgm): disable logprob when recompute_log_prob is enable
+            # if n = 1: (len(rows), response_length) ; if n > 1: (len(rows) * n, response_length)
+            generated = output[0].to(idx.device)
+            if padding is None:
+                response[:, :generated.shape[1]] = generated
+            else:
+                out_rows = torch.tensor(rows, device=idx.device)[:, None] * num_samples + torch.arange(num_samples, device=idx.device)
+                response[out_rows.reshape(-1), :generated.shape[1]] = generated
+
+        if num_samples > 1:
+            idx = idx.repeat_interleave(num_samples, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_samples, dim=0)
+            position_ids = position_ids.repeat_interleave(num_samples, dim=0)
+            batch_size = batch_size * num_samples
         seq = torch.cat([idx, response], dim=-1)
 
         response_length = response.size(1)
@@ -218,9 +259,12 @@ class vLLMRollout(BaseRollout):
                 'position_ids': position_ids
             },
             batch_size=batch_size)
+        if padding is not None:
+            batch[RAGGED_PADDING_KEY] = padding.repeat_interleave(num_samples, dim=0)
 
-        # free vllm cache engine
-        if self.config.free_cache_engine:
-            self.inference_engine.free_cache_engine()
+        # free vllm cache engine, unless the caller generates the next turn of the same rollout
+        # and frees it itself afterwards
+        if not prompts.meta_info.get('keep_cache_engine', False):
+            self.free_cache_engine()
 
         return DataProto(batch=batch)